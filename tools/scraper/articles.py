@@ -0,0 +1,299 @@
+'''Readability-style article extraction, in process: what `review` used to ask the Mercury Web Parser for.
+
+`extract(page, url)` fills Mercury's result schema (`title`, `author`, `date_published`, `lead_image_url`,
+`content`, `excerpt`, `word_count`...) from a page's html:
+    - metadata comes from the page's <meta> tags (Open Graph, `article:*`, schema.org itemprops), then its markup
+      (<h1>, <title>, bylines, <time datetime>)
+    - content: scripts, navigation and boilerplate blocks (comments, sidebars, share buttons...) are dropped, then
+      every paragraph scores its parent and grandparent by its length and commas. The best scoring block, less
+      its links, is the article, along with any sibling blocks that score close to it.
+
+It runs on lxml's C parser, and is CPU-bound: `review` runs it in the post-processing pool (see `postprocess`).
+
+    >>> page = """<html><head><title>Song of the week | Blog</title><meta name="author" content="Staff"></head><body>
+    ... <nav><a href="/">Home</a> <a href="/about">About</a></nav>
+    ... <div class="entry-content"><p>First, a long enough paragraph about the song, its band, and their tour.</p>
+    ... <p>Second, another paragraph, with <a href="/band">a link</a> to the band's page, and more words.</p></div>
+    ... <div class="sidebar"><p>Recent posts, some of them, with enough text to count as paragraphs too.</p></div>
+    ... </body></html>"""
+    >>> article = extract(page, 'http://blog.example.com/2018/05/song')
+    >>> article['title'], article['author'], article['domain'], article['word_count']
+    ('Song of the week', 'Staff', 'blog.example.com', 26)
+    >>> print(article['content'])
+    <div><div class="entry-content"><p>First, a long enough paragraph about the song, its band, and their tour.</p>
+    <p>Second, another paragraph, with <a href="http://blog.example.com/band">a link</a> to the band's page, and more words.</p></div></div>
+'''
+
+import lxml.etree
+import lxml.html
+import pandas as pd
+import re
+from urllib.parse import urljoin, urlparse
+
+# elements that are never article content
+REMOVE_TAGS = ('script', 'style', 'noscript', 'iframe', 'form', 'nav', 'footer', 'aside', 'button', 'input', 'select',
+               'textarea', 'svg', 'object', 'embed', 'link', 'meta')
+
+# class / id hints (as in Readability): blocks that are likely boilerplate, unless they may also be the article
+UNLIKELY = re.compile(r'banner|breadcrumb|combx|comment|community|disqus|extra|footer|gdpr|header|menu|related|remark|'
+                      r'replies|rss|shoutbox|sidebar|skyscraper|social|sponsor|supplemental|ad-break|agegate|pagination|'
+                      r'pager|popup|share|nav|newsletter|subscribe|widget', re.IGNORECASE)
+MAYBE = re.compile(r'and|article|body|column|content|main|shadow', re.IGNORECASE)
+POSITIVE = re.compile(r'article|body|content|entry|hentry|h-entry|main|page|post|text|blog|story', re.IGNORECASE)
+NEGATIVE = re.compile(r'hidden|banner|combx|comment|contact|foot|footer|footnote|masthead|media|meta|promo|related|'
+                      r'scroll|share|shoutbox|sidebar|skyscraper|sponsor|shopping|tags|tool|widget', re.IGNORECASE)
+
+# a paragraph shorter than this (characters) says nothing about its block
+MIN_PARAGRAPH = 25
+EXCERPT_LENGTH = 200
+
+# <meta> keys (property, name or itemprop) holding each field, in order of preference
+TITLE_KEYS = ('og:title', 'twitter:title', 'headline')
+AUTHOR_KEYS = ('author', 'article:author', 'parsely-author', 'sailthru.author', 'dc.creator')
+DATE_KEYS = ('article:published_time', 'datepublished', 'og:published_time', 'parsely-pub-date', 'sailthru.date',
+             'dc.date', 'date', 'pubdate', 'publishdate')
+IMAGE_KEYS = ('og:image', 'og:image:url', 'twitter:image', 'twitter:image:src')
+DESCRIPTION_KEYS = ('og:description', 'description', 'twitter:description')
+
+# separators between an article's title and its site's name in <title>
+_TITLE_SEPARATOR = re.compile(r'\s+(?:\||::|»|·|•)\s+')
+
+def extract(page, url):
+    '''The article in `page` (html text) fetched from `url`, in the Mercury Web Parser's result schema;
+    None if the page has no html to speak of.
+    '''
+    if not page or not page.strip():
+        return None
+
+    try:
+        doc = lxml.html.document_fromstring(page.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except (lxml.etree.ParserError, ValueError):
+        return None
+
+    meta = _meta(doc)
+    title = _title(doc, meta)
+    author = _author(doc, meta)
+    date_published = _date_published(doc, meta)
+    direction = doc.get('dir') or 'ltr'
+
+    _remove_boilerplate(doc)
+    article = _article(doc)
+    try:
+        article.make_links_absolute(url)
+    except ValueError: # a malformed link
+        pass
+
+    text = ' '.join(article.text_content().split())
+    lead_image_url = _first(meta, IMAGE_KEYS)
+    if lead_image_url is None:
+        images = [img.get('src') for img in article.iter('img') if img.get('src')]
+        lead_image_url = images[0] if images else None
+
+    excerpt = _first(meta, DESCRIPTION_KEYS)
+    if excerpt is None:
+        excerpt = text if len(text) <= EXCERPT_LENGTH else text[:EXCERPT_LENGTH].rsplit(' ', 1)[0] + '…'
+
+    return {
+        'title': title,
+        'author': author,
+        'date_published': date_published,
+        'dek': None,
+        'lead_image_url': urljoin(url, lead_image_url) if lead_image_url else None,
+        'content': lxml.html.tostring(article, encoding='unicode'),
+        'next_page_url': None,
+        'url': url,
+        'domain': urlparse(url).hostname,
+        'excerpt': excerpt,
+        'word_count': len(text.split()),
+        'direction': direction,
+        'total_pages': 1,
+        'rendered_pages': 1
+    }
+
+def _meta(doc):
+    meta = {}
+    for el in doc.iter('meta'):
+        key = (el.get('property') or el.get('name') or el.get('itemprop') or '').strip().lower()
+        content = (el.get('content') or '').strip()
+        if key and content:
+            meta.setdefault(key, content)
+
+    return meta
+
+def _first(meta, keys):
+    return next((meta[key] for key in keys if key in meta), None)
+
+def _text(el):
+    return ' '.join(el.text_content().split())
+
+def _title(doc, meta):
+    title = _first(meta, TITLE_KEYS)
+    if title is not None:
+        return title
+
+    # one <h1> on the page is the article's title; several are usually post titles in a listing
+    h1s = [_text(h1) for h1 in doc.iter('h1')]
+    if len(h1s) == 1 and h1s[0]:
+        return h1s[0]
+
+    title = doc.find('.//title')
+    if title is None or not _text(title):
+        return None
+
+    # leave out the site's name
+    return _TITLE_SEPARATOR.split(_text(title))[0]
+
+def _author(doc, meta):
+    author = _first(meta, AUTHOR_KEYS)
+    if author is not None and not author.startswith('http'):
+        return author
+
+    for xpath in ('//*[@rel="author"]', '//*[@itemprop="author"]', '//*[contains(concat(" ", normalize-space(@class), " "), " author ")]',
+                  '//*[contains(concat(" ", normalize-space(@class), " "), " byline ")]'):
+        for el in doc.xpath(xpath):
+            author = re.sub(r'^by\s+', '', _text(el), flags=re.IGNORECASE)
+            if author and len(author) <= 100:
+                return author
+
+    return None
+
+def _date_published(doc, meta):
+    candidates = [_first(meta, DATE_KEYS)]
+    candidates.extend(el.get('datetime') or el.get('content') for el in doc.xpath('//*[@itemprop="datePublished"]'))
+    candidates.extend(el.get('datetime') for el in doc.xpath('//time[@datetime]'))
+
+    for value in candidates:
+        date = _iso_date(value)
+        if date is not None:
+            return date
+
+    return None
+
+def _iso_date(value):
+    '''`value` as Mercury formats dates (UTC, ISO 8601), or None if it is not a date.
+
+        >>> _iso_date('2017-11-20T08:33:10-05:00'), _iso_date('November 20, 2017'), _iso_date('soon')
+        ('2017-11-20T13:33:10.000Z', '2017-11-20T00:00:00.000Z', None)
+    '''
+    if not value:
+        return None
+
+    try:
+        date = pd.Timestamp(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if date is pd.NaT:
+        return None
+
+    date = date.tz_localize('UTC') if date.tzinfo is None else date.tz_convert('UTC')
+
+    return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def _remove_boilerplate(doc):
+    for el in list(doc.iter(lxml.etree.Comment, *REMOVE_TAGS)):
+        el.drop_tree()
+
+    for el in list(doc.iter()):
+        if el.tag in ('html', 'body', 'article', 'main') or el.getparent() is None:
+            continue
+        hints = f'{el.get("class") or ""} {el.get("id") or ""}'
+        if UNLIKELY.search(hints) and not MAYBE.search(hints):
+            el.drop_tree()
+
+def _class_weight(el):
+    weight = 0
+    for hints in (el.get('class'), el.get('id')):
+        if hints:
+            if NEGATIVE.search(hints):
+                weight -= 25
+            if POSITIVE.search(hints):
+                weight += 25
+
+    return weight
+
+def _initial_score(el):
+    score = {'div': 5, 'article': 5, 'pre': 3, 'td': 3, 'blockquote': 3, 'ol': -3, 'ul': -3, 'dl': -3, 'th': -5}.get(el.tag, 0)
+    if el.tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+        score = -5
+
+    return score + _class_weight(el)
+
+def _link_density(el, text_length=None):
+    text_length = text_length if text_length is not None else len(_text(el))
+    if not text_length:
+        return 0.0
+
+    return sum(len(_text(a)) for a in el.iter('a')) / text_length
+
+def _article(doc):
+    '''The best scoring block of the page (and its best scoring siblings), in a <div>
+    '''
+    scores = {}
+    for paragraph in doc.iter('p', 'pre', 'td'):
+        text = _text(paragraph)
+        if len(text) < MIN_PARAGRAPH:
+            continue
+
+        score = 1 + text.count(',') + min(len(text) // 100, 3)
+        parent = paragraph.getparent()
+        grandparent = parent.getparent() if parent is not None else None
+        for ancestor, share in ((parent, 1), (grandparent, 0.5)):
+            if ancestor is None or ancestor.tag == 'html':
+                continue
+            if ancestor not in scores:
+                scores[ancestor] = _initial_score(ancestor)
+            scores[ancestor] += score * share
+
+    body = doc.find('body')
+    if not scores:
+        return _wrap([body if body is not None else doc])
+
+    scores = {el: score * (1 - _link_density(el)) for el, score in scores.items()}
+    top = max(scores, key=scores.get)
+
+    parent = top.getparent()
+    if parent is None or top.tag == 'body':
+        return _wrap([top])
+
+    threshold = max(10, scores[top] * 0.2)
+    blocks = []
+    for sibling in parent:
+        if sibling is top or scores.get(sibling, -1) >= threshold:
+            blocks.append(sibling)
+        elif sibling.tag == 'p':
+            text = _text(sibling)
+            if (len(text) > 80 and _link_density(sibling, len(text)) < 0.25) or (text.endswith('.') and _link_density(sibling, len(text)) == 0):
+                blocks.append(sibling)
+
+    return _wrap(blocks)
+
+def _wrap(blocks):
+    '''A <div> of `blocks` (or of their children, for the <body>), less links-only and empty blocks
+    '''
+    div = lxml.html.Element('div')
+    for block in blocks:
+        if block.tag in ('body', 'html'):
+            div.text = block.text
+            div.extend(list(block))
+        else:
+            div.append(block)
+            # text between blocks belongs to their old parent
+            block.tail = None
+
+    for el in list(div.iter('div', 'section', 'ul', 'ol', 'table')):
+        if el is div or el.getparent() is None:
+            continue
+        text = _text(el)
+        paragraphs = len(el.findall('.//p'))
+        if (_class_weight(el) < 0 and paragraphs < 3) or (_link_density(el, len(text)) > 0.5 and paragraphs < 2):
+            el.drop_tree()
+
+    for el in list(div.iter('p', 'div', 'section', 'span')):
+        if el is not div and el.getparent() is not None and not _text(el) and el.find('.//img') is None:
+            el.drop_tree()
+
+    return div
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,66 @@
+'''asyncio scraping backend: an alternative to the 'pool' backend's worker processes.
+
+Scrapes run concurrently on one event loop in a single process. Each URL is scraped with the
+scraper's own `scrape_url` on a thread of a shared executor, so requests still go through the
+run's host rate limiter and this process's pooled session; the loop caps concurrency overall
+(`concurrency` option) and per host (`host_concurrency` option).
+Results always come back in input order.
+'''
+
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import time
+from urllib.parse import urlparse
+import utils
+
+def run(scraper, urls, *args):
+    '''Scrape `urls` with `scraper.scrape_url(url, remaining_count, *args)`; returns results in input order.
+    '''
+    return run_jobs([(scraper, urls, args)])[0]
+
+def run_jobs(jobs):
+    '''Scrape several (scraper, urls, args) jobs concurrently on one event loop.
+    Returns one result list per job, each in its job's input order.
+    '''
+    return asyncio.run(_run_jobs(jobs, utils.get_option('concurrency'), utils.get_option('host_concurrency')))
+
+class Runner():
+    '''Scrapes single URLs on a shared executor, capping requests in flight overall and per host.
+    Create and use within a running event loop.
+    '''
+    def __init__(self, concurrency, host_concurrency):
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.host_semaphores = defaultdict(lambda: asyncio.Semaphore(host_concurrency))
+
+    async def call(self, host, func, *args):
+        '''Run `func(*args)` on the executor, holding one of `host`'s request slots
+        '''
+        async with self.host_semaphores[host]:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def scrape(self, scraper, url, remaining_count, *args):
+        return await self.call(urlparse(url).hostname, scraper.scrape_url, url, remaining_count, *args)
+
+    def close(self):
+        self.executor.shutdown()
+
+async def _run_jobs(jobs, concurrency, host_concurrency):
+    runner = Runner(concurrency, host_concurrency)
+    total = sum(len(urls) for _, urls, _ in jobs)
+    utils.metrics().submitted(total)
+
+    print(f'Executing async scrape of {total} urls with max {concurrency} concurrent requests ({host_concurrency} per host)')
+
+    start = time.time()
+    try:
+        job_results = await asyncio.gather(*[
+            asyncio.gather(*[runner.scrape(scraper, url, len(urls)-i, *args) for i, url in enumerate(urls)])
+            for scraper, urls, args in jobs])
+    finally:
+        runner.close()
+
+    end = time.time()
+    print(f'{total} urls scraped in {end-start:.2f}s.')
+
+    return [list(results) for results in job_results]
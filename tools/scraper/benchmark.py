@@ -0,0 +1,284 @@
+'''End-to-end throughput benchmarks of the CLI commands against local stand-in providers (`mock_providers`).
+
+Each scenario runs one command of reviews.py, features.py or scraper.py on generated inputs, in a fresh
+interpreter (so runs don't share memory or warm state), with the provider endpoints pointed at the
+stand-ins. The report covers, per scenario:
+    - wall time of the command, and requests per second received by the stand-ins
+    - p50 / p99 request latency seen by the scrapers (every `requests` call, retries included)
+    - per provider: achieved request rate against `request_rate`, and the most requests seen in any one second
+    - responses by status (injected 429 / 502 / 503 included)
+    - peak RSS of the largest process of the run (main process or pool worker)
+
+    python -u benchmark.py run --size=500 --request_rate=50 --num_processes=4 --out_file=bench.json
+    python -u benchmark.py run --scenarios='["review_mercury", "genius"]' --latency='{"mercury": 0.3}' --throttle_rate=0.02 --backoff_base=0.05
+
+Extra flags are run options (see README), passed to every command.
+'''
+
+from collections import Counter
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+import mock_providers
+
+SCENARIOS = ['time_machine', 'song_blogs', 'extern_song_ids', 'review', 'review_mercury', 'spotify_genre', 'spotify_audio', 'genius',
+             'pipeline_dom', 'pipeline_recipe_api', 'pipeline_structured']
+
+# songs per HypeM chart week, as served by `mock_providers`
+SONGS_PER_WEEK = 50
+
+def run(scenarios=None, size=200, request_rate=50, num_processes=4, out_file=None, quiet=True, seed=0,
+        latency=mock_providers.DEFAULTS['latency'], throttle_rate=mock_providers.DEFAULTS['throttle_rate'],
+        retry_after=mock_providers.DEFAULTS['retry_after'], error_rate=mock_providers.DEFAULTS['error_rate'],
+        bad_gateway_rate=mock_providers.DEFAULTS['bad_gateway_rate'], payload_kb=mock_providers.DEFAULTS['payload_kb'],
+        **options):
+    '''Run benchmark `scenarios` (default: all of `SCENARIOS`) on inputs of `size` records each.
+    Provider settings (`latency`, ...) take one value for all providers or a dict of per-provider values.
+    With `quiet`, command output goes to a log file per scenario instead of the console.
+    '''
+    scenarios = scenarios or SCENARIOS
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        print(f'[ERROR] Unknown scenarios: {", ".join(unknown)}. Choose from: {", ".join(SCENARIOS)}')
+        sys.exit()
+
+    work_dir = tempfile.mkdtemp(prefix='scraper_benchmark_')
+    providers = mock_providers.MockProviders(seed=seed, latency=latency, throttle_rate=throttle_rate, retry_after=retry_after,
+                                             error_rate=error_rate, bad_gateway_rate=bad_gateway_rate, payload_kb=payload_kb)
+    results = []
+    try:
+        urls = providers.start()
+        inputs = _write_inputs(work_dir, size, urls)
+
+        for name in scenarios:
+            providers.reset()
+            print(f'Running {name}...')
+            result = _run_scenario(name, inputs, urls, work_dir, request_rate, num_processes, options, quiet)
+            result.update(_provider_report(providers.stats(), request_rate, result.get('elapsed')))
+            results.append(result)
+            _print_result(result)
+    finally:
+        providers.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if out_file is not None:
+        with open(out_file, 'w') as f:
+            json.dump({'settings': {'size': size, 'request_rate': request_rate, 'num_processes': num_processes, 'seed': seed,
+                                    'latency': latency, 'throttle_rate': throttle_rate, 'retry_after': retry_after,
+                                    'error_rate': error_rate, 'bad_gateway_rate': bad_gateway_rate,
+                                    'payload_kb': payload_kb, 'options': options},
+                       'results': results}, f, indent=2)
+        print(f'Benchmark results saved to {out_file}')
+
+def _write_inputs(work_dir, size, urls):
+    '''Input files for every scenario; returns their paths by name
+    '''
+    blog = urls['blog']
+    songs = [{'itemid': f'i{n}', 'artist': f'Artist {n % 97}', 'title': f'Song {n} (feat. Someone)'} for n in range(size)]
+    # every fifth song repeats an earlier one's query (in another case), as chart re-entries do
+    for n in range(0, size, 5):
+        if n:
+            songs[n] = {**songs[n - 1], 'itemid': f'i{n}', 'title': songs[n - 1]['title'].upper()}
+
+    weeks = [{'popular_week': f'week {w}', 'songs': songs[w * SONGS_PER_WEEK:(w + 1) * SONGS_PER_WEEK]}
+             for w in range(math.ceil(size / SONGS_PER_WEEK))]
+    # one song in ten has no spotify id
+    songids = [{'itemid': f'i{n}', 'spotify_id': f's{n}' if n % 10 else None, 'genius_id': n} for n in range(size)]
+    bloglist = [f'{blog}/articles/review-{n}' for n in range(size)]
+    # two sites with 10 posts per index page (see `mock_providers`), as many pages as it takes to find `size` posts
+    pages = max(1, math.ceil(size / 20))
+    config = [{'friendly_name': f'blog {i}', 'index_url': f'{blog}/index?site={i}',
+               'pagination': {'type': 'query_param', 'query_param': '&page=', 'first_page': i * pages, 'last_page': (i + 1) * pages - 1},
+               'href_selector': 'a.post', 'content_selectors': ['div.description', 'div.instructions']} for i in range(2)]
+
+    inputs = {}
+    for name, records in [('songlist', songs), ('time_machine', weeks), ('songids', songids), ('bloglist', bloglist), ('config', config)]:
+        inputs[name] = os.path.join(work_dir, f'{name}.json')
+        with open(inputs[name], 'w') as f:
+            json.dump(records, f)
+
+    return inputs
+
+def _command(name, inputs, out_file, request_rate, num_processes, options):
+    '''(module, function, args, kwargs) of a scenario's command
+    '''
+    common = {'request_rate': request_rate, 'out_file': out_file, 'num_processes': num_processes, **options}
+    if name == 'time_machine':
+        with open(inputs['time_machine']) as f:
+            weeks = len(json.load(f))
+        return ('reviews', 'time_machine', ('key',), {'start_date': 'May-28-2018', 'days_from_start': 7 * weeks, **common})
+    if name == 'song_blogs':
+        return ('reviews', 'song_blogs', (inputs['time_machine'],), common)
+    if name == 'extern_song_ids':
+        return ('reviews', 'extern_song_ids', (inputs['songlist'],), {'spotify_token': 'token', 'genius_token': 'token', **common})
+    if name == 'review':
+        return ('reviews', 'review', (inputs['bloglist'],), common)
+    if name == 'review_mercury':
+        return ('reviews', 'review', (inputs['bloglist'], 'key'), {'extractor': 'mercury', **common})
+    if name in ('spotify_genre', 'spotify_audio'):
+        return ('features', name, (inputs['songids'], 'token'), common)
+    if name == 'genius':
+        return ('features', 'genius', (inputs['songids'], 'token'), common)
+    if name in ('pipeline_dom', 'pipeline_recipe_api', 'pipeline_structured'):
+        # index and content scrapes use one process per config row
+        del common['num_processes']
+        scrape_method = {'pipeline_dom': 'DOM', 'pipeline_recipe_api': 'RecipeAPI', 'pipeline_structured': 'StructuredData'}[name]
+        return ('scraper', 'Pipeline', (), {'config_file': inputs['config'], 'scrape_method': scrape_method, **common})
+
+def _run_scenario(name, inputs, urls, work_dir, request_rate, num_processes, options, quiet):
+    scenario_dir = os.path.join(work_dir, name)
+    os.makedirs(os.path.join(scenario_dir, 'latencies'))
+    out_file = os.path.join(scenario_dir, 'out.jsonl')
+    log_file = os.path.join(scenario_dir, 'log.txt') if quiet else None
+    spec = {'command': _command(name, inputs, out_file, request_rate, num_processes, options), 'urls': urls,
+            'scenario_dir': scenario_dir, 'log_file': log_file}
+
+    proc = subprocess.Popen([sys.executable, '-c', f'import benchmark; benchmark._child({json.dumps(spec)!r})'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    # wait4: resource usage of the command's process tree (pool workers included, once reaped)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    result = {'scenario': name, 'peak_rss_mb': rusage.ru_maxrss / 1024}
+    result_file = os.path.join(scenario_dir, 'result.json')
+    if proc.returncode != 0 or not os.path.exists(result_file):
+        print(f'[WARNING] {name} failed (exit code {proc.returncode})')
+        if log_file is not None:
+            with open(log_file) as f:
+                print(f.read()[-2000:])
+        result['error'] = proc.returncode
+        return result
+
+    with open(result_file) as f:
+        result.update(json.load(f))
+    result.update(_latency_report(os.path.join(scenario_dir, 'latencies')))
+
+    return result
+
+def _child(spec):
+    '''Run one scenario's command (in its own interpreter, see `_run_scenario`)
+    '''
+    spec = json.loads(spec)
+    if spec['log_file'] is not None:
+        log = os.open(spec['log_file'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+
+    import importlib
+    mock_providers.install(spec['urls'])
+    _log_latencies(os.path.join(spec['scenario_dir'], 'latencies'))
+
+    module_name, function_name, args, kwargs = spec['command']
+    function = getattr(importlib.import_module(module_name), function_name)
+
+    start = time.time()
+    if function_name == 'Pipeline':
+        function(*args, **kwargs).run()
+    else:
+        function(*args, **kwargs)
+    elapsed = time.time() - start
+
+    with open(kwargs['out_file']) as f:
+        records = sum(1 for line in f if line.strip())
+
+    with open(os.path.join(spec['scenario_dir'], 'result.json'), 'w') as f:
+        json.dump({'elapsed': elapsed, 'records': records}, f)
+
+def _log_latencies(log_dir):
+    '''Log the host, latency and status of every request sent from this process (and the pool workers it forks)
+    '''
+    import requests
+
+    send = requests.Session.send
+    files = {}
+    lock = threading.Lock()
+
+    def timed_send(session, request, **kwargs):
+        start = time.perf_counter()
+        status = 0 # no response: connection error or timeout
+        try:
+            res = send(session, request, **kwargs)
+            status = res.status_code
+            return res
+        finally:
+            latency = time.perf_counter() - start
+            with lock:
+                pid = os.getpid()
+                if pid not in files:
+                    files[pid] = open(os.path.join(log_dir, f'{pid}.log'), 'a', buffering=1)
+                files[pid].write(f'{urlparse(request.url).hostname} {latency:.6f} {status}\n')
+
+    requests.Session.send = timed_send
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+def _latency_report(log_dir):
+    latencies = []
+    for name in os.listdir(log_dir):
+        with open(os.path.join(log_dir, name)) as f:
+            latencies.extend(float(line.split()[1]) for line in f if line.strip())
+    latencies.sort()
+
+    return {'client_requests': len(latencies),
+            'p50_ms': _percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p99_ms': _percentile(latencies, 0.99) * 1000 if latencies else None}
+
+def _provider_report(stats, request_rate, elapsed):
+    providers = {}
+    statuses = Counter()
+    total = 0
+    for provider, provider_stats in stats.items():
+        arrivals = provider_stats['arrivals']
+        if not arrivals:
+            continue
+
+        total += len(arrivals)
+        statuses.update(provider_stats['statuses'])
+        # achieved rate between the first and last arrivals; a lone request has no interval to measure
+        achieved = (len(arrivals) - 1) / (arrivals[-1] - arrivals[0]) if len(arrivals) > 1 and arrivals[-1] > arrivals[0] else None
+        providers[provider] = {'requests': len(arrivals), 'achieved_rate': achieved,
+                               'rate_accuracy': achieved / request_rate if achieved is not None else None,
+                               'peak_1s': _peak_window(arrivals, 1.0), 'statuses': provider_stats['statuses']}
+
+    return {'requests': total, 'requests_per_sec': total / elapsed if elapsed else None,
+            'statuses': dict(statuses), 'providers': providers}
+
+def _peak_window(arrivals, window):
+    '''Most arrivals within any `window` seconds (`arrivals` sorted)
+
+        >>> _peak_window([0, 0.1, 0.2, 1.5, 1.6], 1.0)
+        3
+    '''
+    peak = 0
+    start = 0
+    for end, arrival in enumerate(arrivals):
+        while arrival - arrivals[start] >= window:
+            start += 1
+        peak = max(peak, end - start + 1)
+
+    return peak
+
+def _print_result(result):
+    if 'error' in result:
+        return
+
+    fmt = lambda value, spec: format(value, spec) if value is not None else 'n/a'
+    print(f'{result["scenario"]}: {result["records"]} records in {result["elapsed"]:.2f}s; '
+          f'{result["requests"]} requests ({fmt(result["requests_per_sec"], ".1f")}/s); '
+          f'latency p50 {fmt(result["p50_ms"], ".1f")}ms, p99 {fmt(result["p99_ms"], ".1f")}ms; '
+          f'peak RSS {result["peak_rss_mb"]:.0f}MB')
+    for provider, stats in result['providers'].items():
+        accuracy = f' ({stats["rate_accuracy"]:.0%} of target)' if stats['rate_accuracy'] is not None else ''
+        print(f'    {provider}: {stats["requests"]} requests; achieved {fmt(stats["achieved_rate"], ".2f")}/s{accuracy}; '
+              f'peak {stats["peak_1s"]} in 1s; statuses {stats["statuses"]}')
+
+if __name__ == '__main__':
+    import fire; fire.Fire()
@@ -0,0 +1,360 @@
+'''The run's one set of worker processes, shared by all of its stages.
+
+Every stage that fans out over processes - a multi-process scrape, the index and content steps of
+`Pipeline.run`, post-processing, each provider of `extern_song_ids` - takes a `Lane` of the run's
+`Executor` (through `utils.worker_pool`) instead of starting a `Pool` of its own:
+    - workers are started once, when a lane first needs them, and kept for the rest of the run: later stages
+      (and later chunks of the same stage) reuse them instead of forking and initializing new ones
+    - a lane of `num_processes` reserves that many workers for as long as it is open, and never has more tasks
+      than that with the workers: the rest wait in the lane. Lanes open at the same time get workers of their own,
+      so two providers with N workers each run fully in parallel (2 x N workers), and a lane whose tasks block
+      (the index step, waiting on the content step) can't starve another one.
+    - stages fan out from the main process (threads can open lanes concurrently), never from inside a worker:
+      worker processes can't have children of their own. A lane opened inside a worker runs its tasks in that worker.
+
+Lanes take tasks like a `multiprocessing.Pool` does (`apply_async` with callbacks, results with `get`).
+
+    >>> executor = Executor()
+    >>> lane = executor.lane(2)
+    >>> results = [lane.apply_async(pow, (2, n)) for n in range(5)]
+    >>> [result.get() for result in results]
+    [1, 2, 4, 8, 16]
+    >>> lane.apply_async(int, ('x',)).get()
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    >>> lane.close()
+    >>> executor.shutdown()
+
+Workers are forked by a fork server: a process the executor forks as soon as it is created, before the run starts
+threads of its own (`utils.command` creates the executor first thing). A process forked while other threads run gets
+the locks those threads hold (stdout's, the journal's...) locked for good, and can hang on them; the server has a
+single thread, and the workers it forks inherit the main process's state as of the executor's creation (options,
+the shared rate limiter and metrics, provider endpoints).
+
+A worker that dies (killed, out of memory) fails the task it was running, and the server starts another in its place.
+'''
+
+from collections import deque
+import multiprocessing
+from multiprocessing.connection import wait
+from multiprocessing.reduction import ForkingPickler
+import multiprocessing.util
+import os
+import signal
+import threading
+import time
+
+# seconds `shutdown` gives busy workers before terminating them
+SHUTDOWN_TIMEOUT = 30
+
+class Executor():
+    '''Worker processes started with `initializer(*initargs)`, handed tasks through lanes (see `lane`)
+    '''
+    def __init__(self, initializer=None, initargs=()):
+        self.lock = threading.Lock()
+        self.num_workers = 0
+        self.reserved = 0
+        self.tasks = multiprocessing.SimpleQueue()
+        self.results = multiprocessing.SimpleQueue()
+        self.pending = {} # task id -> `AsyncResult`
+        self.running = {} # worker pid -> id of its task
+        self.next_id = 0
+        self.broken = None # the exception workers failed to initialize with
+        self.result_handler = None
+        self.server = None
+
+        # workers run lanes' tasks themselves (see `InlineLane`)
+        if multiprocessing.current_process().daemon:
+            return
+
+        server_requests, self.requests = multiprocessing.Pipe(duplex=False)
+        self.server = multiprocessing.Process(target=_serve, args=(server_requests, self.tasks, self.results, initializer, initargs))
+        self.server.start()
+        server_requests.close()
+        # the server can't be a daemon (daemons have no children): stop it at exit if `shutdown` never was called
+        self.finalizer = multiprocessing.util.Finalize(self, _stop_server, args=(self.requests,), exitpriority=10)
+
+    def lane(self, num_processes):
+        '''A `Lane` of `num_processes` workers; more workers are started if the open lanes need more than there are
+        '''
+        if multiprocessing.current_process().daemon:
+            return InlineLane()
+
+        with self.lock:
+            self.reserved += num_processes
+            if self.reserved > self.num_workers:
+                self.requests.send(('start', self.reserved - self.num_workers))
+                self.num_workers = self.reserved
+
+            if self.result_handler is None:
+                self.result_handler = threading.Thread(target=self._handle_results, daemon=True)
+                self.result_handler.start()
+
+        return Lane(self, num_processes)
+
+    def _release(self, num_processes):
+        with self.lock:
+            self.reserved -= num_processes
+
+    def _submit(self, result, func, args):
+        # pickled here, so a task that can't be sent fails on its own result instead of in a worker
+        task = bytes(ForkingPickler.dumps((func, args)))
+        with self.lock:
+            if self.broken is not None:
+                raise self.broken
+            task_id = self.next_id
+            self.next_id += 1
+            self.pending[task_id] = result
+        self.tasks.put((task_id, task))
+
+    def _handle_results(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                return
+
+            kind, *args = message
+            with self.lock:
+                if kind == 'taken':
+                    task_id, pid = args
+                    self.running[pid] = task_id
+                    continue
+
+                if kind == 'done':
+                    task_id, pid, ok, value = args
+                    self.running.pop(pid, None)
+                    results = [self.pending.pop(task_id)]
+                elif kind == 'died':
+                    pid, exitcode = args
+                    task_id = self.running.pop(pid, None)
+                    results = [self.pending.pop(task_id)] if task_id in self.pending else []
+                    ok, value = False, RuntimeError(f'worker {pid} died (exit code {exitcode}) running the task')
+                else: # 'broken': no worker can run tasks
+                    pid, value = args
+                    self.broken = value
+                    results, self.pending = list(self.pending.values()), {}
+                    ok = False
+
+            for result in results:
+                result._set(ok, value)
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        '''Stop the workers once they have finished their tasks (they write their profiles and spans as they exit).
+        Workers still busy after `timeout` seconds (e.g. blocked on a stage the failure of a run left behind) are
+        terminated, and their tasks fail.
+        '''
+        if self.server is None:
+            return
+
+        with self.lock:
+            num_workers, self.num_workers = self.num_workers, 0
+        for _ in range(num_workers):
+            self.tasks.put(None)
+
+        self.finalizer.cancel()
+        self.requests.send(('stop', timeout))
+        self.server.join(timeout + 5)
+        if self.server.is_alive():
+            self.server.terminate()
+            self.server.join()
+        self.server = None
+
+        if self.result_handler is not None:
+            self.results.put(None)
+            self.result_handler.join()
+            self.result_handler = None
+
+        with self.lock:
+            unfinished, self.pending = list(self.pending.values()), {}
+        for result in unfinished:
+            result._set(False, RuntimeError('the executor shut down before the task finished'))
+
+def _stop_server(requests):
+    try:
+        requests.send(('stop', 0))
+    except OSError:
+        pass
+
+def _serve(requests, tasks, results, initializer, initargs):
+    '''The fork server: starts workers when asked, replaces those that die, and stops them all on 'stop'
+    '''
+    # Ctrl-C is for the main process (and the workers' tasks) to handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    workers = []
+    def start(count):
+        for _ in range(count):
+            worker = multiprocessing.Process(target=_work, args=(tasks, results, initializer, initargs), daemon=True)
+            worker.start()
+            workers.append(worker)
+
+    while True:
+        ready = wait([requests] + [worker.sentinel for worker in workers])
+
+        for worker in [worker for worker in workers if worker.sentinel in ready]:
+            worker.join()
+            workers.remove(worker)
+            # workers only exit cleanly when told to (or when they can't initialize: see `_work`)
+            if worker.exitcode != 0:
+                results.put(('died', worker.pid, worker.exitcode))
+                start(1)
+
+        if requests not in ready:
+            continue
+
+        try:
+            command, arg = requests.recv()
+        except EOFError: # the main process is gone
+            command, arg = 'stop', 0
+
+        if command == 'start':
+            start(arg)
+            continue
+
+        deadline = time.time() + arg
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        return
+
+def _work(tasks, results, initializer, initargs):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    pid = os.getpid()
+
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except BaseException as e:
+            results.put(('broken', pid, RuntimeError(f'worker failed to initialize: {e!r}')))
+            return
+
+    while True:
+        message = tasks.get()
+        if message is None:
+            return
+
+        task_id, task = message
+        results.put(('taken', task_id, pid))
+        try:
+            func, args = ForkingPickler.loads(task)
+            value, ok = func(*args), True
+        except BaseException as e: # `sys.exit()` in a task fails the task, not the worker
+            value, ok = e, False
+
+        try:
+            results.put(('done', task_id, pid, ok, value))
+        except Exception as e: # a result (or exception) that can't be pickled
+            results.put(('done', task_id, pid, False, RuntimeError(f'could not send the result back: {e!r}')))
+
+class AsyncResult():
+    '''The result of a task: `get` waits for it (and raises the task's exception, if it failed)
+    '''
+    def __init__(self, callback=None, error_callback=None, on_done=None):
+        self.callback = callback
+        self.error_callback = error_callback
+        self.on_done = on_done
+        self.event = threading.Event()
+
+    def _set(self, ok, value):
+        # callbacks first, as with `Pool`: by the time `get` returns, they have run
+        try:
+            if ok and self.callback is not None:
+                self.callback(value)
+            elif not ok and self.error_callback is not None:
+                self.error_callback(value)
+        except Exception as e:
+            # the callback's error is the result's: the thread delivering results carries on
+            ok, value = False, e
+        self.ok = ok
+        self.value = value
+        self.event.set()
+        if self.on_done is not None:
+            self.on_done()
+
+    def ready(self):
+        return self.event.is_set()
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise multiprocessing.TimeoutError
+
+        if not self.ok:
+            raise self.value
+
+        return self.value
+
+class Lane():
+    '''`num_processes` workers of an `Executor`: at most that many of the lane's tasks are with the workers at a time
+    '''
+    def __init__(self, executor, num_processes):
+        self.executor = executor
+        self.num_processes = num_processes
+        self.lock = threading.Lock()
+        self.waiting = deque() # (result, func, args) not handed to the workers yet
+        self.running = 0
+        self.closed = False
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        result = AsyncResult(callback, error_callback, on_done=self._task_done)
+        with self.lock:
+            if self.running >= self.num_processes:
+                self.waiting.append((result, func, args))
+                return result
+            self.running += 1
+
+        self._submit(result, func, args)
+
+        return result
+
+    def _submit(self, result, func, args):
+        try:
+            self.executor._submit(result, func, args)
+        except Exception as e:
+            result._set(False, e)
+
+    def _task_done(self):
+        with self.lock:
+            if self.waiting:
+                task = self.waiting.popleft()
+            else:
+                task = None
+                self.running -= 1
+                release = self.closed and self.running == 0
+        if task is not None:
+            self._submit(*task)
+        elif release:
+            self.executor._release(self.num_processes)
+
+    def close(self):
+        '''No more tasks: the lane's workers go back to the executor once its last task is done
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            release = self.running == 0
+        if release:
+            self.executor._release(self.num_processes)
+
+class InlineLane():
+    '''A lane opened in a worker process: tasks run right away, in that process
+    '''
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        result = AsyncResult(callback, error_callback)
+        try:
+            value, ok = func(*args), True
+        except Exception as e:
+            value, ok = e, False
+        result._set(ok, value)
+
+        return result
+
+    def close(self):
+        pass
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
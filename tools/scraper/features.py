@@ -1,156 +1,134 @@
 import html2text
-import json
-import math
-import numpy as np
-import pandas as pd
 import re
 import scraper
+import streams
+import tracing
 import utils
 
-def spotify_genre(songids_file, spotify_token, request_rate=0.25, out_file=None, num_processes=1):
-    # TODO: unlikely that the sequential calls to get artist ids and get genres will finish in under
-    # an hour, so use a token with longer expiration, or refresh your token between tasks.
+# provider endpoints (see `mock_providers.install`)
+SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+GENIUS_API_URL = 'https://api.genius.com'
+
+def spotify_genre(songids_file, spotify_token, request_rate=0.25, out_file=None, num_processes=1, **options):
+    with utils.command(out_file, **options):
+        # TODO: unlikely that the sequential calls to get artist ids and get genres will finish in under
+        # an hour, so use a token with longer expiration, or refresh your token between tasks.
+
+        with streams.RecordWriter(out_file) as writer:
+            for songids_df in streams.read_json_chunks(songids_file, utils.get_option('chunk_size')):
+                # get non-empty spotify ids
+                songids_df = songids_df.loc[(~songids_df.spotify_id.isna())]
+                if songids_df.empty:
+                    continue
+
+                headers = utils.create_auth_headers(bearer_token=spotify_token)
 
-    songids_df = pd.read_json(songids_file)
+                # batch endpoints: up to 50 tracks / artists per request, each distinct id looked up once
+                tracks_s = scraper.BatchAPIScraper(request_rate, _construct_spotify_tracks_url, 'tracks', 50, headers=headers)
+                tracks = tracks_s.lookup(list(songids_df.spotify_id), num_processes)
 
-    # get non-empty spotify ids
-    songids_df = songids_df.loc[(~songids_df.spotify_id.isna())]
-    relevant_spotify_ids = songids_df.spotify_id
+                # get spotify artist ids - just take first artist into account
+                artist_ids = [track['artists'][0]['id'] if track is not None and 'artists' in track else '' for track in tracks]
 
-    # get spotify track urls
-    track_api_urls = [_construct_spotify_track_url(id) for id in relevant_spotify_ids]
+                artists_s = scraper.BatchAPIScraper(request_rate, _construct_spotify_artists_url, 'artists', 50, headers=headers)
+                artists = artists_s.lookup(artist_ids, num_processes)
 
-    headers = utils.create_auth_headers(bearer_token=spotify_token)
-    api_s = scraper.APIScraper(request_rate, headers=headers)
-    api_results = utils.run_multi_scraper(api_s, track_api_urls, num_processes)
+                genres = [artist['genres'] if artist is not None else [] for artist in artists]
 
-    # get spotify artist urls - just take first artist into account
-    artist_ids = [res['artists'][0]['id'] if 'artists' in res else '' for res in api_results]
-    #artist_ids = songids_df.artist_id
-    artist_api_urls = [_construct_spotify_artist_url(id) for id in artist_ids]
+                songids_df = songids_df.assign(artist_id=lambda x: None)
+                songids_df = songids_df.assign(spotify_genres=lambda x: None)
 
-    api_s = scraper.APIScraper(request_rate, headers=headers)
-    api_results = utils.run_multi_scraper(api_s, artist_api_urls, num_processes)
+                songids_df.artist_id = artist_ids
+                songids_df.spotify_genres = genres
 
-    genres = [res['genres'] if len(res) else [] for res in api_results]
+                writer.write_df(songids_df)
 
-    songids_df = songids_df.assign(artist_id=lambda x: None)
-    songids_df = songids_df.assign(spotify_genres=lambda x: None)
+def spotify_audio(songids_file, spotify_token, request_rate=0.25, out_file=None, num_processes=1, **options):
+    with utils.command(out_file, **options):
+        with streams.RecordWriter(out_file) as writer:
+            for songids_df in streams.read_json_chunks(songids_file, utils.get_option('chunk_size')):
+                # get non-empty spotify ids
+                songids_df = songids_df.loc[(~songids_df.spotify_id.isna())]
+                if songids_df.empty:
+                    continue
 
-    songids_df.artist_id = artist_ids
-    songids_df.spotify_genres = genres
+                # spotify audio features API can take up to 100 ids at a time
+                headers = utils.create_auth_headers(bearer_token=spotify_token)
+                api_s = scraper.BatchAPIScraper(request_rate, _construct_spotify_audio_features_url, 'audio_features', 100, headers=headers)
+                features = api_s.lookup(list(songids_df.spotify_id), num_processes)
 
-    if out_file is not None:
-        songids_df.to_json(out_file, orient='records')
-    else:
-        print(songids_df.to_json(orient='records'))
+                songids_df = songids_df.assign(audio_features=lambda x: None)
+                songids_df.audio_features = features
 
-def spotify_audio(songids_file, spotify_token, request_rate=0.25, out_file=None, num_processes=1):
-    songids_df = pd.read_json(songids_file)
+                writer.write_df(songids_df)
 
-    # get non-empty spotify ids
-    songids_df = songids_df.loc[(~songids_df.spotify_id.isna())]
-    relevant_spotify_ids = songids_df.spotify_id
+def genius(songids_file, genius_token, request_rate=0.25, out_file=None, num_processes=1, **options):
+    with utils.command(out_file, **options):
+        h = html2text.HTML2Text()
+        h.ignore_links = True
+        h.ignore_images = True
 
-    # spotify audio features API can take up to 100 ids at a time
-    num_groups = math.ceil(len(relevant_spotify_ids) / 100)
-    groups = np.array_split(relevant_spotify_ids, num_groups)
+        regex = r'tag:([^,]+)'
+        with streams.RecordWriter(out_file) as writer:
+            # genius ids are read as nullable integers: a chunk with a missing id would otherwise have float ids (songs/1.0)
+            for songids_df in streams.read_json_chunks(songids_file, utils.get_option('chunk_size'), dtype={'genius_id': 'Int64'}):
+                # get genius ids that have a non-empty corresponding spotify id
+                songids_df = songids_df.loc[~songids_df.spotify_id.isna()]
+                relevant_genius_ids = songids_df.genius_id
 
-    api_urls = [_construct_spotify_audio_features_url(g) for g in groups]
+                # get genius song urls
+                song_api_urls = [_construct_genius_song_api_url(id) for id in relevant_genius_ids]
+                headers = utils.create_auth_headers(bearer_token=genius_token)
+                api_s = scraper.APIScraper(request_rate, headers=headers)
+                api_results = utils.iter_multi_scraper(api_s, song_api_urls, num_processes)
 
-    headers = utils.create_auth_headers(bearer_token=spotify_token)
-    api_s = scraper.APIScraper(request_rate, headers=headers)
-    api_results = utils.run_multi_scraper(api_s, api_urls, num_processes)
+                song_urls = [res['response']['song']['url'] if 'response' in res else '' for res in api_results]
 
-    songids_df = songids_df.assign(audio_features=lambda x: None)
+                # only the page_data meta tag is needed: stop downloading each page once it has come in
+                page_s = scraper.TagScraper(request_rate)
+                page_results = utils.iter_multi_scraper(page_s, song_urls, num_processes, 'meta', {'itemprop': 'page_data'}, 'content', True)
 
-    features = []
-    for res in api_results:
-        features.extend(res['audio_features'])
+                for song, page_data in zip(songids_df.to_dict(orient='records'), page_results):
+                    if page_data is None:
+                        writer.write({**song, 'genres': None, 'desc': None})
+                        continue
 
-    songids_df.audio_features = features
+                    with tracing.span('extract', genius_id=song['genius_id']):
+                        sections = page_data['chartbeat']['sections']
 
-    if out_file is not None:
-        songids_df.to_json(out_file, orient='records')
-    else:
-        print(songids_df.to_json(orient='records'))
+                        try:
+                            matches = re.finditer(regex, sections)
+                            song_genres = [match.group(1) for match in matches]
+                        except Exception as e:
+                            print(f'[WARNING] error getting song genres - setting to None')
+                            print(e)
+                            song_genres = None
 
-def genius(songids_file, genius_token, request_rate=0.25, out_file=None, num_processes=1):
-    songids_df = pd.read_json(songids_file)
+                        try:
+                            desc = h.handle(page_data['song']['description']['html'])
+                        except Exception as e:
+                            print(f'[WARNING] error getting song desc - setting to None')
+                            print(e)
+                            desc = None
+
+                    # TODO: desc == '\n\n?\n\n'
 
-    # get genius ids that have a non-empty corresponding spotify id
-    songids_df = songids_df.loc[~songids_df.spotify_id.isna()]
-    relevant_genius_ids = songids_df.genius_id
+                    writer.write({**song, 'genres': song_genres, 'desc': desc})
+
+def _construct_spotify_artists_url(ids):
+    # maximum: 50 IDs
+    return f'{SPOTIFY_API_URL}/artists?ids={",".join(ids)}'
 
-    # get genius song urls
-    song_api_urls = [_construct_genius_song_api_url(id) for id in relevant_genius_ids]
-    headers = utils.create_auth_headers(bearer_token=genius_token)
-    api_s = scraper.APIScraper(request_rate, headers=headers)
-    api_results = utils.run_multi_scraper(api_s, song_api_urls, num_processes)
-
-    song_urls = [res['response']['song']['url'] if 'response' in res else '' for res in api_results]
-
-    dom_s = scraper.DOMScraper(request_rate)
-    dom_results = utils.run_multi_scraper(dom_s, song_urls, num_processes, ['meta[itemprop="page_data"]'], 'content')
-
-    songids_df = songids_df.assign(genres=lambda x:None, desc=lambda x:None)
-
-    h = html2text.HTML2Text()
-    h.ignore_links = True
-    h.ignore_images = True
-
-    genres = []
-    descs = []
-    regex = r'tag:([^,]+)'
-    for content in dom_results:
-        if content is None:
-            genres.append(None)
-            descs.append(None)
-            continue
-
-        sections = json.loads(content)['chartbeat']['sections']
-
-        try:
-            matches = re.finditer(regex, sections)
-            song_genres = [match.group(1) for match in matches]
-        except Exception as e:
-            print(f'[WARNING] error getting song genres - setting to None')
-            print(e)
-            song_genres = None
-
-        genres.append(song_genres)
-
-        try:
-            desc = h.handle(json.loads(content)['song']['description']['html'])
-        except Exception as e:
-            print(f'[WARNING] error getting song desc - setting to None')
-            print(e)
-            desc = None
-
-        descs.append(desc)
-
-    songids_df.genres = genres
-    songids_df.desc = descs
-
-    # TODO: desc == '\n\n?\n\n'
-
-    if out_file is not None:
-        songids_df.to_json(out_file, orient='records')
-    else:
-        print(songids_df.to_json(orient='records'))
-
-def _construct_spotify_artist_url(id):
-    return f'https://api.spotify.com/v1/artists/{id}'
-
-def _construct_spotify_track_url(id):
-    return f'https://api.spotify.com/v1/tracks/{id}'
+def _construct_spotify_tracks_url(ids):
+    # maximum: 50 IDs
+    return f'{SPOTIFY_API_URL}/tracks?ids={",".join(ids)}'
 
 def _construct_spotify_audio_features_url(ids):
     # maximum: 100 IDs
-    return f'https://api.spotify.com/v1/audio-features?ids={",".join(ids)}'
+    return f'{SPOTIFY_API_URL}/audio-features?ids={",".join(ids)}'
 
 def _construct_genius_song_api_url(id):
-    return f'https://api.genius.com/songs/{id}?text_format=plain'
+    return f'{GENIUS_API_URL}/songs/{id}?text_format=plain'
 
 if __name__ == '__main__':
     import fire; fire.Fire()
\ No newline at end of file
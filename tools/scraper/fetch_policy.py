@@ -0,0 +1,198 @@
+'''Failure handling for `utils.RequestRateLimiter`: timeouts, retries with backoff, circuit breakers and fallbacks.
+
+Every request gets connect and read timeouts (`connect_timeout`, `read_timeout` options). Connection
+errors, timeouts and the `Policy`'s retry statuses are retried up to `max_retries` times, with
+exponentially growing, jittered waits (`backoff`).
+
+With a policy's `circuit_breaker` on, failures also count against the target host's circuit breaker.
+After `breaker_threshold` consecutive failures the breaker opens: requests to the host fail right away
+(`HostUnavailable`), without spending rate budget or timeouts on it, until `breaker_cooldown` seconds
+have passed and one probe request is let through. Like the rate limiter, the breakers live in shared
+memory and hold for the whole run (see `utils.circuit_breakers`). Breakers are for runs over many hosts, some of them dead (blogs):
+they are off by default, as a run against one API host would otherwise drop every request for
+`breaker_cooldown` seconds after a short outage of that host.
+
+When a request fails for good (or answers with one of the policy's fallback statuses), the policy's
+fallbacks are tried in order, e.g. the page's copy on the Wayback Machine (`wayback_url`).
+'''
+
+import multiprocessing
+import random
+import requests
+import time
+from urllib.parse import urlparse
+import zlib
+
+NUM_SLOTS = 4096
+
+# statuses worth retrying by default: the server (or a proxy in front of it) may well answer next time
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# fields stored per slot in the shared array
+_HOST, _FAILURES, _OPEN_UNTIL = range(3)
+_NUM_FIELDS = 3
+
+class HostUnavailable(requests.exceptions.ConnectionError):
+    '''The host's circuit breaker is open: it failed too often recently to be worth a request.
+    '''
+
+def backoff(attempt, base, cap):
+    '''Seconds to wait before retry number `attempt` (from 0): "full jitter" exponential backoff,
+    so workers that failed together don't all retry together.
+
+        >>> all(0 <= backoff(attempt, 0.5, 4) <= min(4, 0.5 * 2 ** attempt) for attempt in range(10))
+        True
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def wayback_url(url):
+    '''The Wayback Machine's copy of `url` (its latest snapshot, as the archive redirects to the nearest one)
+    '''
+    return f'https://web.archive.org/web/1000/{url}'
+
+def wayback_raw_url(url):
+    '''The Wayback Machine's copy of `url` as it was archived, without the archive's toolbar or rewritten links
+    '''
+    return f'https://web.archive.org/web/1000id_/{url}'
+
+class Policy():
+    '''How one scraper's requests fail over.
+
+    `retry_statuses`: response statuses that are retried (with backoff)
+    `fallbacks`: functions mapping a failed target url to another url to try (or None to skip), in order;
+    module-level functions, so the policy can be sent to pool workers
+    `fallback_statuses`: response statuses that go straight to the fallbacks, without retries
+    `target_param`: for APIs that fetch a page on our behalf (e.g. `...parser?url=<page>`), the query parameter
+    holding the page url. It must come last in the url. Breakers then track the page's host rather than
+    the API's, and fallbacks rewrite the page url.
+    `circuit_breaker`: whether failures (see `host_failed`) count against the target host's circuit breaker, and an
+    open breaker fails the host's requests right away
+
+        >>> policy = Policy(fallbacks=[wayback_url], target_param='url', circuit_breaker=True)
+        >>> policy.target('https://api.example.com/parser?url=http://blog.example.com/post?id=1')
+        'http://blog.example.com/post?id=1'
+        >>> policy.breaker_key('https://api.example.com/parser?url=http://blog.example.com/post?id=1')
+        'blog.example.com'
+        >>> list(policy.fallback_urls('https://api.example.com/parser?url=http://blog.example.com/post'))
+        ['https://api.example.com/parser?url=https://web.archive.org/web/1000/http://blog.example.com/post']
+    '''
+    def __init__(self, retry_statuses=RETRY_STATUSES, fallbacks=(), fallback_statuses=(), target_param=None, circuit_breaker=False):
+        self.retry_statuses = tuple(retry_statuses)
+        self.fallbacks = tuple(fallbacks)
+        self.fallback_statuses = tuple(fallback_statuses)
+        self.target_param = target_param
+        self.circuit_breaker = circuit_breaker
+
+    def _target_index(self, url):
+        if self.target_param is None:
+            return 0
+
+        for sep in ('?', '&'):
+            idx = url.find(f'{sep}{self.target_param}=')
+            if idx > -1:
+                return idx + len(self.target_param) + 2
+
+        return 0
+
+    def target(self, url):
+        return url[self._target_index(url):]
+
+    def host_failed(self, status_code, fallback=False):
+        '''Whether a response with `status_code` counts as a failure of its host: server errors (5xx) do (as do
+        connection errors and timeouts). Other answers (403, 404...) come from a healthy host, and so does a fallback
+        status for a `fallback` url: Mercury's 502 for a page the Wayback Machine has no copy of says nothing of
+        the archive.
+
+            >>> policy = Policy(fallback_statuses=(404, 502))
+            >>> policy.host_failed(503), policy.host_failed(404), policy.host_failed(502), policy.host_failed(502, fallback=True)
+            (True, False, True, False)
+        '''
+        return status_code >= 500 and not (fallback and status_code in self.fallback_statuses)
+
+    def breaker_key(self, url):
+        # host and port: two servers on one machine fail independently
+        return urlparse(self.target(url)).netloc.lower()
+
+    def fallback_urls(self, url):
+        idx = self._target_index(url)
+        for fallback in self.fallbacks:
+            target = fallback(url[idx:])
+            if target is not None:
+                yield url[:idx] + target
+
+class CircuitBreakers():
+    '''Consecutive-failure circuit breakers, one per host, in shared memory.
+
+    Hosts are hashed into a fixed number of slots; each slot remembers a fingerprint of its host,
+    so a host never trips - or is blocked by - another host's breaker (at worst, a host that
+    finds its slot taken by an open breaker goes unprotected).
+
+        >>> breakers = CircuitBreakers(threshold=2, cooldown=60)
+        >>> breakers.failed('dead.example.com')
+        False
+        >>> breakers.allow('dead.example.com')
+        True
+        >>> breakers.failed('dead.example.com')
+        True
+        >>> breakers.allow('dead.example.com')
+        False
+        >>> breakers.allow('alive.example.com')
+        True
+    '''
+    def __init__(self, threshold, cooldown, num_slots=NUM_SLOTS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.num_slots = num_slots
+        self.lock = multiprocessing.Lock()
+        self.slots = multiprocessing.Array('d', num_slots * _NUM_FIELDS, lock=False)
+
+    def _slot(self, host):
+        host = (host or '').encode()
+        # fingerprints are kept non-zero, so an empty slot never matches
+        return (zlib.crc32(host) % self.num_slots) * _NUM_FIELDS, zlib.adler32(host) + 1
+
+    def allow(self, host):
+        '''Whether a request to `host` may go out. Once an open breaker's cooldown is over,
+        one caller gets through as a probe; the others keep waiting for its outcome.
+        '''
+        with self.lock:
+            o, fingerprint = self._slot(host)
+            s = self.slots
+            if s[o + _HOST] != fingerprint or s[o + _FAILURES] < self.threshold:
+                return True
+
+            now = time.time()
+            if now < s[o + _OPEN_UNTIL]:
+                return False
+
+            s[o + _OPEN_UNTIL] = now + self.cooldown
+            return True
+
+    def failed(self, host):
+        '''Count a failure; returns True if it opened the host's breaker.
+        '''
+        with self.lock:
+            o, fingerprint = self._slot(host)
+            s = self.slots
+            if s[o + _HOST] != fingerprint:
+                if s[o + _FAILURES] >= self.threshold and time.time() < s[o + _OPEN_UNTIL]:
+                    return False # the slot is taken by another host's open breaker
+                s[o + _HOST] = fingerprint
+                s[o + _FAILURES] = 0
+
+            s[o + _FAILURES] += 1
+            if s[o + _FAILURES] < self.threshold:
+                return False
+
+            s[o + _OPEN_UNTIL] = time.time() + self.cooldown
+            return s[o + _FAILURES] == self.threshold
+
+    def succeeded(self, host):
+        with self.lock:
+            o, fingerprint = self._slot(host)
+            if self.slots[o + _HOST] == fingerprint:
+                self.slots[o + _FAILURES] = 0
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
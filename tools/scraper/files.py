@@ -0,0 +1,51 @@
+'''File helpers shared by the modules that keep state on disk while several processes (and runs) use it.
+
+Append-only JSON Lines files - the journal, the search cache, trace spans - are written a whole line at a time,
+flushed right away (`append`), and read back line by line (`complete_lines`). A process killed mid-write leaves at
+most a partial last line, which readers skip: the file stays readable up to its last complete record.
+
+Files rewritten in place - response cache entries, metrics snapshots - are written to a temporary file and renamed
+over the old one (`write_atomic`), so a reader (another worker, a Prometheus collector) sees the old file or the new
+one, never a partial one.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'log.jsonl')
+    >>> with open(path, 'a') as f:
+    ...     append(f, '{"a": 1}\\n'); _ = f.write('{"b": ')
+    >>> with open(path) as f:
+    ...     list(complete_lines(f))
+    ['{"a": 1}\\n']
+'''
+
+import os
+import tempfile
+
+def process_path(directory):
+    '''This process's own append-only file in `directory` (processes never append to the same file)
+    '''
+    return os.path.join(directory, f'{os.getpid()}.jsonl')
+
+def append(f, line):
+    '''Append `line` (ending in a newline) to `f` and flush it
+    '''
+    f.write(line)
+    f.flush()
+
+def complete_lines(f):
+    '''The lines of `f` (text or binary), without a partial last line
+    '''
+    for line in f:
+        if line[-1:] in ('\n', b'\n'):
+            yield line
+
+def write_atomic(path, data):
+    '''Replace `path` with `data` (bytes) all at once
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
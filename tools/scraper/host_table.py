@@ -0,0 +1,83 @@
+'''Per-host records in shared memory: the run-wide state every process updates for each host (rate limits, metrics).
+
+Each host gets a record of its own. Hosts are keyed by a 64-bit fingerprint of their name and placed by open
+addressing (linear probing) in a table twice the size of `max_hosts`, so probes stay short and no two hosts share a
+record. Past `max_hosts` distinct hosts, further hosts share one overflow record, named `OTHER`.
+
+Callers hold the table's `lock` while they look up (`offset`) and update a record.
+
+    >>> table = HostTable(num_fields=1, max_hosts=2)
+    >>> with table.lock:
+    ...     for host, count in (('a.example.com', 1), ('b.example.com', 2), ('c.example.com', 4), ('d.example.com', 8)):
+    ...         table.slots[table.offset(host)] += count
+    ...     print(sorted((name, table.slots[o]) for name, o in table.hosts()))
+    [('(other hosts)', 12.0), ('a.example.com', 1.0), ('b.example.com', 2.0)]
+'''
+
+import hashlib
+import multiprocessing
+
+# distinct hosts a table keeps apart
+MAX_HOSTS = 4096
+
+# bytes of a host's name kept for reporting
+HOST_BYTES = 64
+
+# name of the record shared by the hosts past `max_hosts`
+OTHER = '(other hosts)'
+
+class HostTable():
+    '''`num_fields` doubles per host (`slots[offset(host) + field]`), for up to `max_hosts` hosts
+    '''
+    def __init__(self, num_fields, max_hosts=MAX_HOSTS):
+        self.num_fields = num_fields
+        self.max_hosts = max_hosts
+        # the last slot is the overflow record
+        self.num_slots = 2 * max_hosts + 1
+        self.lock = multiprocessing.Lock()
+        self.keys = multiprocessing.Array('Q', self.num_slots, lock=False)
+        self.names = multiprocessing.Array('c', self.num_slots * HOST_BYTES, lock=False)
+        self.slots = multiprocessing.Array('d', self.num_slots * num_fields, lock=False)
+        self.used = multiprocessing.Value('q', 0, lock=False)
+
+    def offset(self, host):
+        '''Offset of `host`'s record in `slots`, claimed on first use. Call with the lock held.
+        '''
+        name = (host or '').encode()
+        # fingerprints are kept non-zero: zero marks a free slot
+        key = int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), 'little') or 1
+
+        slot = key % (self.num_slots - 1)
+        while self.keys[slot] != key:
+            if self.keys[slot] == 0:
+                if self.used.value >= self.max_hosts:
+                    return self._overflow()
+                self.keys[slot] = key
+                self.names[slot * HOST_BYTES:slot * HOST_BYTES + len(name[:HOST_BYTES])] = name[:HOST_BYTES]
+                self.used.value += 1
+                break
+            slot = (slot + 1) % (self.num_slots - 1)
+
+        return slot * self.num_fields
+
+    def _overflow(self):
+        slot = self.num_slots - 1
+        if self.keys[slot] == 0:
+            self.keys[slot] = 1
+            name = OTHER.encode()
+            self.names[slot * HOST_BYTES:slot * HOST_BYTES + len(name)] = name
+
+        return slot * self.num_fields
+
+    def hosts(self):
+        '''(name, offset) of every record in use. Call with the lock held.
+        '''
+        keys = self.keys[:]
+        names = self.names[:]
+
+        return [(names[slot * HOST_BYTES:(slot + 1) * HOST_BYTES].rstrip(b'\x00').decode(errors='replace'), slot * self.num_fields)
+                for slot in range(self.num_slots) if keys[slot]]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,206 @@
+'''Persistent on-disk HTTP response cache for `utils.RequestRateLimiter`.
+
+Successful responses are stored under `cache_dir`, keyed by method, URL, request body and the
+request headers that change a response (`VARY_HEADERS`; credentials are deliberately left out so a
+refreshed token still hits the cache). Credentials (`SENSITIVE_HEADERS`) are never written to disk either. Fresh entries (younger than `ttl` seconds) are served without
+touching the network or the rate limiter; stale entries are revalidated with If-None-Match /
+If-Modified-Since, so an unchanged resource costs a 304. The cache is bounded to `max_bytes`,
+evicting least recently used entries first.
+
+The cache's size is walked from disk once, when it is created, and tracked from then on in shared memory by every
+process storing entries (the cache is handed to pool workers); the directory is only walked again to evict, once the
+tracked size passes `max_bytes`.
+'''
+
+import files
+import hashlib
+import multiprocessing
+import os
+import pickle
+import requests
+from requests.structures import CaseInsensitiveDict
+import time
+
+VARY_HEADERS = ('accept', 'accept-language', 'content-type')
+
+# request headers never written to disk (cache entries, WARC archives)
+SENSITIVE_HEADERS = ('authorization', 'proxy-authorization', 'cookie', 'x-api-key')
+
+def public_headers(headers):
+    '''`headers` without credentials
+    '''
+    return {name: value for name, value in (headers or {}).items() if name.lower() not in SENSITIVE_HEADERS}
+
+class CacheEntry():
+    def __init__(self, path, record):
+        self.path = path
+        self.record = record
+
+    def is_fresh(self, ttl):
+        return time.time() - self.record['stored_at'] < ttl
+
+    def validators(self):
+        '''Conditional request headers for revalidating this entry
+        '''
+        headers = {}
+        if 'ETag' in self.record['headers']:
+            headers['If-None-Match'] = self.record['headers']['ETag']
+        if 'Last-Modified' in self.record['headers']:
+            headers['If-Modified-Since'] = self.record['headers']['Last-Modified']
+
+        return headers
+
+    def to_response(self):
+        record = self.record
+        res = requests.Response()
+        res.status_code = record['status_code']
+        res.headers = CaseInsensitiveDict(record['headers'])
+        res._content = record['content']
+        res.encoding = record['encoding']
+        res.url = record['url']
+        res.reason = 'OK'
+        res.request = requests.Request(record['method'], record['request_url'], headers=record['request_headers']).prepare()
+        res.from_cache = True
+
+        return res
+
+class ResponseCache():
+    def __init__(self, cache_dir, ttl, max_bytes):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stores = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # bytes on disk, shared by the processes this cache is handed to
+        self.size = multiprocessing.Value('q', self._walk()[1])
+
+    def _path(self, method, url, headers, data):
+        h = hashlib.sha256()
+        h.update(f'{method} {url}\n'.encode())
+        for name in VARY_HEADERS:
+            for key, value in (headers or {}).items():
+                if key.lower() == name:
+                    h.update(f'{name}: {value}\n'.encode())
+        if data is not None:
+            h.update(data if isinstance(data, bytes) else str(data).encode())
+
+        key = h.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, method, url, headers=None, data=None):
+        '''Returns the `CacheEntry` for this request, or None
+        '''
+        path = self._path(method, url, headers, data)
+        try:
+            with open(path, 'rb') as f:
+                record = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # touch for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return CacheEntry(path, record)
+
+    def fresh_response(self, entry):
+        self.hits += 1
+        return entry.to_response()
+
+    def revalidated_response(self, entry, res):
+        '''The cached response for a 304 answer to a conditional request; the entry is fresh again.
+        '''
+        self.revalidations += 1
+        record = entry.record
+        record['stored_at'] = time.time()
+        for name in ('ETag', 'Last-Modified', 'Cache-Control', 'Expires'):
+            if name in res.headers:
+                record['headers'][name] = res.headers[name]
+        self._write(entry.path, record)
+
+        return entry.to_response()
+
+    def store(self, method, url, headers, data, res, complete=True):
+        '''Store a response fetched from the network (counted as a cache miss).
+        Responses whose body was not read to the end (`complete=False`) are only counted.
+        '''
+        self.misses += 1
+        if res.status_code != 200 or not complete:
+            return
+
+        path = self._path(method, url, headers, data)
+        record = {
+            'method': method,
+            'request_url': url,
+            'request_headers': public_headers(headers),
+            'url': res.url,
+            'status_code': res.status_code,
+            'headers': dict(res.headers),
+            'content': res.content,
+            'encoding': res.encoding,
+            'stored_at': time.time(),
+        }
+        self._write(path, record)
+        self.stores += 1
+
+    def _write(self, path, record):
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        files.write_atomic(path, data)
+        written = len(data)
+
+        with self.size.get_lock():
+            self.size.value += written - replaced
+            if self.size.value > self.max_bytes:
+                self.evict()
+
+    def _walk(self):
+        '''(mtime, size, path) of every entry, and their total size
+        '''
+        entries = []
+        total = 0
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        return entries, total
+
+    def evict(self):
+        '''Delete least recently used entries until the cache is back under 90% of `max_bytes`. The walk also corrects
+        the tracked size (e.g. for entries another run stored in the same `cache_dir`).
+        Called with the size's lock held, so only one process evicts at a time.
+        '''
+        entries, total = self._walk()
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes * 0.9:
+                    break
+
+        self.size.value = total
+
+    def report(self):
+        looked_up = self.hits + self.revalidations + self.misses
+        if looked_up:
+            print(f'cache: {self.hits} fresh hits, {self.revalidations} revalidated (304), {self.misses} misses '
+                  f'({(self.hits + self.revalidations) / looked_up:.0%} hit ratio)')
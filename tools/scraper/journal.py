@@ -0,0 +1,80 @@
+'''Journal of completed scrapes, so an interrupted command can resume where it stopped.
+
+A journal is a directory next to the command's `out_file` (`<out_file>.journal`). Every process
+appends one line per scraped URL to its own file, flushed as soon as the URL is done:
+
+    <key>\t<json result>
+
+Keys identify the scraper stage and URL (see `Journal.key`). On startup only the keys and their
+file offsets are indexed; results are read back lazily, so resuming a long run stays cheap in memory.
+The journal is removed once the command has written its `out_file`.
+'''
+
+import files
+import json
+import os
+import shutil
+import threading
+
+class Journal():
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        self.index = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_pid = None
+
+        os.makedirs(journal_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        for name in sorted(os.listdir(self.journal_dir)):
+            path = os.path.join(self.journal_dir, name)
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in files.complete_lines(f):
+                    tab = line.find(b'\t')
+                    if tab > -1:
+                        self.index[line[:tab].decode()] = (path, offset + tab + 1)
+                    offset += len(line)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @staticmethod
+    def key(scraper, url, args=()):
+        '''A scraper stage (class and extra args, e.g. selectors) plus the URL scraped
+        '''
+        return f'{type(scraper).__name__}{json.dumps(args, default=str)} {url}'
+
+    def get(self, key):
+        path, offset = self.index[key]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def record(self, key, result):
+        '''Append a completed result. Empty results (failed or abandoned scrapes) are not recorded,
+        so they are retried on resume.
+        '''
+        if not result or (isinstance(result, list) and all(r == [] for r in result)):
+            return
+
+        line = f'{key}\t{json.dumps(result)}\n'.encode()
+        with self.lock:
+            if self.file is None or self.file_pid != os.getpid():
+                self.file_pid = os.getpid()
+                self.file = open(files.process_path(self.journal_dir), 'ab')
+
+            files.append(self.file, line)
+
+    def remove(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
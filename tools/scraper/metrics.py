@@ -0,0 +1,303 @@
+'''Runtime metrics of a run, aggregated across processes, with a single progress view.
+
+A single `Metrics` is created once per run (see `utils.metrics`) and handed to every pool worker. Like
+the rate limiter, it lives in shared memory: counters from all workers add up in one place, per host:
+    - requests, by response status (no response: `errors`), and their latency histogram
+    - bytes received
+    - time spent waiting on the rate limiter
+    - response cache hits, revalidations and misses
+    - processing (parse) time per record: the time a scrape takes besides fetching
+plus run-wide progress (urls submitted and scraped) and post-processing time per record.
+
+While a command runs, a `Reporter` thread in the main process redraws one aggregated progress line
+and, every `metrics_interval` seconds, writes a JSON snapshot (`metrics_file` option) and a
+Prometheus text file (`prometheus_file` option, e.g. for node_exporter's textfile collector).
+'''
+
+import files
+import host_table
+import json
+import multiprocessing
+import threading
+import time
+
+# response statuses counted on their own; any other status is counted by class (2xx, 3xx, ...)
+STATUS_CODES = (200, 204, 301, 302, 304, 400, 401, 403, 404, 429, 500, 502, 503, 504)
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+# upper bounds (seconds) of the request latency histogram buckets, as in Prometheus' defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# fields stored per host in the shared table
+(_REQUESTS, _ERRORS, _BYTES, _WAITED, _CACHE_HITS, _CACHE_REVALIDATED, _CACHE_MISSES,
+ _PARSE_SECONDS, _PARSED, _LATENCY_SUM) = range(10)
+_STATUSES = 10
+_LATENCIES = _STATUSES + len(STATUS_CODES) + len(STATUS_CLASSES)
+_NUM_FIELDS = _LATENCIES + len(LATENCY_BUCKETS) + 1
+
+# run-wide fields
+_SUBMITTED, _DONE, _POSTPROCESS_SECONDS, _POSTPROCESSED, _STARTED = range(5)
+_NUM_TOTALS = 5
+
+# seconds between redraws of the progress line
+PROGRESS_INTERVAL = 1
+
+def _status_field(status):
+    if status in STATUS_CODES:
+        return _STATUSES + STATUS_CODES.index(status)
+
+    return _STATUSES + len(STATUS_CODES) + min(max(status // 100, 1), 5) - 1
+
+def _latency_field(latency):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return _LATENCIES + i
+
+    return _LATENCIES + len(LATENCY_BUCKETS)
+
+class Metrics():
+    '''Counters, one set per host (in a `host_table.HostTable`: past `max_hosts` hosts, the rest are counted together as
+    `host_table.OTHER`) plus run-wide ones, in shared memory.
+
+        >>> m = Metrics()
+        >>> m.request('example.com', 200, 0.03, 512); m.request('example.com', 429, 0.2, 0); m.request('example.com', None, 5.0, 0)
+        >>> host = m.snapshot()['hosts']['example.com']
+        >>> host['requests'], host['errors'], host['statuses'], host['bytes']
+        (3, 1, {'200': 1, '429': 1}, 512)
+        >>> host['latency']['buckets']['0.05'], host['latency']['buckets']['+Inf']
+        (1, 3)
+        >>> m = Metrics(max_hosts=1); m.request('a.example.com', 200, 0.03, 512); m.request('b.example.com', 200, 0.03, 512)
+        >>> sorted(m.snapshot()['hosts'])
+        ['(other hosts)', 'a.example.com']
+    '''
+    def __init__(self, max_hosts=host_table.MAX_HOSTS):
+        self.table = host_table.HostTable(_NUM_FIELDS, max_hosts)
+        self.lock = self.table.lock
+        self.slots = self.table.slots
+        self.totals = multiprocessing.Array('d', _NUM_TOTALS, lock=False)
+        self.totals[_STARTED] = time.time()
+
+    def _offset(self, host):
+        '''Offset of `host`'s counters; call with the lock held
+        '''
+        return self.table.offset(host)
+
+    def request(self, host, status, latency, num_bytes):
+        '''A request sent to `host`: its response `status` (None when there was no response), latency in seconds and bytes received
+        '''
+        with self.lock:
+            o = self._offset(host)
+            s = self.slots
+            s[o + _REQUESTS] += 1
+            if status is None:
+                s[o + _ERRORS] += 1
+            else:
+                s[o + _status_field(status)] += 1
+            s[o + _BYTES] += num_bytes
+            s[o + _LATENCY_SUM] += latency
+            s[o + _latency_field(latency)] += 1
+
+    def waited(self, host, seconds):
+        if seconds > 0:
+            with self.lock:
+                self.slots[self._offset(host) + _WAITED] += seconds
+
+    def cache(self, host, outcome):
+        '''A response cache lookup for `host`: 'hit' (fresh), 'revalidated' (304) or 'miss'
+        '''
+        field = {'hit': _CACHE_HITS, 'revalidated': _CACHE_REVALIDATED, 'miss': _CACHE_MISSES}[outcome]
+        with self.lock:
+            self.slots[self._offset(host) + field] += 1
+
+    def submitted(self, count=1):
+        '''Urls handed to a scraper, for the progress view
+        '''
+        with self.lock:
+            self.totals[_SUBMITTED] += count
+
+    def scraped(self, host, parse_seconds=None):
+        '''A url scraped; `parse_seconds`: the time its scrape took besides fetching (None: nothing was parsed, e.g. journaled results)
+        '''
+        with self.lock:
+            self.totals[_DONE] += 1
+            if parse_seconds is not None:
+                o = self._offset(host)
+                self.slots[o + _PARSE_SECONDS] += parse_seconds
+                self.slots[o + _PARSED] += 1
+
+    def postprocessed(self, count, seconds):
+        with self.lock:
+            self.totals[_POSTPROCESSED] += count
+            self.totals[_POSTPROCESS_SECONDS] += seconds
+
+    def snapshot(self):
+        '''All metrics as a JSON-serializable dict
+        '''
+        with self.lock:
+            slots = self.slots[:]
+            hosts = self.table.hosts()
+            totals = self.totals[:]
+
+        now = time.time()
+        elapsed = now - totals[_STARTED]
+        snapshot = {
+            'time': now,
+            'elapsed': elapsed,
+            'progress': {'submitted': int(totals[_SUBMITTED]), 'done': int(totals[_DONE]),
+                         'rate': totals[_DONE] / elapsed if elapsed > 0 else None},
+            'postprocess': {'records': int(totals[_POSTPROCESSED]), 'seconds': totals[_POSTPROCESS_SECONDS]},
+            'hosts': {},
+        }
+
+        for name, o in hosts:
+            statuses = {str(code): int(slots[o + _STATUSES + i]) for i, code in enumerate(STATUS_CODES + STATUS_CLASSES)
+                        if slots[o + _STATUSES + i]}
+            cumulative = 0
+            buckets = {}
+            for i, bound in enumerate(LATENCY_BUCKETS + ('+Inf',)):
+                cumulative += int(slots[o + _LATENCIES + i])
+                buckets[str(bound)] = cumulative
+            looked_up = slots[o + _CACHE_HITS] + slots[o + _CACHE_REVALIDATED] + slots[o + _CACHE_MISSES]
+
+            snapshot['hosts'][name] = {
+                'requests': int(slots[o + _REQUESTS]),
+                'errors': int(slots[o + _ERRORS]),
+                'statuses': statuses,
+                'latency': {'buckets': buckets, 'sum': slots[o + _LATENCY_SUM], 'count': cumulative},
+                'bytes': int(slots[o + _BYTES]),
+                'wait_seconds': slots[o + _WAITED],
+                'cache': {'hits': int(slots[o + _CACHE_HITS]), 'revalidated': int(slots[o + _CACHE_REVALIDATED]),
+                          'misses': int(slots[o + _CACHE_MISSES]),
+                          'hit_ratio': (slots[o + _CACHE_HITS] + slots[o + _CACHE_REVALIDATED]) / looked_up if looked_up else None},
+                'parse': {'records': int(slots[o + _PARSED]), 'seconds': slots[o + _PARSE_SECONDS]},
+            }
+
+        return snapshot
+
+def prometheus(snapshot):
+    '''A `Metrics.snapshot` in the Prometheus text exposition format
+
+        >>> m = Metrics(); m.request('example.com', 200, 0.03, 512)
+        >>> print('\\n'.join(line for line in prometheus(m.snapshot()).splitlines() if 'example.com' in line and 'bucket' not in line))
+        scraper_requests_total{host="example.com",code="200"} 1
+        scraper_request_duration_seconds_sum{host="example.com"} 0.03
+        scraper_request_duration_seconds_count{host="example.com"} 1
+        scraper_response_bytes_total{host="example.com"} 512
+        scraper_rate_limit_wait_seconds_total{host="example.com"} 0
+        scraper_parse_seconds_total{host="example.com"} 0
+        scraper_parsed_records_total{host="example.com"} 0
+    '''
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_str}}} {value:g}' if label_str else f'{name} {value:g}')
+
+    hosts = snapshot['hosts']
+    metric('scraper_urls_submitted_total', 'counter', 'Urls handed to scrapers.', [({}, snapshot['progress']['submitted'])])
+    metric('scraper_urls_scraped_total', 'counter', 'Urls scraped.', [({}, snapshot['progress']['done'])])
+    metric('scraper_requests_total', 'counter', 'Responses received, by host and status.',
+           [({'host': host, 'code': code}, count) for host, h in hosts.items() for code, count in h['statuses'].items()])
+    metric('scraper_request_errors_total', 'counter', 'Requests that got no response (connection error, timeout).',
+           [({'host': host}, h['errors']) for host, h in hosts.items() if h['errors']])
+    metric('scraper_request_duration_seconds', 'histogram', 'Request latency.', [])
+    for host, h in hosts.items():
+        for le, count in h['latency']['buckets'].items():
+            lines.append(f'scraper_request_duration_seconds_bucket{{host="{host}",le="{le}"}} {count}')
+        lines.append(f'scraper_request_duration_seconds_sum{{host="{host}"}} {h["latency"]["sum"]:g}')
+        lines.append(f'scraper_request_duration_seconds_count{{host="{host}"}} {h["latency"]["count"]:g}')
+    metric('scraper_response_bytes_total', 'counter', 'Response bytes received.', [({'host': host}, h['bytes']) for host, h in hosts.items()])
+    metric('scraper_rate_limit_wait_seconds_total', 'counter', 'Time spent waiting on the rate limiter.',
+           [({'host': host}, h['wait_seconds']) for host, h in hosts.items()])
+    metric('scraper_cache_lookups_total', 'counter', 'Response cache lookups, by result.',
+           [({'host': host, 'result': result}, h['cache'][key]) for host, h in hosts.items()
+            for result, key in (('hit', 'hits'), ('revalidated', 'revalidated'), ('miss', 'misses')) if h['cache'][key]])
+    metric('scraper_parse_seconds_total', 'counter', 'Time spent on scrapes besides fetching.',
+           [({'host': host}, h['parse']['seconds']) for host, h in hosts.items()])
+    metric('scraper_parsed_records_total', 'counter', 'Records parsed.', [({'host': host}, h['parse']['records']) for host, h in hosts.items()])
+    metric('scraper_postprocess_seconds_total', 'counter', 'Time spent post-processing records.', [({}, snapshot['postprocess']['seconds'])])
+    metric('scraper_postprocessed_records_total', 'counter', 'Records post-processed.', [({}, snapshot['postprocess']['records'])])
+
+    return '\n'.join(lines) + '\n'
+
+def progress_line(snapshot, bar_len=30):
+    '''One line summing up a run's progress
+
+        >>> m = Metrics(); m.submitted(4); m.scraped('example.com', 0.01); m.request('example.com', 200, 0.03, 512)
+        >>> progress_line(m.snapshot()).split(' | ')[0]
+        '[========----------------------]  25.0% 1/4 urls'
+    '''
+    progress = snapshot['progress']
+    done, total = progress['done'], max(progress['submitted'], progress['done'])
+    filled = int(round(bar_len * done / total)) if total else 0
+    percent = 100.0 * done / total if total else 0.0
+
+    hosts = snapshot['hosts'].values()
+    classes = {}
+    for h in hosts:
+        for code, count in h['statuses'].items():
+            cls = code if code.endswith('xx') else f'{code[0]}xx'
+            classes[cls] = classes.get(cls, 0) + count
+    errors = sum(h['errors'] for h in hosts)
+    waited = sum(h['wait_seconds'] for h in hosts)
+    statuses = ' '.join(f'{cls} {count}' for cls, count in sorted(classes.items()))
+
+    line = f'[{"=" * filled}{"-" * (bar_len - filled)}] {percent:5.1f}% {done}/{total} urls'
+    if progress['rate'] is not None:
+        line += f' | {progress["rate"]:.1f} urls/s'
+    if statuses or errors:
+        line += f' | {statuses}' + (f' errors {errors}' if errors else '')
+    if waited:
+        line += f' | {waited:.1f}s rate-limited'
+
+    return line
+
+class Reporter():
+    '''Redraws the progress line every `PROGRESS_INTERVAL` seconds and writes the metrics files every `interval`
+    seconds, from a thread of the main process, until `stop`.
+    '''
+    def __init__(self, metrics, interval, json_file=None, prometheus_file=None, out=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.out = out
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.last_written = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(PROGRESS_INTERVAL):
+            self.report(final=False)
+
+    def report(self, final):
+        snapshot = self.metrics.snapshot()
+        if self.out is not None:
+            self.out.write(f'\r{progress_line(snapshot)}' + ('\n' if final else ''))
+            self.out.flush()
+
+        if final or snapshot['time'] - self.last_written >= self.interval:
+            self.last_written = snapshot['time']
+            self.write(snapshot)
+
+    def write(self, snapshot):
+        if self.json_file is not None:
+            files.write_atomic(self.json_file, json.dumps(snapshot, indent=2).encode())
+        if self.prometheus_file is not None:
+            files.write_atomic(self.prometheus_file, prometheus(snapshot).encode())
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report(final=True)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,194 @@
+'''Micro-benchmarks of the CPU hot paths: HTML parsing and selection, html2text, song query normalization, language detection.
+
+Cases run over the bundled corpora in `datasets/` (`blog_content_en_sample.json`, `song_titles_5yrs.json`,
+`bloglist_sample.json`) and the saved pages in `fixtures/`. For each case the report gives:
+    - ops/sec: items (pages, titles, articles...) processed per second, best of `repeat` rounds of at least `min_time` seconds
+    - peak allocation per op: the most memory allocated at once while processing one item (tracemalloc), averaged over a sample
+and compares them with the stored baseline (`microbench_baseline.json`), flagging changes beyond `tolerance`.
+
+    python -u microbench.py run
+    python -u microbench.py run --cases='["parse_html", "get_song_queries"]' --min_time=2
+    python -u microbench.py run --save_baseline # after a change is merged: the new numbers become the baseline
+
+Baselines are machine-specific: compare runs made on the same machine.
+'''
+
+import articles
+import gc
+import json
+from langdetect import detect, DetectorFactory
+import os
+import pandas as pd
+import parsers
+import platform
+import sys
+import time
+import tracemalloc
+import postprocess
+import reviews
+import scraper
+import utils
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATASETS_DIR = os.path.join(HERE, '..', '..', 'datasets')
+FIXTURES_DIR = os.path.join(HERE, 'fixtures')
+BASELINE_FILE = os.path.join(HERE, 'microbench_baseline.json')
+
+# items per case (the corpora are larger than a benchmark round needs)
+ARTICLES = 200
+ALLOC_SAMPLE = 50
+
+def _dataset(name):
+    with open(os.path.join(DATASETS_DIR, name), encoding='utf-8') as f:
+        return json.load(f)
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+def _articles():
+    '''Article html as Mercury returns it, rebuilt from the (text) content of the blog content sample
+    '''
+    contents = [article['content'] for article in _dataset('blog_content_en_sample.json') if article.get('content')]
+    return [''.join(f'<p>{" ".join(block.split())}</p>' for block in content.split('\n\n') if block.strip())
+            for content in contents[:ARTICLES]]
+
+def _pages():
+    return [_fixture(name) for name in sorted(os.listdir(FIXTURES_DIR)) if name.endswith('.html')]
+
+def _parse(page):
+    # as `utils.Soup.url_to_soup` does, with the `parser` option's backend
+    return parsers.get(utils.get_option('parser')).parse(page)
+
+# name: (setup returning the items to process, function processing one item, ops in an item or None for 1)
+CASES = {
+    'parse_html': (_pages, _parse, None),
+    # the BeautifulSoup backend, for comparison
+    'parse_html_bs4': (_pages, parsers.get('bs4').parse, None),
+    'soup_to_index': (lambda: [_parse(_fixture('recipe_index.html'))],
+                      lambda soup: utils.Soup.soup_to_index('https://www.example.com/search', soup, '.recipe-content-card a[itemprop="url"]'), None),
+    'soup_to_content': (lambda: [_parse(_fixture('genius_song.html'))],
+                        lambda soup: utils.Soup.soup_to_content('https://genius.com/song', soup, ['meta[itemprop="page_data"]'], 'content'), None),
+    # what `features.genius` does instead: find the tag in the raw page (`TagScraper`), no DOM
+    'find_tag': (lambda: [_fixture('genius_song.html').encode('utf-8')],
+                 lambda page: scraper._find_tag(page, 'meta', {'itemprop': 'page_data'}), None),
+    'strip_api_metadata': (lambda: [_fixture('augmentation_recipe.html')],
+                           lambda html: scraper.Pipeline._strip_api_metadata(None, html), None),
+    'extract_article': (lambda: [_fixture('blog_post.html')], lambda page: articles.extract(page, 'https://blog.example.com/2017/11/post'), None),
+    'html2text': (_articles, postprocess.html_to_text, None),
+    'get_song_query': (lambda: _dataset('song_titles_5yrs.json'), lambda title: reviews._get_song_query(title, ''), None),
+    'get_song_queries': (lambda: [pd.Series(_dataset('song_titles_5yrs.json'))],
+                         lambda titles: reviews._get_song_queries(titles, pd.Series([''] * len(titles))), len),
+    'langdetect': (lambda: [article['content'] for article in _dataset('blog_content_en_sample.json') if article.get('content')][:ARTICLES],
+                   detect, None),
+    # per-url work of `review` besides the request: its Mercury url and circuit breaker key
+    'mercury_request_urls': (lambda: _dataset('bloglist_sample.json'),
+                             lambda url: reviews.MERCURY_POLICY.breaker_key(reviews._construct_mercury_parser_url(url)), None),
+}
+
+def run(cases=None, min_time=1.0, repeat=3, tolerance=0.15, baseline_file=BASELINE_FILE, save_baseline=False, out_file=None):
+    '''Run the micro-benchmark `cases` (default: all of `CASES`) and compare them with `baseline_file`.
+    '''
+    cases = cases or list(CASES)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        print(f'[ERROR] Unknown cases: {", ".join(unknown)}. Choose from: {", ".join(CASES)}')
+        sys.exit()
+
+    DetectorFactory.seed = 0
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    print(f'{"case":<20} {"ops/sec":>12} {"baseline":>12} {"change":>8} {"KB/op":>10} {"baseline":>10} {"change":>8}')
+    for name in cases:
+        setup, func, ops = CASES[name]
+        items = setup()
+        ops = ops or (lambda item: 1)
+        results[name] = {'ops_per_sec': _ops_per_sec(func, items, ops, min_time, repeat),
+                         'peak_alloc_kb': _peak_alloc_kb(func, items, ops)}
+
+        line, regressed = _compare(name, results[name], baseline.get(name), tolerance)
+        print(line)
+        if regressed:
+            regressions.append(name)
+
+    if regressions:
+        print(f'[WARNING] {len(regressions)} case(s) slower or allocating more than the baseline (tolerance {tolerance:.0%}): {", ".join(regressions)}')
+
+    report = {'machine': {'platform': platform.platform(), 'python': platform.python_version()}, 'results': results}
+    if save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump({**report, 'results': {**baseline, **results}}, f, indent=2)
+        print(f'Baseline saved to {baseline_file}')
+    if out_file is not None:
+        with open(out_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Micro-benchmark results saved to {out_file}')
+
+def _ops_per_sec(func, items, ops, min_time, repeat):
+    '''Best throughput of `repeat` rounds, each going over `items` as many times as it takes to fill `min_time`.
+    Like `timeit`, rounds run with garbage collection off, after one warm-up pass.
+    '''
+    ops_per_pass = sum(ops(item) for item in items)
+    for item in items:
+        func(item)
+
+    best = 0
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            done = 0
+            start = time.perf_counter()
+            while True:
+                for item in items:
+                    func(item)
+                done += ops_per_pass
+                elapsed = time.perf_counter() - start
+                if elapsed >= min_time:
+                    break
+            best = max(best, done / elapsed)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return best
+
+def _peak_alloc_kb(func, items, ops):
+    '''Mean peak of memory allocated while processing one item, per op, over a sample of `items`
+    '''
+    sample = items[:ALLOC_SAMPLE]
+    peaks = []
+    tracemalloc.start()
+    try:
+        for item in sample:
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            func(item)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append((peak - start) / ops(item))
+    finally:
+        tracemalloc.stop()
+
+    return sum(peaks) / len(peaks) / 1024
+
+def _compare(name, result, baseline, tolerance):
+    '''A report line for a case, and whether it regressed against `baseline`
+    '''
+    ops, alloc = result['ops_per_sec'], result['peak_alloc_kb']
+    if baseline is None:
+        return f'{name:<20} {ops:>12.1f} {"n/a":>12} {"":>8} {alloc:>10.1f} {"n/a":>10} {"":>8}', False
+
+    ops_change = ops / baseline['ops_per_sec'] - 1
+    alloc_change = alloc / baseline['peak_alloc_kb'] - 1 if baseline['peak_alloc_kb'] else 0.0
+    regressed = ops_change < -tolerance or alloc_change > tolerance
+
+    return (f'{name:<20} {ops:>12.1f} {baseline["ops_per_sec"]:>12.1f} {ops_change:>+8.1%} '
+            f'{alloc:>10.1f} {baseline["peak_alloc_kb"]:>10.1f} {alloc_change:>+8.1%}{"  <- regression" if regressed else ""}'), regressed
+
+if __name__ == '__main__':
+    import fire; fire.Fire()
@@ -0,0 +1,359 @@
+'''Local stand-ins for the providers the scrapers talk to, for benchmarks (see `benchmark.py`).
+
+Each provider - HypeM, Spotify, Genius (API and song pages), Mercury, OneNote's augmentation API and a
+generic HTML blog - is served by its own threaded HTTP server on its own loopback address (127.0.0.2,
+127.0.0.3, ...), so the run's per-host rate limits and circuit breakers apply to each one separately,
+as they would to the real hosts. The servers run in a process of their own and answer with deterministic
+content derived from the requested ids, after a configurable latency and with configurable injected
+failures (429 with `Retry-After`, 503, 502) and payload sizes.
+
+Every setting is either one value for all providers or a dict of per-provider values, e.g.
+`latency={'mercury': 0.5, 'spotify': 0.05}` (providers left out get the default).
+
+    providers = MockProviders(latency=0.02, throttle_rate=0.01)
+    urls = providers.start()
+    install(urls) # point reviews.py, features.py and scraper.py at the stand-ins
+    ...
+    providers.stats() # per provider: requests received, their arrival times and response statuses
+    providers.stop()
+'''
+
+from collections import Counter
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+import urllib.request
+import zlib
+
+PROVIDERS = ['hypem', 'spotify', 'genius', 'genius_web', 'mercury', 'onenote', 'blog']
+
+# defaults of the per-provider settings
+DEFAULTS = {
+    'latency': 0.02, # mean seconds before a response (actual latencies are spread over 0.5x to 1.5x this)
+    'throttle_rate': 0.0, # share of requests answered 429 with `Retry-After: retry_after`
+    'retry_after': 1, # seconds
+    'error_rate': 0.0, # share of requests answered 503
+    'bad_gateway_rate': 0.0, # share of requests answered 502 (for Mercury: "could not fetch the page")
+    'payload_kb': 2, # approximate size of each page, article or API object, in kilobytes
+}
+
+WORDS = ('the song with a beat and this track is about love summer night music album artist sound '
+         'guitar voice new record from band first single video remix tour lyrics').split()
+
+def _crc(*parts):
+    return zlib.crc32('/'.join(str(p) for p in parts).encode())
+
+def _filler(size, seed):
+    '''About `size` bytes of words, the same for the same seed
+    '''
+    rng = random.Random(_crc(seed))
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    return ' '.join(words)
+
+def _setting(settings, name, provider):
+    value = settings.get(name, DEFAULTS[name])
+    if isinstance(value, dict):
+        return value.get(provider, DEFAULTS[name])
+
+    return value
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as with the real providers
+
+    # set per server by `_serve`
+    provider = None
+    urls = None
+    settings = None
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self._handle()
+
+    def _handle(self):
+        url = urlparse(self.path)
+        if url.path == '/__stats':
+            return self._send(200, json.dumps(self.state.snapshot()))
+        if url.path == '/__reset':
+            self.state.reset()
+            return self._send(200, '{}')
+
+        setting = lambda name: _setting(self.settings, name, self.provider)
+        arrival = time.time()
+        roll = self.state.roll()
+        time.sleep(setting('latency') * (0.5 + self.state.roll()))
+
+        if roll < setting('throttle_rate'):
+            status, body, headers = 429, '', {'Retry-After': str(setting('retry_after'))}
+        elif roll < setting('throttle_rate') + setting('error_rate'):
+            status, body, headers = 503, '', {}
+        elif roll < setting('throttle_rate') + setting('error_rate') + setting('bad_gateway_rate'):
+            status, body, headers = 502, '', {}
+        else:
+            status, body = getattr(self, f'_{self.provider}')(url.path, parse_qs(url.query), int(setting('payload_kb') * 1024))
+            headers = {}
+
+        self.state.record(arrival, status)
+        self._send(status, body, headers)
+
+    def _send(self, status, body, headers={}):
+        body = body.encode()
+        self.send_response(status)
+        content_type = 'text/html' if body.startswith(b'<') else 'application/json'
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _hypem(self, path, query, size):
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['v2', 'set'] and parts[2].startswith('popularweek_'):
+            week = parts[2][len('popularweek_'):]
+            # weeks share songs, like the real charts
+            tracks = []
+            for i in range(50):
+                item = _crc(week, i) % 500
+                tracks.append({'itemid': f'i{item}', 'artist': f'Artist {item % 97}', 'title': f'Song {item} (feat. Someone)',
+                               'loved_count': item * 3, 'posted_count': item % 11, 'time': 180 + item % 120,
+                               'description': _filler(size // 50, item)})
+            return 200, json.dumps(tracks)
+        if parts[:2] == ['v2', 'tracks'] and parts[-1] == 'blogs':
+            item = parts[2]
+            blogs = [{'siteid': _crc(item, i) % 1000, 'sitename': f'blog {_crc(item, i) % 1000}',
+                      'url': f'{self.urls["blog"]}/posts/{item}-{i}', 'description': _filler(size // 4, _crc(item, i))}
+                     for i in range(1 + _crc(item) % 4)]
+            return 200, json.dumps(blogs)
+
+        return 404, '{}'
+
+    def _spotify(self, path, query, size):
+        kind = path.strip('/').split('/')[1]
+        if kind == 'search':
+            q = ' '.join(query['q'][0].lower().split())
+            # one search in ten finds nothing
+            items = [{'id': f's{_crc(q)}', 'name': q, 'description': _filler(size, _crc(q))}] if _crc(q) % 10 else []
+            return 200, json.dumps({'tracks': {'items': items}})
+
+        ids = query['ids'][0].split(',') if 'ids' in query else []
+        if kind == 'tracks':
+            objs = [{'id': id, 'name': f'track {id}', 'artists': [{'id': f'a{_crc(id) % 200}'}], 'description': _filler(size, id)}
+                    for id in ids]
+        elif kind == 'artists':
+            objs = [{'id': id, 'genres': [f'genre {_crc(id, i) % 40}' for i in range(_crc(id) % 4)], 'description': _filler(size, id)}
+                    for id in ids]
+        elif kind == 'audio-features':
+            objs = [{'id': id, 'danceability': _crc(id) % 1000 / 1000, 'energy': _crc(id, 'energy') % 1000 / 1000,
+                     'tempo': 60 + _crc(id) % 120} for id in ids]
+        else:
+            return 404, '{}'
+
+        return 200, json.dumps({kind.replace('-', '_'): objs})
+
+    def _genius(self, path, query, size):
+        parts = path.strip('/').split('/')
+        if parts[0] == 'search':
+            q = ' '.join(query['q'][0].lower().split())
+            hits = [{'result': {'id': _crc(q) % 1000000, 'full_title': q}}] if _crc(q, 'genius') % 10 else []
+            return 200, json.dumps({'response': {'hits': hits}})
+        if parts[0] == 'songs':
+            id = parts[1]
+            song = {'id': int(id), 'url': f'{self.urls["genius_web"]}/songs/{id}', 'description': {'plain': _filler(size, id)}}
+            return 200, json.dumps({'response': {'song': song}})
+
+        return 404, '{}'
+
+    def _genius_web(self, path, query, size):
+        id = path.strip('/').split('/')[-1]
+        tags = ','.join(f'tag:genre {_crc(id, i) % 40}' for i in range(1 + _crc(id) % 3))
+        page_data = {'chartbeat': {'sections': f'{tags},other'},
+                     'song': {'description': {'html': f'<p>{_filler(size // 4, id)}</p>'}}}
+        return 200, (f'<html><head><meta itemprop="page_data" content="{html.escape(json.dumps(page_data))}"></head>'
+                     f'<body><div class="lyrics">{_filler(size, id)}</div></body></html>')
+
+    def _mercury(self, path, query, size):
+        url = query['url'][0]
+        paragraphs = ''.join(f'<p>{_filler(512, (url, i))} <a href="{url}">link</a></p>' for i in range(max(1, size // 512)))
+        article = {'title': f'Review {_crc(url)}', 'author': 'Blogger', 'date_published': None, 'dek': None,
+                   'lead_image_url': None, 'content': f'<div>{paragraphs}</div>', 'next_page_url': None, 'url': url,
+                   'domain': urlparse(url).hostname, 'excerpt': _filler(100, url), 'word_count': size // 6,
+                   'direction': 'ltr', 'total_pages': 1, 'rendered_pages': 1}
+        return 200, json.dumps(article)
+
+    def _onenote(self, path, query, size):
+        url = unquote(query['url'][0])
+        html_content = (f'<div class="Metadata">{url}</div><img class="Thumbnail" src="x.png">'
+                        f'<div class="IngredientsContainer"><h2>Ingredients</h2><ul><li>{_filler(size // 4, url)}</li></ul></div>'
+                        f'<div class="InstructionsContainer"><h2>Instructions</h2><p>{_filler(size // 2, (url, 1))}</p></div>')
+        return 200, json.dumps([{'ContentModel': 4, 'ContentInHtml': html_content}])
+
+    def _blog(self, path, query, size):
+        parts = path.strip('/').split('/')
+        if parts[0] == 'index':
+            page = query.get('page', ['0'])[0]
+            links = ''.join(f'<li><a class="post" href="/posts/{page}-{i}">post {i}</a></li>' for i in range(10))
+            return 200, f'<html><body><ul>{links}</ul><p>{_filler(size // 4, page)}</p></body></html>'
+        if parts[0] == 'posts':
+            id = parts[1]
+            description = _filler(200, id)
+            instructions = _filler(size, (id, 1))
+            # three posts in four describe their recipe in JSON-LD, as recipe sites do for search engines
+            recipe = ''
+            if _crc(id) % 4:
+                steps = [{'@type': 'HowToStep', 'text': _filler(size // 4, (id, 'step', i))} for i in range(4)]
+                recipe = json.dumps({'@context': 'https://schema.org', '@type': 'Recipe', 'name': f'Post {id}', 'description': description,
+                                     'recipeIngredient': [_filler(24, (id, 'ingredient', i)) for i in range(8)], 'recipeInstructions': steps})
+                recipe = f'<script type="application/ld+json">{recipe}</script>'
+            return 200, (f'<html><head><title>Post {id}</title>{recipe}</head><body>'
+                         f'<div class="description" text="{description}">{description}</div>'
+                         f'<div class="instructions" text="{instructions}">{instructions}</div></body></html>')
+        if parts[0] == 'articles':
+            # a review as blogs publish them: the article among navigation, comments and a sidebar
+            id = parts[1]
+            paragraphs = ''.join(f'<p>{_filler(512, (id, i))}, {_filler(64, (id, i, 1))}.</p>' for i in range(max(1, size // 576)))
+            comments = ''.join(f'<div class="comment"><span class="author">user{i}</span><p>{_filler(160, (id, "c", i))}</p></div>' for i in range(5))
+            links = ''.join(f'<li><a href="/articles/{i}">{_filler(40, i)}</a></li>' for i in range(10))
+            return 200, (f'<html><head><title>Review {id} | Blog</title><meta name="author" content="Blogger"></head><body>'
+                         f'<header class="site-header"><nav><ul>{links}</ul></nav></header>'
+                         f'<article class="post"><h1 class="entry-title">Review {id}</h1>'
+                         f'<time class="published" datetime="2018-05-28T12:00:00Z">May 28, 2018</time>'
+                         f'<div class="entry-content">{paragraphs}</div><div class="share-buttons"><a href="#">Share</a></div></article>'
+                         f'<section id="comments">{comments}</section><aside class="sidebar"><ul>{links}</ul></aside>'
+                         f'<footer class="site-footer"><p>{_filler(100, "footer")}</p></footer></body></html>')
+
+        return 404, '{}'
+
+class _State():
+    '''Requests received by one server, and its random source for latencies and failures
+    '''
+    def __init__(self, seed):
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.reset()
+
+    def roll(self):
+        with self.lock:
+            return self.rng.random()
+
+    def record(self, arrival, status):
+        with self.lock:
+            self.arrivals.append(arrival)
+            self.statuses[status] += 1
+
+    def reset(self):
+        with self.lock:
+            self.arrivals = []
+            self.statuses = Counter()
+
+    def snapshot(self):
+        with self.lock:
+            return {'arrivals': sorted(self.arrivals), 'statuses': dict(self.statuses)}
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # clients may hang up mid-response (e.g. `TagScraper` once it has read the tag it wants)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def _serve(settings, seed, conn):
+    servers = {}
+    for i, provider in enumerate(PROVIDERS):
+        servers[provider] = _Server((f'127.0.0.{i + 2}', 0), _Handler)
+    urls = {provider: f'http://{server.server_address[0]}:{server.server_address[1]}' for provider, server in servers.items()}
+
+    for provider, server in servers.items():
+        server.daemon_threads = True
+        server.RequestHandlerClass = type(f'_{provider}_handler', (_Handler,), {
+            'provider': provider, 'urls': urls, 'settings': settings, 'state': _State(_crc(seed, provider))})
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    conn.send(urls)
+    conn.recv() # until `stop`
+
+class MockProviders():
+    '''The stand-in servers, run in a child process. Settings: see `DEFAULTS`.
+    '''
+    def __init__(self, seed=0, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f'unknown mock provider settings: {", ".join(sorted(unknown))}')
+
+        self.seed = seed
+        self.settings = settings
+        self.process = None
+        self.conn = None
+        self.urls = None
+
+    def start(self):
+        '''Start the servers; returns each provider's base url
+        '''
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(self.settings, self.seed, child_conn), daemon=True)
+        self.process.start()
+        self.urls = self.conn.recv()
+
+        return self.urls
+
+    def _get(self, provider, path):
+        with urllib.request.urlopen(f'{self.urls[provider]}{path}') as res:
+            return json.loads(res.read())
+
+    def stats(self):
+        '''{provider: {'arrivals': [request arrival times], 'statuses': {status: count}}}
+        '''
+        return {provider: self._get(provider, '/__stats') for provider in PROVIDERS}
+
+    def reset(self):
+        for provider in PROVIDERS:
+            self._get(provider, '/__reset')
+
+    def stop(self):
+        if self.process is not None:
+            self.conn.send(None)
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def install(urls):
+    '''Point the provider endpoints of reviews.py, features.py and scraper.py at the stand-ins at `urls`: those
+    modules keep their endpoints in module-level constants for this. Call before any pool workers are started (they
+    inherit the endpoints).
+    '''
+    import features
+    import reviews
+    import scraper
+
+    reviews.MERCURY_PARSER_URL = f'{urls["mercury"]}/parser'
+    reviews.HYPEM_API_URL = f'{urls["hypem"]}/v2'
+    reviews.SPOTIFY_API_URL = features.SPOTIFY_API_URL = f'{urls["spotify"]}/v1'
+    reviews.GENIUS_API_URL = features.GENIUS_API_URL = urls['genius']
+    scraper.AUGMENTATION_API_URL = f'{urls["onenote"]}/'
@@ -0,0 +1,148 @@
+'''HTML parsing backends behind `utils.Soup` and the Augmentation API response handling.
+
+DOM scrapes only ever run a handful of CSS selectors over each page, so building a full BeautifulSoup
+tree (and its Python objects for every node) is most of their CPU time. The `parser` option picks the backend:
+    - 'lxml' (default): lxml.html's C parser, with selectors compiled once by cssselect into XPath
+    - 'bs4': BeautifulSoup on top of lxml, selectors run by soupsieve - the original behavior
+
+Both give the same elements for the selectors the scrapers use (the tree is built by the same libxml2
+parser either way); they differ only where cssselect and soupsieve do, e.g. cssselect has no `:has()`.
+Attribute values come back as strings from both, except that bs4 returns multi-valued attributes
+(`class`, `rel`...) as lists.
+
+    >>> page = '<html><body><a class="post" href="/a">A</a><a class="post" href="/b">B</a><meta content="m"></body></html>'
+    >>> for name in PARSERS:
+    ...     parser = get(name)
+    ...     doc = parser.parse(page)
+    ...     print(name, [parser.attr(el, 'href') for el in parser.select(doc, 'a.post')], parser.attr(parser.select(doc, 'meta')[0], 'content'),
+    ...           parser.text(parser.select(doc, 'body')[0]))
+    lxml ['/a', '/b'] m AB
+    bs4 ['/a', '/b'] m AB
+'''
+
+from bs4 import BeautifulSoup
+from bs4.element import Tag
+import lxml.html
+import threading
+
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError: # cssselect is not installed
+    CSSSelector = None
+
+PARSERS = ('lxml', 'bs4')
+
+class LxmlParser():
+    '''lxml.html documents, selected with compiled cssselect expressions
+    '''
+    name = 'lxml'
+
+    def __init__(self):
+        # lxml parsers and compiled selectors are not to be shared between threads (the 'async' backend's):
+        # each thread keeps its own parser and css selector -> XPath cache, as the scrapers reuse a few selectors for every page
+        self._local = threading.local()
+
+    def _thread_state(self):
+        local = self._local
+        if not hasattr(local, 'parser'):
+            local.parser = lxml.html.HTMLParser(encoding='utf-8')
+            local.selectors = {}
+
+        return local
+
+    def parse(self, page):
+        if not page.strip():
+            # lxml refuses empty documents, where BeautifulSoup gives an empty tree
+            return lxml.html.Element('html')
+
+        # lxml refuses str input that declares its own encoding: hand it bytes in a known encoding
+        return lxml.html.document_fromstring(page.encode('utf-8'), parser=self._thread_state().parser)
+
+    def select(self, doc, selector):
+        selectors = self._thread_state().selectors
+        compiled = selectors.get(selector)
+        if compiled is None:
+            compiled = selectors[selector] = CSSSelector(selector)
+
+        return compiled(doc)
+
+    def attr(self, element, name):
+        return element.attrib[name]
+
+    def get(self, element, name, default=None):
+        return element.get(name, default)
+
+    def text(self, element):
+        return element.text_content()
+
+    def parent(self, element):
+        return element.getparent()
+
+    def parse_fragment(self, html):
+        return lxml.html.fragment_fromstring(html, create_parent='div', parser=self._thread_state().parser)
+
+    def remove(self, element):
+        # `drop_tree` keeps the text that follows the element, as BeautifulSoup's `decompose` does
+        element.drop_tree()
+
+    def fragment_to_html(self, fragment):
+        # without the <div> wrapper `parse_fragment` added
+        return lxml.html.tostring(fragment, encoding='unicode')[len('<div>'):-len('</div>')]
+
+class SoupParser():
+    '''BeautifulSoup trees (built with lxml), selected with soupsieve
+    '''
+    name = 'bs4'
+
+    def parse(self, page):
+        return BeautifulSoup(page, 'lxml')
+
+    def select(self, doc, selector):
+        return doc.select(selector)
+
+    def attr(self, element, name):
+        return element[name]
+
+    def get(self, element, name, default=None):
+        return element.get(name, default)
+
+    def text(self, element):
+        return element.get_text()
+
+    def parent(self, element):
+        return element.parent
+
+    def parse_fragment(self, html):
+        return BeautifulSoup(html, 'html.parser')
+
+    def remove(self, element):
+        element.decompose()
+
+    def fragment_to_html(self, fragment):
+        return str(fragment)
+
+_parsers = {}
+
+def get(name):
+    '''The backend called `name` (one of `PARSERS`); 'lxml' falls back to 'bs4' when cssselect is not installed.
+    '''
+    if name not in PARSERS:
+        raise ValueError(f'parser must be one of: {", ".join(PARSERS)}')
+
+    if name not in _parsers:
+        if name == 'lxml' and CSSSelector is None:
+            print(f'[WARNING] cssselect is not installed (pip install cssselect) - parsing with bs4 instead')
+            _parsers[name] = get('bs4')
+        else:
+            _parsers[name] = LxmlParser() if name == 'lxml' else SoupParser()
+
+    return _parsers[name]
+
+def of(doc):
+    '''The backend that parsed `doc`
+    '''
+    return get('bs4') if isinstance(doc, Tag) else get('lxml')
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,76 @@
+'''CPU-bound post-processing of scraped records (html2text conversion, language detection, word counts).
+
+Fetching is I/O-bound, but converting thousands of articles to text is not. `imap` runs a function over a
+stream of scraped records in a pool of `postprocess_processes` workers, handing out `postprocess_batch_size`
+records per task and yielding results in input order. Because it consumes the scraper's result stream as it
+goes, records are processed while later ones are still being fetched.
+Each worker process builds its html2text converter once (see `html_to_text`) rather than once per record.
+'''
+
+from collections import deque
+import html2text
+from itertools import islice
+import os
+import time
+import utils
+
+# this process's html2text converter (see `html_to_text`)
+_converter = None
+
+def html_to_text(html):
+    '''Convert `html` to markdown text, leaving out links and images, with this process's converter.
+
+        >>> html_to_text('<p>Read <a href="https://example.com">this</a> <img src="x.png"></p>')
+        'Read this\\n\\n'
+    '''
+    global _converter
+    if _converter is None:
+        _converter = html2text.HTML2Text()
+        _converter.ignore_links = True
+        _converter.ignore_images = True
+
+    return _converter.handle(html)
+
+def _process_batch(func, records):
+    start = time.perf_counter()
+    results = [func(record) for record in records]
+    utils.metrics().postprocessed(len(records), time.perf_counter() - start)
+
+    return results
+
+def imap(func, records, num_processes=None):
+    '''Yield `func(record)` for each record, in input order, computed across a pool of worker processes.
+    `func` must be a module-level function (it is sent to the workers by reference).
+
+        >>> list(imap(len, iter(['a', 'bb', 'ccc']), num_processes=1))
+        [1, 2, 3]
+    '''
+    num_processes = num_processes or utils.get_option('postprocess_processes') or os.cpu_count()
+    if num_processes == 1:
+        for record in records:
+            yield from _process_batch(func, [record])
+        return
+
+    batch_size = utils.get_option('postprocess_batch_size')
+    pool = utils.worker_pool(num_processes)
+    pending = deque()
+    record_iter = iter(records)
+    try:
+        while True:
+            batch = list(islice(record_iter, batch_size))
+            if not batch:
+                break
+
+            pending.append(pool.apply_async(_process_batch, (func, batch)))
+            # keep every worker busy, but don't read far ahead of what has been written out
+            if len(pending) >= 2 * num_processes:
+                yield from pending.popleft().get() # `get` is a blocking call
+
+        while pending:
+            yield from pending.popleft().get()
+    finally:
+        pool.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,180 @@
+'''Recipes from the structured data recipe pages publish for search engines: what `ContentScrapeMethod.StructuredData`
+reads instead of asking the Augmentation API to extract each page.
+
+Most recipe sites describe their recipes with schema.org's `Recipe` type, either as JSON-LD
+(`<script type="application/ld+json">`, on its own or in an `@graph`) or as microdata (`itemscope` /
+`itemprop` attributes on the page's elements). `find_recipe` reads the first it finds, JSON-LD first,
+into `name`, `description`, `ingredients` and `instructions` (`HowToStep`s and `HowToSection`s are
+flattened into their steps' text); `to_text` lays it out as the Augmentation API content reads after html2text.
+
+It works on documents of either `parsers` backend.
+
+    >>> import parsers
+    >>> page = """<html><head><script type="application/ld+json">{"@context": "https://schema.org", "@graph": [
+    ...     {"@type": "WebPage", "name": "Cake | Site"},
+    ...     {"@type": "Recipe", "name": "Cake", "description": "A <b>simple</b> cake.", "recipeIngredient": ["2 eggs", "1 cup flour"],
+    ...      "recipeInstructions": [{"@type": "HowToStep", "text": "Mix."}, {"@type": "HowToSection", "name": "Baking",
+    ...                             "itemListElement": [{"@type": "HowToStep", "text": "Bake &amp; cool."}]}]}]}</script></head>
+    ... <body><div itemscope itemtype="http://schema.org/Recipe"><h1 itemprop="name">Pie</h1>
+    ... <span itemprop="author" itemscope itemtype="http://schema.org/Person"><span itemprop="name">Sam</span></span>
+    ... <li itemprop="recipeIngredient">3 apples</li><div itemprop="recipeInstructions"><p>Bake   it.</p></div></div></body></html>"""
+    >>> for name in parsers.PARSERS:
+    ...     parser = parsers.get(name)
+    ...     print(name, find_recipe(parser, parser.parse(page)))
+    lxml {'name': 'Cake', 'description': 'A simple cake.', 'ingredients': ['2 eggs', '1 cup flour'], 'instructions': ['Mix.', 'Bake & cool.']}
+    bs4 {'name': 'Cake', 'description': 'A simple cake.', 'ingredients': ['2 eggs', '1 cup flour'], 'instructions': ['Mix.', 'Bake & cool.']}
+    >>> parser = parsers.get('lxml')
+    >>> recipe = find_recipe(parser, parser.parse(page.split('</head>')[1]))
+    >>> recipe
+    {'name': 'Pie', 'description': None, 'ingredients': ['3 apples'], 'instructions': ['Bake it.']}
+    >>> print(to_text(recipe))
+      * 3 apples
+    <BLANKLINE>
+    Bake it.
+    <BLANKLINE>
+    <BLANKLINE>
+'''
+
+import html
+import json
+import re
+
+JSON_LD_SELECTOR = 'script[type="application/ld+json"]'
+MICRODATA_SELECTOR = '[itemscope][itemtype*="schema.org/Recipe"]'
+
+# schema.org properties read into each field, in order of preference (`ingredients` is the older name of `recipeIngredient`)
+INGREDIENTS_KEYS = ('recipeIngredient', 'ingredients')
+INSTRUCTIONS_KEYS = ('recipeInstructions',)
+
+_TAG_REGEX = re.compile(r'<[^>]+>')
+_BLOCK_TAG_REGEX = re.compile(r'</?(?:p|br|div|li|ol|ul|h[1-6])\b[^>]*>', re.IGNORECASE)
+
+def find_recipe(parser, doc):
+    '''The schema.org Recipe in `doc` (parsed by `parser`, a `parsers` backend) - from its JSON-LD, else its microdata -
+    as {name, description, ingredients, instructions}; None if it has none, or one with neither ingredients nor instructions.
+    '''
+    for recipe in (_json_ld_recipe(parser, doc), _microdata_recipe(parser, doc)):
+        if recipe is not None and (recipe['ingredients'] or recipe['instructions']):
+            return recipe
+
+    return None
+
+def to_text(recipe):
+    '''`recipe`'s description, ingredients (as a list) and instructions (one paragraph per step), as text
+    '''
+    blocks = []
+    if recipe['description']:
+        blocks.append(recipe['description'])
+    if recipe['ingredients']:
+        blocks.append('\n'.join(f'  * {ingredient}' for ingredient in recipe['ingredients']))
+    blocks.extend(recipe['instructions'])
+
+    return ''.join(f'{block}\n\n' for block in blocks)
+
+def _json_ld_recipe(parser, doc):
+    for script in parser.select(doc, JSON_LD_SELECTOR):
+        try:
+            # pages often leave raw newlines in their strings, which strict JSON refuses
+            data = json.loads(parser.text(script), strict=False)
+        except ValueError:
+            continue
+
+        recipe = _find_typed(data, 'Recipe')
+        if recipe is not None:
+            return {
+                'name': _clean(recipe.get('name')),
+                'description': _clean(recipe.get('description')),
+                'ingredients': _strings(_first(recipe, INGREDIENTS_KEYS)),
+                'instructions': _steps(_first(recipe, INSTRUCTIONS_KEYS))
+            }
+
+    return None
+
+def _find_typed(data, type):
+    '''The first object of schema.org `type` in JSON-LD `data`, looking into lists, `@graph`s and nested objects
+    '''
+    if isinstance(data, list):
+        return next((found for found in (_find_typed(item, type) for item in data) if found is not None), None)
+    if not isinstance(data, dict):
+        return None
+
+    types = data.get('@type')
+    types = types if isinstance(types, list) else [types]
+    if any(isinstance(t, str) and t.split(':')[-1].split('/')[-1] == type for t in types):
+        return data
+
+    return _find_typed(list(data.values()), type)
+
+def _microdata_recipe(parser, doc):
+    scopes = parser.select(doc, MICRODATA_SELECTOR)
+    if not scopes:
+        return None
+
+    scope = scopes[0]
+    props = {}
+    for element in parser.select(scope, '[itemprop]'):
+        # properties of items nested in the recipe (its author, its rating...) are not the recipe's
+        if _owner(parser, element) is not scope:
+            continue
+        for name in parser.get(element, 'itemprop', '').split():
+            props.setdefault(name, []).append(element)
+
+    def values(names):
+        elements = next((props[name] for name in names if name in props), [])
+        return [_clean(parser.get(element, 'content') or parser.text(element)) for element in elements]
+
+    name, description = values(['name']), values(['description'])
+    instructions = [step for value in values(INSTRUCTIONS_KEYS) if value for step in _steps(value)]
+
+    return {
+        'name': name[0] if name else None,
+        'description': description[0] if description else None,
+        'ingredients': [value for value in values(INGREDIENTS_KEYS) if value],
+        'instructions': instructions
+    }
+
+def _owner(parser, element):
+    '''The item `element`'s property belongs to: its closest ancestor with `itemscope`
+    '''
+    parent = parser.parent(element)
+    while parent is not None and parser.get(parent, 'itemscope') is None:
+        parent = parser.parent(parent)
+
+    return parent
+
+def _first(item, keys):
+    return next((item[key] for key in keys if item.get(key)), None)
+
+def _strings(value):
+    if value is None:
+        return []
+    values = value if isinstance(value, list) else [value]
+
+    return [text for text in (_clean(v) for v in values if isinstance(v, str)) if text]
+
+def _steps(value):
+    '''The text of each step of `recipeInstructions`: one string (a step per line), strings, `HowToStep`s,
+    `HowToSection`s of steps, or `ItemList`s of them
+    '''
+    if isinstance(value, str):
+        return [text for text in (_clean(line) for line in _BLOCK_TAG_REGEX.sub('\n', value).splitlines()) if text]
+    if isinstance(value, list):
+        return [step for item in value for step in _steps(item)]
+    if isinstance(value, dict):
+        if 'itemListElement' in value:
+            return _steps(value['itemListElement'])
+        return _steps(value.get('text') or value.get('name') or '')
+
+    return []
+
+def _clean(value):
+    '''`value` as plain text: no markup or entities, whitespace collapsed
+    '''
+    if not isinstance(value, str):
+        return None
+
+    return ' '.join(html.unescape(_TAG_REGEX.sub(' ', value)).split()) or None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,240 +1,275 @@
+import articles
+import async_scraper
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import html2text
+from itertools import tee
+import fetch_policy
 import json
+import os
 from langdetect import detect, DetectorFactory
-from multiprocessing import Pool
 import pandas as pd
+import postprocess
 import re
 import scraper
+import search_cache
+import streams
 import string
 import sys
-from urllib.parse import quote
+import tracing
+from urllib.parse import quote, urlparse
 import utils
 
-def review(bloglist_file, api_key, request_rate=0.25, out_file=None, num_processes=1):
-    '''Scrape reviews (article-like) of the URLs provided using the Mercury Web Parser (https://mercury.postlight.com/web-parser/).
-    '''
-    bloglist_df = pd.read_json(bloglist_file)
-    bloglist_df.columns = ['url']
-
-    parser_urls = [_construct_mercury_parser_url(url) for url in bloglist_df.url]
-    headers = utils.create_auth_headers(api_key=api_key)
-    s = scraper.APIScraper(request_rate, headers=headers, res_callback=_handle_article_response)
-    results = utils.run_multi_scraper(s, parser_urls, num_processes)
-
-    DetectorFactory.seed = 0 # enforce consistent language detection
-
-    # assumption: no next_page_url handling (assuming 1 page)
-    updated_results = []
-    for i, res in enumerate(results):
-        if not res:
-            res = {
-                'title': None,
-                'author': None,
-                'date_published': None,
-                'dek': None,
-                'lead_image_url': None,
-                'content': '',
-                'next_page_url': None,
-                'url': None,
-                'domain': None,
-                'excerpt': None,
-                'word_count': 0,
-                'direction': None,
-                'total_pages': None,
-                'rendered_pages': None
-            }
-
-        res['orig_url'] = bloglist_df.loc[i, 'url']
-
-        h = html2text.HTML2Text()
-        h.ignore_links = True
-        h.ignore_images = True
-        try:
-            res['content'] = h.handle(res['content'])
-        except Exception as e:
-            print(f'[WARNING] html2text content handling threw an exception - setting content to empty')
-            res['content'] = ''
-        res['word_count'] = len(res['content'].split())
-        try:
-            res['lang'] = detect(res['content'])
-        except Exception as e:
-            #print(f'[WARNING] langdetect threw an exception - setting lang to None')
-            res['lang'] = None
+# provider endpoints (see `mock_providers.install`)
+MERCURY_PARSER_URL = 'https://mercury.postlight.com/parser'
+HYPEM_API_URL = 'https://api.hypem.com/v2'
+SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+GENIUS_API_URL = 'https://api.genius.com'
 
-        updated_results.append(res)
-
-    print('total word count:', sum([res['word_count'] for res in updated_results]))
-
-    updated_results_df = pd.DataFrame.from_records(updated_results)
-
-    if out_file is not None:
-        updated_results_df.to_json(out_file, orient='records')
-    else:
-        print(updated_results_df.to_json(orient='records'))
-
-def extern_song_ids(hypem_songlist_file, spotify_token=None, genius_token=None, request_rate=0.25, out_file=None, num_processes=1):
-    songlist_df = pd.read_json(hypem_songlist_file)
-
-    search_queries = []
-    for song in songlist_df.itertuples():
-        search_queries.append(_get_song_query(song.title, song.artist))
-
-    if spotify_token is not None:
-        spotify_search_urls = [_construct_spotify_search_url(query) for query in search_queries]
-
-    if genius_token is not None:
-        genius_search_urls = [_construct_genius_search_url(query) for query in search_queries]
-
-    if spotify_token is not None and genius_token is not None:
-        # run spotify and genius in parallel
-        parallel_params = zip([spotify_search_urls, genius_search_urls], [spotify_token, genius_token])
-        pool = Pool(processes=2)
-
-        # TODO: num_processes > 1 == AssertionError: daemonic processes are not allowed to have children
-        print(f'Executing Spotify and Genius scrapes in parallel')
-        async_results = [pool.apply_async(utils.run_multi_scraper, (scraper.APIScraper(request_rate, headers=utils.create_auth_headers(bearer_token=bearer_token)), urls, num_processes)) \
-            for urls, bearer_token in parallel_params]
-        pool_results = []
-        for res in async_results:
-            pool_results.append(res.get()) # `get` is a blocking call
-
-        pool.close()
-
-        spotify_res = pool_results[0]
-        genius_res = pool_results[1]
-    elif spotify_token is not None:
-        headers = utils.create_auth_headers(bearer_token=spotify_token)
-        s = scraper.APIScraper(request_rate, headers=headers)
-        spotify_res = utils.run_multi_scraper(s, spotify_search_urls, num_processes)
-    elif genius_token is not None:
-        headers = utils.create_auth_headers(bearer_token=genius_token)
-        s = scraper.APIScraper(request_rate, headers=headers)
-        genius_res = utils.run_multi_scraper(s, genius_search_urls, num_processes)
-    else:
-        print(f'[ERROR] At least one token must be provided: spotify_token or genius_token')
-        sys.exit()
+# Mercury answers 502 when it cannot fetch the page itself (e.g. a dead blog): go to the page's copy on the
+# Wayback Machine instead of retrying, and track breakers per blog rather than for Mercury as a whole
+MERCURY_POLICY = fetch_policy.Policy(retry_statuses=(500, 503, 504), fallbacks=[fetch_policy.wayback_url],
+                                     fallback_statuses=(502,), target_param='url', circuit_breaker=True)
 
-    if spotify_token is not None:
-        spotify_ids = []
-        for res in spotify_res:
-            if 'tracks' not in res:
-                spotify_ids.append(None)
-                continue
+# blog pages fetched directly: pages gone from their blog (or refused to us) are read from the Wayback Machine
+PAGE_POLICY = fetch_policy.Policy(fallbacks=[fetch_policy.wayback_raw_url], fallback_statuses=(403, 404, 410, 451), circuit_breaker=True)
 
-            track_items = res['tracks']['items']
+EXTRACTORS = ('local', 'mercury')
 
-            if not len(track_items):
-                spotify_ids.append(None)
-                continue
+# a page's own declaration of its encoding
+_META_CHARSET_REGEX = re.compile(rb'''<meta[^>]+charset=["']?([\w-]+)''', re.IGNORECASE)
 
-            # assumption: taking top search result
-            spotify_ids.append(track_items[0]['id'])
-    else:
-        spotify_ids = [None] * len(songlist_df.itemid)
+def review(bloglist_file, api_key=None, request_rate=0.25, out_file=None, num_processes=1, extractor=None, **options):
+    '''Scrape reviews (article-like) of the URLs provided: fetch each page and extract its article in process (`articles`),
+    or with `extractor='mercury'`, have the Mercury Web Parser (https://mercury.postlight.com/web-parser/) do both.
+    `extractor` defaults to 'mercury' when a Mercury `api_key` is given, 'local' otherwise.
+    '''
+    if extractor is None:
+        extractor = 'mercury' if api_key is not None else 'local'
+    if extractor not in EXTRACTORS:
+        print(f'[ERROR] extractor must be one of: {", ".join(EXTRACTORS)}')
+        sys.exit()
+    if extractor == 'mercury' and api_key is None:
+        print(f'[ERROR] the mercury extractor needs an api_key')
+        sys.exit()
+    if extractor == 'local' and api_key is not None:
+        print(f'[WARNING] the local extractor does not use Mercury - ignoring api_key')
+
+    with utils.command(out_file, **options):
+        # blog urls are streamed from bloglist_file: one pass feeds the scraper, the other labels its results
+        blog_urls, orig_urls = tee(streams.read_records(bloglist_file))
+
+        if extractor == 'mercury':
+            parser_urls = (_construct_mercury_parser_url(url) for url in blog_urls)
+            headers = utils.create_auth_headers(api_key=api_key)
+            s = scraper.APIScraper(request_rate, headers=headers, policy=MERCURY_POLICY)
+            results = utils.iter_multi_scraper(s, parser_urls, num_processes)
+        else:
+            s = scraper.APIScraper(request_rate, res_callback=_handle_page_response, policy=PAGE_POLICY)
+            results = utils.iter_multi_scraper(s, blog_urls, num_processes)
+
+        # assumption: no next_page_url handling (assuming 1 page)
+        # text conversion and language detection run in a pool of their own, while later articles are still being fetched
+        total_word_count = 0
+        with streams.RecordWriter(out_file) as writer:
+            for res in postprocess.imap(_process_article, zip(orig_urls, results)):
+                total_word_count += res['word_count']
+                writer.write(res)
+
+            print('total word count:', total_word_count)
+
+def extern_song_ids(hypem_songlist_file, spotify_token=None, genius_token=None, request_rate=0.25, out_file=None, num_processes=1,
+                    search_cache_file=None, incremental=True, **options):
+    '''Find Spotify and Genius ids for songs by searching their titles and artists.
+    Songs with the same (normalized) search query are searched once. With `search_cache_file`, top hits are kept
+    across runs; `incremental` then only searches queries that are not resolved in the cache yet.
+    '''
+    with utils.command(out_file, **options):
+        if spotify_token is None and genius_token is None:
+            print(f'[ERROR] At least one token must be provided: spotify_token or genius_token')
+            sys.exit()
+
+        cache = search_cache.SearchCache(search_cache_file) if search_cache_file is not None else None
+
+        with streams.RecordWriter(out_file) as writer:
+            for songlist_df in streams.read_json_chunks(hypem_songlist_file, utils.get_option('chunk_size')):
+                # one search per distinct normalized query
+                queries = {}
+                song_keys = []
+                for query in _get_song_queries(songlist_df.title, songlist_df.artist):
+                    key = search_cache.normalize(query)
+                    queries.setdefault(key, query)
+                    song_keys.append(key)
+
+                if spotify_token is not None:
+                    spotify_keys = _keys_to_search(cache, 'spotify', queries, incremental)
+                    spotify_search_urls = [_construct_spotify_search_url(queries[key]) for key in spotify_keys]
+
+                if genius_token is not None:
+                    genius_keys = _keys_to_search(cache, 'genius', queries, incremental)
+                    genius_search_urls = [_construct_genius_search_url(queries[key]) for key in genius_keys]
+
+                print(f'{len(song_keys)} songs, {len(queries)} distinct search queries')
+
+                if spotify_token is not None and genius_token is not None and utils.get_option('backend') == 'async':
+                    # run spotify and genius concurrently on one event loop
+                    spotify_res, genius_res = async_scraper.run_jobs([
+                        (scraper.APIScraper(request_rate, headers=utils.create_auth_headers(bearer_token=spotify_token)), spotify_search_urls, ()),
+                        (scraper.APIScraper(request_rate, headers=utils.create_auth_headers(bearer_token=genius_token)), genius_search_urls, ())])
+                elif spotify_token is not None and genius_token is not None:
+                    # run spotify and genius in parallel: each from a thread of this process, with `num_processes` workers
+                    # of the run's executor (worker processes can't start workers of their own)
+                    parallel_params = zip([spotify_search_urls, genius_search_urls], [spotify_token, genius_token])
+
+                    print(f'Executing Spotify and Genius scrapes in parallel')
+                    with ThreadPoolExecutor(2) as threads:
+                        futures = [threads.submit(utils.run_multi_scraper, scraper.APIScraper(request_rate, headers=utils.create_auth_headers(bearer_token=bearer_token)), urls, num_processes) \
+                            for urls, bearer_token in parallel_params]
+                        spotify_res, genius_res = [future.result() for future in futures] # `result` is a blocking call
+                elif spotify_token is not None:
+                    headers = utils.create_auth_headers(bearer_token=spotify_token)
+                    s = scraper.APIScraper(request_rate, headers=headers)
+                    spotify_res = utils.run_multi_scraper(s, spotify_search_urls, num_processes)
+                elif genius_token is not None:
+                    headers = utils.create_auth_headers(bearer_token=genius_token)
+                    s = scraper.APIScraper(request_rate, headers=headers)
+                    genius_res = utils.run_multi_scraper(s, genius_search_urls, num_processes)
+
+                if spotify_token is not None:
+                    spotify_ids = _resolve_ids(cache, 'spotify', song_keys, spotify_keys, spotify_res, _spotify_top_hit)
+                else:
+                    spotify_ids = [None] * len(songlist_df.itemid)
+
+                if genius_token is not None:
+                    genius_ids = _resolve_ids(cache, 'genius', song_keys, genius_keys, genius_res, _genius_top_hit)
+                else:
+                    genius_ids = [0] * len(songlist_df.itemid)
+
+                result_df = pd.DataFrame({'itemid': songlist_df.itemid, 'spotify_id': spotify_ids, 'genius_id': genius_ids})
+                result_df.genius_id = result_df.genius_id.fillna(0).astype(int)
+
+                writer.write_df(result_df)
+
+        if cache is not None:
+            cache.close()
+
+def _keys_to_search(cache, provider, queries, incremental):
+    if cache is None or not incremental:
+        return list(queries)
+
+    return [key for key in queries if cache.get(provider, key) is None]
+
+def _resolve_ids(cache, provider, song_keys, searched_keys, results, top_hit):
+    '''Fan search results back out to songs; songs whose query was not searched get the cached hit
+    '''
+    ids = {}
+    for key, res in zip(searched_keys, results):
+        ids[key] = top_hit(res)
+        if cache is not None and ids[key] is not None:
+            cache.put(provider, key, ids[key])
 
-    if genius_token is not None:
-        genius_ids = []
-        for res in genius_res:
-            if 'response' not in res:
-                genius_ids.append(None)
-                continue
+    return [ids[key] if key in ids else cache.get(provider, key) for key in song_keys]
 
-            hits = res['response']['hits']
+def _spotify_top_hit(res):
+    if 'tracks' not in res:
+        return None
 
-            if not len(hits):
-                genius_ids.append(None)
-                continue
+    track_items = res['tracks']['items']
 
-            # assumption: taking top search result
-            genius_ids.append(hits[0]['result']['id'])
-    else:
-        genius_ids = [0] * len(songlist_df.itemid)
+    if not len(track_items):
+        return None
 
-    result_df = pd.DataFrame({'itemid': songlist_df.itemid, 'spotify_id': spotify_ids, 'genius_id': genius_ids})
-    result_df.genius_id = result_df.genius_id.fillna(0).astype(int)
+    # assumption: taking top search result
+    return track_items[0]['id']
 
-    if out_file is not None:
-        result_df.to_json(out_file, orient='records')
-    else:
-        print(result_df.to_json(orient='records'))
+def _genius_top_hit(res):
+    if 'response' not in res:
+        return None
 
-def song_blogs(tm_out_file, request_rate=0.25, out_file=None, num_processes=1):
-    tm_df = pd.read_json(tm_out_file)
+    hits = res['response']['hits']
 
-    item_ids = set()
-    for week in tm_df.songs:
-        for song in week:
-            item_ids.add(song['itemid']) # artist, title, loved_count, posted_count, time, week
+    if not len(hits):
+        return None
 
-    print(f'{len(item_ids)} unique songs provided.')
+    # assumption: taking top search result
+    return hits[0]['result']['id']
 
-    item_ids = list(item_ids) # order
-    song_blogs_urls = [_construct_song_blogs_url(item_id) for item_id in item_ids]
+def song_blogs(tm_out_file, request_rate=0.25, out_file=None, num_processes=1, **options):
+    with utils.command(out_file, **options):
+        # unique item ids are streamed out as they are first seen, so fetching starts right away
+        item_ids, result_item_ids = tee(_unique_item_ids(streams.read_records(tm_out_file)))
+        song_blogs_urls = (_construct_song_blogs_url(item_id) for item_id in item_ids)
 
-    s = scraper.APIScraper(request_rate)
-    blogs = utils.run_multi_scraper(s, song_blogs_urls, num_processes)
+        s = scraper.APIScraper(request_rate)
+        blogs = utils.iter_multi_scraper(s, song_blogs_urls, num_processes)
 
-    result_df = pd.DataFrame({'itemid': item_ids, 'blogs': blogs})
+        num_songs = 0
+        with streams.RecordWriter(out_file, columns=['itemid', 'blogs']) as writer:
+            for item_id, item_blogs in zip(result_item_ids, blogs):
+                writer.write({'itemid': item_id, 'blogs': item_blogs})
+                num_songs += 1
 
-    if out_file is not None:
-        result_df.to_json(out_file, orient='records')
-    else:
-        print(result_df.to_json(orient='records'))
+        print(f'{num_songs} unique songs provided.')
 
-def time_machine(api_key, start_date=datetime.now(), end_date=datetime.now()-timedelta(days=14), days_from_start=None, request_rate=0.25, out_file=None, num_processes=1):
-    date_format = '%b-%d-%Y' # May-27-2018
+def time_machine(api_key, start_date=datetime.now(), end_date=datetime.now()-timedelta(days=14), days_from_start=None, request_rate=0.25, out_file=None, num_processes=1, **options):
+    with utils.command(out_file, **options):
+        date_format = '%b-%d-%Y' # May-27-2018
 
-    if not isinstance(start_date, datetime):
-        start_date = datetime.strptime(start_date, date_format)
+        if not isinstance(start_date, datetime):
+            start_date = datetime.strptime(start_date, date_format)
 
-    if isinstance(days_from_start, int):
-        end_date = start_date - timedelta(days_from_start)
-    elif not isinstance(end_date, datetime):
-        end_date = datetime.strptime(end_date, date_format)
+        if isinstance(days_from_start, int):
+            end_date = start_date - timedelta(days_from_start)
+        elif not isinstance(end_date, datetime):
+            end_date = datetime.strptime(end_date, date_format)
 
-    print(f'start_date: {start_date.__format__(date_format)}; end_date: {end_date.__format__(date_format)}')
+        print(f'start_date: {start_date.__format__(date_format)}; end_date: {end_date.__format__(date_format)}')
 
-    weeks = []
-    curr_date = start_date
-    while curr_date > end_date:
-        if curr_date == start_date and curr_date.weekday() is not 0:
-            delta = curr_date.weekday()
-        else:
-            delta = 7
+        weeks = []
+        curr_date = start_date
+        while curr_date > end_date:
+            if curr_date == start_date and curr_date.weekday() is not 0:
+                delta = curr_date.weekday()
+            else:
+                delta = 7
+
+            last_monday = curr_date - timedelta(days=delta)
 
-        last_monday = curr_date - timedelta(days=delta)
+            weeks.append(last_monday.__format__(date_format))
 
-        weeks.append(last_monday.__format__(date_format))
+            curr_date = last_monday
 
-        curr_date = last_monday
+        time_machine_urls = [_construct_time_machine_url(wk) for wk in weeks]
+        key_param = f'?key={api_key}' if api_key is not None else None
+        s = scraper.APIScraper(request_rate, query_params=key_param)
+        songs = utils.run_multi_scraper(s, time_machine_urls, num_processes)
 
-    time_machine_urls = [_construct_time_machine_url(wk) for wk in weeks]
-    key_param = f'?key={api_key}' if api_key is not None else None
-    s = scraper.APIScraper(request_rate, query_params=key_param)
-    songs = utils.run_multi_scraper(s, time_machine_urls, num_processes)
+        result_df = pd.DataFrame({'popular_week': weeks, 'songs': songs})
 
-    result_df = pd.DataFrame({'popular_week': weeks, 'songs': songs})
+        with streams.RecordWriter(out_file) as writer:
+            writer.write_df(result_df)
 
-    if out_file is not None:
-        result_df.to_json(out_file, orient='records')
-    else:
-        print(result_df.to_json(orient='records'))
+def _unique_item_ids(weeks):
+    item_ids = set()
+    for week in weeks:
+        for song in week['songs']:
+            if song['itemid'] not in item_ids: # artist, title, loved_count, posted_count, time, week
+                item_ids.add(song['itemid'])
+                yield song['itemid']
 
 def _construct_mercury_parser_url(url):
-    return f'https://mercury.postlight.com/parser?url={url}'
+    return f'{MERCURY_PARSER_URL}?url={url}'
 
 def _construct_song_blogs_url(item_id):
-    return f'https://api.hypem.com/v2/tracks/{item_id}/blogs'
+    return f'{HYPEM_API_URL}/tracks/{item_id}/blogs'
 
 def _construct_spotify_search_url(query):
-    return f'https://api.spotify.com/v1/search?q={quote(query)}&type=track'
+    return f'{SPOTIFY_API_URL}/search?q={quote(query)}&type=track'
 
 def _construct_genius_search_url(query):
-    return f'https://api.genius.com/search?q={quote(query)}'
+    return f'{GENIUS_API_URL}/search?q={quote(query)}'
 
 def _construct_time_machine_url(date):
-    return f'https://api.hypem.com/v2/set/popularweek_{date}/tracks'
+    return f'{HYPEM_API_URL}/set/popularweek_{date}/tracks'
 
 def _get_song_query(title, artist):
     '''removes following from title:
@@ -285,65 +320,165 @@ def _get_song_query(title, artist):
 
     return f'{title} {artist}'
 
-def _handle_article_response(**kwargs):
-    if kwargs is None:
-        raise ValueError('_handle_article_response needs args (res, url, remaining_count, rrl)')
-
+def _handle_page_response(**kwargs):
+    '''The article of a blog page (`articles.extract`), extracted in the worker that fetched it: only the article's
+    fields are journaled and sent back, not the page. [] if it could not be fetched (or has no html)
+    '''
     res = kwargs.get('res')
     url = kwargs.get('url')
-    remaining_count = kwargs.get('remaining_count')
-    rrl = kwargs.get('rrl')
 
     if res.status_code != 200:
-        print(f'[WARNING] request to {url} not successful: {res} {res.text}')
-        if res.status_code == 401:
-            print(f'[WARNING] request token expired or invalid - abandoning scrape')
-            return [[] for i in range(remaining_count)]
-
-        if res.status_code == 502:
-            try:
-                url = res.request.url
-
-                url_param = 'url='
-                idx = url.find(url_param) + len(url_param)
-                url = url[:idx] + 'https://web.archive.org/web/1000/' + url[idx:]
-
-                request_url = url
-                #print(f'[DEBUG:502] make_rate_limited_request: {request_url}; {utils.RequestVerb.GET}; {res.request.headers}')
-                res = rrl.make_rate_limited_request(request_url, utils.RequestVerb.GET, headers=res.request.headers)
-            except Exception as e:
-                print(f'[WARNING:502] Exception thrown - skipping {url}')
-                print(e)
-                return []
-
-            if res.status_code != 200:
-                print(f'[WARNING:502] request to {url} not successful: {res} {res.text}')
-                if res.status_code == 401:
-                    print(f'[WARNING:502] request token expired or invalid - abandoning scrape')
-                    return [[] for i in range(remaining_count)]
-            else:
-                try:
-                    return res.json()
-                except Exception as e:
-                    print(f'[WARNING:502] Exception thrown on res.json() for {url}; {res.text} - skipping')
-                    return []
-
-        parsed_res = []
-    else:
+        print(f'[WARNING] request to {url} not successful: {res}')
+        return []
+
+    content_type = res.headers.get('Content-Type', '').lower()
+    if content_type and 'html' not in content_type:
+        print(f'[WARNING] {url} is not an html page ({content_type}) - skipping')
+        return []
+
+    if 'charset' not in content_type:
+        # requests assumes ISO-8859-1 for text without a charset: go by the page's own declaration, or UTF-8
+        match = _META_CHARSET_REGEX.search(res.content[:4096])
+        res.encoding = match.group(1).decode('ascii') if match else 'utf-8'
+
+    # the page's url after redirects - but not the Wayback Machine's, for a page read from there
+    page_url = res.url if urlparse(res.url).hostname != 'web.archive.org' else url
+
+    with tracing.span('extract', url=url):
+        return articles.extract(res.text, page_url) or []
+
+def _process_article(article):
+    orig_url, res = article
+    if not res:
+        res = {
+            'title': None,
+            'author': None,
+            'date_published': None,
+            'dek': None,
+            'lead_image_url': None,
+            'content': '',
+            'next_page_url': None,
+            'url': None,
+            'domain': None,
+            'excerpt': None,
+            'word_count': 0,
+            'direction': None,
+            'total_pages': None,
+            'rendered_pages': None
+        }
+
+    res['orig_url'] = orig_url
+
+    with tracing.span('extract', url=orig_url):
         try:
-            parsed_res = res.json()
+            res['content'] = postprocess.html_to_text(res['content'])
         except Exception as e:
-            print(f'[WARNING] Exception thrown on res.json() for {url}; {res.text} - skipping')
-            parsed_res = []
+            print(f'[WARNING] html2text content handling threw an exception - setting content to empty')
+            res['content'] = ''
+        res['word_count'] = len(res['content'].split())
+
+        DetectorFactory.seed = 0 # enforce consistent language detection
+        try:
+            res['lang'] = detect(res['content'])
+        except Exception as e:
+            #print(f'[WARNING] langdetect threw an exception - setting lang to None')
+            res['lang'] = None
+
+    return res
+
+# compiled once for `_get_song_queries`
+_PARENTHETICAL_REGEX = re.compile(r'\([^)]+\)')
+_PUNCTUATION_REGEX = re.compile('[%s]' % re.escape(string.punctuation))
+_COLUMN_SEPARATOR = '\x00'
+_PARENTHETICAL_KEEP_WORDS = ['remix', 'edit', 'rework']
+
+# titles of 9850 songs, to check `_get_song_queries` against `_get_song_query` (run `python -m doctest reviews.py`)
+_SONG_TITLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'datasets', 'song_titles_5yrs.json')
 
-    return parsed_res
+def _get_song_queries(titles, artists):
+    '''`_get_song_query` for whole Series of titles and artists at once, e.g. a songlist's columns.
+    Regexes are compiled once, each cleanup step runs over a whole column joined into one string,
+    and parentheticals are filtered in a single scan. The output is identical:
+
+        >>> titles = pd.Series(json.load(open(_SONG_TITLES_FILE)) + ['Song (Remix) (Remix) w/ (Edit (x) edit)', None])
+        >>> artists = pd.Series((['Cam-ron w Mike feat Z', 'A feat B', None, 'Sam'] * len(titles))[:len(titles)])
+        >>> queries = _get_song_queries(titles, artists)
+        >>> len(queries), all(q == _get_song_query(t, a) for q, t, a in zip(queries, titles, artists))
+        (9852, True)
+    '''
+    titles = ['' if t is None or t != t else t for t in titles]
+    artists = ['' if a is None or a != a else a for a in artists]
+
+    # column-wide steps must not see one value run into the next
+    if any(_COLUMN_SEPARATOR in value for value in titles + artists):
+        return [_get_song_query(t, a) for t, a in zip(titles, artists)]
+
+    # remove everything after 'prod.' from title, then lowercase it
+    lower_titles = _COLUMN_SEPARATOR.join(titles).lower().split(_COLUMN_SEPARATOR)
+    titles = [low if 'prod.' not in low else t[0:low.find('prod.')].lower() for t, low in zip(titles, lower_titles)]
+
+    # remove parentheticals that don't include 'remix' OR 'edit' OR 'rework'
+    titles = [_remove_parentheticals(t) if '(' in t else t for t in titles]
+
+    # remove punctuation, 'feat ' and 'w ' from title
+    title_column = _COLUMN_SEPARATOR.join(titles)
+    title_column = _PUNCTUATION_REGEX.sub('', title_column).replace('feat ', '').replace(' w ', ' ')
+
+    # remove 'feat ', '-' and 'w ' from artist
+    artist_column = _COLUMN_SEPARATOR.join(artists)
+    artist_column = artist_column.replace('feat ', '').replace('-', ' ').replace(' w ', ' ')
+
+    return [f'{title} {artist}' for title, artist in zip(title_column.split(_COLUMN_SEPARATOR), artist_column.split(_COLUMN_SEPARATOR))]
+
+def _has_word(target_str, word):
+    '''Whether `word` is one of the alphabetic words of `target_str`
+    '''
+    i = target_str.find(word)
+    while i > -1:
+        end = i + len(word)
+        if (i == 0 or not target_str[i-1].isalpha()) and (end == len(target_str) or not target_str[end].isalpha()):
+            return True
+        i = target_str.find(word, i + 1)
+
+    return False
+
+def _remove_parentheticals(title):
+    '''`_remove_matches_without_words(title, r'\([^)]+\)', ['remix', 'edit', 'rework'])` for a lowercased title,
+    in a single scan
+    '''
+    matches = list(_PARENTHETICAL_REGEX.finditer(title))
+    if not matches:
+        return title
+
+    # positions of the first occurrence of each keep word, as `_remove_matches_without_words` has it
+    idx = [title.find(word) for word in _PARENTHETICAL_KEEP_WORDS if word in title and _has_word(title, word)]
+    removed = [m for m in matches if not any(m.start() < i < m.end() for i in idx)] if idx else matches
+    if len(matches) == 1:
+        return title.replace(matches[0].group(), '') if removed else title
+
+    groups = [m.group() for m in matches]
+    if len(set(groups)) < len(groups) or any(g.count('(') > 1 for g in groups):
+        # repeated or nested parentheticals: removing one may remove another, so replace exactly as the original does
+        for m in removed:
+            title = title.replace(m.group(), '')
+        return title
+
+    if len(removed) == len(matches):
+        return _PARENTHETICAL_REGEX.sub('', title)
+
+    parts = []
+    start = 0
+    for m in removed:
+        parts.append(title[start:m.start()])
+        start = m.end()
+    parts.append(title[start:])
+
+    return ''.join(parts)
 
 def _remove_matches_without_words(target_str, regex, words):
-    ''' e.g., TODO: doctest
-        target_str = Bad Things feat. Killer Mike (of Run The Jewels) (Official Remix) (Jumanji edition)
-        regex = r"\([^)]+\)"
-        words = ['remix', 'edit', 'rework']
-        output => Bad Things feat. Killer Mike  (Official Remix)
+    ''' e.g.,
+        >>> _remove_matches_without_words('bad things feat. killer mike (of run the jewels) (official remix) (jumanji edition)', r'\([^)]+\)', ['remix', 'edit', 'rework'])
+        'bad things feat. killer mike  (official remix) '
     '''
     target_list = ''.join((c if c.isalpha() else ' ') for c in target_str.lower()).split()
 
@@ -1,19 +1,32 @@
 from abc import ABC, abstractmethod
-from bs4 import BeautifulSoup
+import asyncio
+import async_scraper
 from enum import Enum, auto
+import html
 import html2text
 import json
-from multiprocessing import Pool
+import multiprocessing
 import pandas as pd
+import parsers
+import queue
+import re
+import recipes
+import streams
 import sys
+import threading
 import time
+import tracing
 from urllib.parse import urlparse
 import utils
 
 USAGE_HELP = 'Run `python scrape.py -- --help` for usage.'
 
+# OneNote's clipper extraction endpoint, used by `ContentScrapeMethod.RecipeAPI` (see `mock_providers.install`)
+AUGMENTATION_API_URL = 'https://www.onenote.com/onaugmentation/clipperextract/v1.0/'
+
 class Scraper(ABC):
-    '''All scrapers should implement a `run` method
+    '''All scrapers should implement a `run` method, and a `_scrape_url` method for scraping a single URL
+    (used by the async backend to scrape many URLs concurrently)
     '''
     @abstractmethod
     def __init__(self, request_rate):
@@ -23,46 +36,109 @@ class Scraper(ABC):
     def run(self):
         pass
 
+    def scrape_url(self, url, remaining_count, *args):
+        '''Scrape a single URL - or read it back from the run's journal, if a previous run already scraped it.
+        '''
+        journal = utils.journal()
+        key = journal.key(self, url, args) if journal is not None else None
+        if key is not None and key in journal:
+            utils.metrics().scraped(urlparse(url).hostname)
+            return journal.get(key)
+
+        # whatever the scrape spends outside of fetching is parse time
+        start = time.perf_counter()
+        fetch_start = utils.fetch_seconds()
+        with tracing.span('scrape', url=url, scraper=type(self).__name__):
+            res = self._scrape_url(url, remaining_count, *args)
+        utils.metrics().scraped(urlparse(url).hostname, time.perf_counter() - start - (utils.fetch_seconds() - fetch_start))
+
+        if journal is not None:
+            journal.record(key, res)
+
+        return res
+
+    @abstractmethod
+    def _scrape_url(self, url, remaining_count, *args):
+        pass
+
 class APIScraper(Scraper):
     '''Get JSON content returned by an API
     '''
-    def __init__(self, request_rate, request_verb=utils.RequestVerb.GET, query_params=None, headers=None, res_callback=utils.handle_json_response):
+    def __init__(self, request_rate, request_verb=utils.RequestVerb.GET, query_params=None, headers=None, res_callback=utils.handle_json_response, policy=None):
         self.request_rate = request_rate
         self.request_verb = request_verb
         self.query_params = query_params
         self.headers = headers
         self.res_callback = res_callback
+        self.policy = policy
 
     def run(self, content_urls):
         responses = []
         total = len(content_urls)
         count = 0
 
+        utils.metrics().submitted(total)
         start = time.time()
         for url in content_urls:
-            rrl = utils.RequestRateLimiterFactory(self.request_rate)()
             if count is 0:
-                print(f'[WARNING] rate_limited _call_api(): max_per_Second:{self.request_rate}')
+                print(f'[WARNING] requests limited to {self.request_rate}/s per host')
 
-            try:
-                request_url = f'{url}{self.query_params}' if self.query_params is not None else url
-                res = rrl.make_rate_limited_request(request_url, self.request_verb, headers=self.headers)
-                parsed_res = self.res_callback(res=res, url=url, remaining_count=total-count, rrl=rrl)
-            except Exception as e:
-                # TODO: could provide 'skip' vs 'abandon' option for exceptions
-                print(f'[WARNING] Exception thrown - skipping {url}')
-                print(e)
-                parsed_res = []
+            parsed_res = self.scrape_url(url, total-count)
 
             count += 1
             responses.append(parsed_res)
-            utils.print_progress(count, total, urlparse(url).hostname)
 
         end = time.time()
         print(f'{sum([len(res) for res in responses])} items scraped from {count} urls in {end-start:.2f}s.')
 
         return responses
 
+    def _scrape_url(self, url, remaining_count):
+        rrl = utils.RequestRateLimiter(self.request_rate, policy=self.policy)
+
+        try:
+            request_url = f'{url}{self.query_params}' if self.query_params is not None else url
+            res = rrl.make_rate_limited_request(request_url, self.request_verb, headers=self.headers)
+            parsed_res = self.res_callback(res=res, url=url, remaining_count=remaining_count, rrl=rrl)
+        except Exception as e:
+            # TODO: could provide 'skip' vs 'abandon' option for exceptions
+            print(f'[WARNING] Exception thrown - skipping {url}')
+            print(e)
+            parsed_res = []
+
+        return parsed_res
+
+class BatchAPIScraper(APIScraper):
+    '''Look up ids through an API's multi-id endpoint (e.g. Spotify's `/tracks?ids=`) instead of one request per id.
+    Ids are deduped (empty ids skipped) and packed `batch_size` to a request; results are fanned back out to the ids.
+    `construct_url` must be a module-level function (scrapers are sent to pool workers), taking a list of ids.
+    '''
+    def __init__(self, request_rate, construct_url, result_key, batch_size, headers=None):
+        super().__init__(request_rate, headers=headers)
+        self.construct_url = construct_url
+        self.result_key = result_key
+        self.batch_size = batch_size
+
+    def lookup(self, ids, num_processes):
+        '''Returns one result per id, in order: the endpoint's object for the id, or None
+        (empty id, unknown id or failed request).
+        '''
+        unique_ids = list(dict.fromkeys(id for id in ids if id))
+        groups = [unique_ids[i:i+self.batch_size] for i in range(0, len(unique_ids), self.batch_size)]
+        api_results = utils.run_multi_scraper(self, [self.construct_url(g) for g in groups], num_processes)
+
+        results = {}
+        for group, res in zip(groups, api_results):
+            items = res.get(self.result_key) if isinstance(res, dict) else None
+            if items is None or len(items) != len(group):
+                print(f'[WARNING] no {self.result_key} returned for {len(group)} ids - setting them to None')
+                continue
+            results.update(zip(group, items))
+
+        print(f'{len(ids)} {self.result_key} looked up with {len(groups)} request(s)')
+
+        return [results.get(id) if id else None for id in ids]
+
 class DOMScraper(Scraper):
     '''Scrape content from the DOM of the URLs provided.
     '''
@@ -72,24 +148,167 @@ class DOMScraper(Scraper):
     def run(self, content_urls, content_selectors, select_prop='text'):
         return self._scrape_dom(content_urls, content_selectors, select_prop)
 
+    def _scrape_url(self, url, remaining_count, content_selectors, select_prop='text'):
+        soup = utils.Soup.url_to_soup(url, self.request_rate)
+
+        if soup is None:
+            print(f'[WARNING] No content found for {url}')
+            return None
+
+        return utils.Soup.soup_to_content(url, soup, content_selectors, select_prop)
+
     def _scrape_dom(self, content_urls, content_selectors, select_prop):
         content = []
         total = len(content_urls)
         count = 0
 
+        utils.metrics().submitted(total)
         for url in content_urls:
-            soup = utils.Soup.url_to_soup(url, self.request_rate, limit_warning=(count==0))
+            if count is 0:
+                print(f'[WARNING] requests limited to {self.request_rate}/s per host')
+
+            content.append(self.scrape_url(url, total-count, content_selectors, select_prop))
 
             count += 1
-            utils.print_progress(count, total, urlparse(url).hostname)
-            if soup is None:
-                print(f'[WARNING] No content found for {url}')
-                content.append(None)
-            else:
-                content.append(utils.Soup.soup_to_content(url, soup, content_selectors, select_prop))
 
         return content
 
+class RecipeScraper(Scraper):
+    '''Scrape recipes from the schema.org structured data (JSON-LD or microdata) of the URLs provided: one request
+    per page, extracted in process (see `recipes`). Pages without a recipe fall back to `content_selectors`, as DOM
+    scrapes read them.
+    '''
+    def __init__(self, request_rate):
+        super().__init__(request_rate)
+
+    def run(self, content_urls, content_selectors=None):
+        total = len(content_urls)
+        utils.metrics().submitted(total)
+
+        return [self.scrape_url(url, total-count, content_selectors) for count, url in enumerate(content_urls)]
+
+    def _scrape_url(self, url, remaining_count, content_selectors=None):
+        soup = utils.Soup.url_to_soup(url, self.request_rate)
+
+        if soup is None:
+            print(f'[WARNING] No content found for {url}')
+            return None
+
+        parser = parsers.of(soup)
+        with tracing.span('extract', url=url):
+            recipe = recipes.find_recipe(parser, soup)
+            if recipe is not None:
+                return recipes.to_text(recipe)
+
+        if not content_selectors:
+            print(f'[WARNING] No structured recipe data found for {url}, and no content_selectors to fall back to')
+            return None
+
+        return utils.Soup.soup_to_content(url, soup, content_selectors)
+
+class TagScraper(Scraper):
+    '''Read one attribute of the first `tag` with the given `attrs` in each page (e.g. a `<meta>` tag's content),
+    without building a DOM: the page is streamed, and the download stops as soon as the tag has come in.
+    With `json_attr`, the attribute is decoded as JSON and the object returned.
+    '''
+    def __init__(self, request_rate):
+        super().__init__(request_rate)
+
+    def run(self, content_urls, tag, attrs, select_attr, json_attr=False):
+        total = len(content_urls)
+        utils.metrics().submitted(total)
+
+        return [self.scrape_url(url, total-count, tag, attrs, select_attr, json_attr) for count, url in enumerate(content_urls)]
+
+    def _scrape_url(self, url, remaining_count, tag, attrs, select_attr, json_attr=False):
+        rrl = utils.RequestRateLimiter(self.request_rate)
+        try:
+            res = rrl.make_rate_limited_request(url, read_until=_TagFinder(tag, attrs))
+        except Exception as e:
+            print(f'[WARNING] Failed to fetch {url}')
+            print(e)
+            return None
+
+        if res.status_code != 200:
+            print(f'[WARNING] request to {url} not successful: {res}')
+            return None
+
+        with tracing.span('extract', url=url):
+            found = _find_tag(res.content, tag, attrs, res.encoding or 'utf-8')
+        if found is None or select_attr not in found:
+            print(f'[WARNING] Failed to find {tag} {attrs} with a {select_attr} attribute for url {url}')
+            return None
+
+        if not json_attr:
+            return found[select_attr]
+
+        try:
+            with tracing.span('parse', url=url):
+                return json.loads(found[select_attr])
+        except ValueError as e:
+            print(f'[WARNING] {select_attr} of {tag} {attrs} is not JSON for url {url}')
+            print(e)
+            return None
+
+# a tag's attributes: name, and a double-quoted, single-quoted or unquoted value (or none)
+_ATTRIBUTE_REGEX = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?''')
+
+def _find_tag(body, tag, attrs, encoding='utf-8'):
+    '''The attributes (names lowercased, values unescaped) of the first complete `tag` in the html `body` (bytes)
+    with all of `attrs`, or None. Quoted attribute values may contain '>'.
+
+        >>> page = b'<html><head><meta name="x"><meta itemprop="page_data" content="{&quot;a&quot;: &quot;&gt;&quot;}"></head>'
+        >>> _find_tag(page, 'meta', {'itemprop': 'page_data'})
+        {'itemprop': 'page_data', 'content': '{"a": ">"}'}
+        >>> _find_tag(page[:60], 'meta', {'itemprop': 'page_data'}) is None # not all in yet
+        True
+    '''
+    return _scan_tags(body, tag, attrs, encoding)[0]
+
+def _scan_tags(body, tag, attrs, encoding='utf-8', start=0):
+    '''`_find_tag` from offset `start` of `body`; returns (attributes or None, offset to resume from once more of the
+    body has come in): the start of the first `tag` not complete yet, else the end of what was scanned.
+    '''
+    tag_bytes = re.escape(tag.encode())
+    tag_regex = re.compile(rb'<' + tag_bytes + rb'''(?=[\s/>])((?:[^>"']|"[^"]*"|'[^']*')*)>''', re.IGNORECASE)
+    end = start
+    for match in tag_regex.finditer(body, start):
+        found = {}
+        for name, double_quoted, single_quoted, unquoted in _ATTRIBUTE_REGEX.findall(match.group(1).decode(encoding, errors='replace')):
+            # as HTML parsers do, the first of repeated attributes wins
+            found.setdefault(name.lower(), html.unescape(double_quoted or single_quoted or unquoted))
+        if all(found.get(name) == value for name, value in attrs.items()):
+            return found, match.start()
+        end = match.end()
+
+    # a tag opened after the last complete one is still coming in; else, keep room for an opening cut at the end
+    opening = re.compile(rb'<' + tag_bytes + rb'(?=[\s/>])', re.IGNORECASE).search(body, end)
+    if opening is not None:
+        return None, opening.start()
+
+    return None, max(end, len(body) - len(tag.encode()) - 1)
+
+class _TagFinder():
+    '''`read_until` for a `_find_tag` search: each call only scans the body from where the previous call left off,
+    not the whole body read so far.
+
+        >>> page = b'<html><head><meta name="x"><meta itemprop="page_data" content="{&quot;a&quot;: &quot;&gt;&quot;}"></head>'
+        >>> finder = _TagFinder('meta', {'itemprop': 'page_data'})
+        >>> [finder(page[:end]) for end in (20, 31, 60, len(page))]
+        [False, False, False, True]
+        >>> finder.start
+        27
+    '''
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.start = 0
+
+    def __call__(self, body):
+        found, self.start = _scan_tags(body, self.tag, self.attrs, start=self.start)
+
+        return found is not None
+
 class IndexScraper(Scraper):
     '''Scrape URLs from the site index using selectors.
     '''
@@ -99,8 +318,11 @@ class IndexScraper(Scraper):
     def run(self, configs):
         #print(configs)
 
+        if utils.get_option('backend') == 'async':
+            return self._run_async(configs)
+
         num_processes = len(configs) # num processes == num configs
-        pool = Pool(processes=num_processes)
+        pool = utils.worker_pool(num_processes)
 
         print(f'Executing index scrape across max {num_processes} processes')
         async_results = [pool.apply_async(self._scrape_index, (index_url, href_selector, pagination_options)) for index_url, href_selector, pagination_options in configs]
@@ -109,25 +331,39 @@ class IndexScraper(Scraper):
 
         return pool_results
 
-    def _scrape_index(self, index_url, href_selector, pagination_options):
+    def _run_async(self, configs):
+        jobs = [(self, self.index_urls(index_url, pagination_options), (href_selector,)) for index_url, href_selector, pagination_options in configs]
+        job_results = async_scraper.run_jobs(jobs)
+
+        # flatten each config's per-index-page url lists
+        return [[content_url for page in pages for content_url in page] for pages in job_results]
+
+    def _scrape_url(self, url, remaining_count, href_selector):
+        soup = utils.Soup.url_to_soup(url, self.request_rate)
+        if soup is None:
+            print(f'[WARNING] No content urls found for {url}')
+            return []
+
+        return utils.Soup.soup_to_index(url, soup, href_selector)
+
+    def index_urls(self, index_url, pagination_options):
         if not pagination_options:
-            index_urls = [index_url]
-        else:
-            index_urls = self._parse_pagination_options(index_url, pagination_options)
+            return [index_url]
+
+        return self._parse_pagination_options(index_url, pagination_options)
+
+    def _scrape_index(self, index_url, href_selector, pagination_options):
+        index_urls = self.index_urls(index_url, pagination_options)
 
         content_urls = []
         total = len(index_urls)
         count = 0
 
+        utils.metrics().submitted(total)
         for i_url in index_urls:
-            soup = utils.Soup.url_to_soup(i_url, self.request_rate)
-            if soup is None:
-                print(f'[WARNING] No content urls found for {i_url}')
-            else:
-                content_urls.extend(utils.Soup.soup_to_index(i_url, soup, href_selector))
+            content_urls.extend(self.scrape_url(i_url, total-count, href_selector))
 
             count += 1
-            utils.print_progress(count, total, urlparse(i_url).hostname)
 
         return content_urls
 
@@ -149,6 +385,7 @@ class ContentScrapeMethod(Enum):
     '''
     DOM = auto()
     RecipeAPI = auto()
+    StructuredData = auto()
 
 class Pipeline(object):
     '''Initialize pipeline for scraping web content.
@@ -156,15 +393,21 @@ class Pipeline(object):
         1) content_url scrape
         2) content scrape
     (You can run any of these steps independently using command line args)
+
+    `run` streams the two steps: content urls are queued as soon as each index page is parsed, and content
+    workers scrape them concurrently (at most `queue_size` urls wait in between, so a fast index step can't
+    run away from the content step). Records are written as they complete.
     '''
 
-    def __init__(self, config_file=None, scrape_method=None, request_rate=0.25, out_file=None):
+    def __init__(self, config_file=None, scrape_method=None, request_rate=0.25, out_file=None, **options):
+        utils.configure(**options)
+
         self.config_file = config_file
         self.request_rate = request_rate
         self.scrape_index = IndexScraper(self.request_rate)
 
-        if out_file is not None and not out_file.endswith('.json'):
-            print(f'[ERROR] \'{out_file}\' is invalid for JSON output. out_file should end in \'.json\'')
+        if out_file is not None and not (out_file.endswith('.json') or streams.is_jsonl(out_file)):
+            print(f'[ERROR] \'{out_file}\' is invalid for JSON output. out_file should end in \'.json\', \'.jsonl\' or \'.jsonl.gz\'')
             sys.exit()
 
         self.out_file = out_file
@@ -183,6 +426,8 @@ class Pipeline(object):
             self.scrape_content = DOMScraper(self.request_rate)
         elif self.scrape_method is ContentScrapeMethod.RecipeAPI:
             self.scrape_content = APIScraper(self.request_rate, request_verb=utils.RequestVerb.POST, res_callback=self._handle_augmentation_response)
+        elif self.scrape_method is ContentScrapeMethod.StructuredData:
+            self.scrape_content = RecipeScraper(self.request_rate)
         else:
             print(f'[ERROR] \'self.scrape_method\' not set or invalid ({self.scrape_method})')
             sys.exit()
@@ -190,23 +435,176 @@ class Pipeline(object):
         print(f'Initialized Pipeline. config_file: {self.config_file}. scrape_method: {self.scrape_method}.')
 
     def run(self):
-        config_df = self._config_file_to_df()
-        config_df = self._scrape_index(config_df)
-        config_df = self._scrape_content_async(config_df)
+        # options were set in `__init__`
+        with utils.command(self.out_file):
+            config_df = self._config_file_to_df()
+            rows = [row for i, row in config_df.iterrows()]
+
+            start = time.time()
+            # TODO: do we want all original config columns in the output? thinking it could be good for debugging failed scrapes...
+            # e.g., maybe 'content_selectors' only output if DOM scrape happened
+            with streams.RecordWriter(self.out_file, columns=['content_url', 'content'] + list(config_df.columns)) as writer:
+                if utils.get_option('backend') == 'async':
+                    hosts = asyncio.run(self._run_pipeline_async(rows, writer))
+                else:
+                    hosts = self._run_pipeline(rows, writer)
+
+        end = time.time()
+        print(f'{writer.count} content urls scraped in {end-start:.2f}s.')
+        utils.host_limiter().report(hosts)
 
-        if self.out_file is None:
-            print(config_df)
+        if self.out_file is not None:
+            print(f'Scrape results saved to {self.out_file}')
+
+    def _run_pipeline(self, rows, writer):
+        '''Index workers push content urls through a bounded queue; the parent hands them to content workers as they
+        arrive, keeping at most `queue_size` in flight, and writes results as they come back.
+        '''
+        queue_size = utils.get_option('queue_size')
+        num_processes = len(rows) # num processes == num unique site indices == num rows
+
+        manager = multiprocessing.Manager()
+        discovered = manager.Queue(maxsize=queue_size)
+        done = queue.Queue()
+        in_flight = threading.Semaphore(queue_size)
+        hosts = set(urlparse(row.index_url).hostname for row in rows)
+
+        index_pool = utils.worker_pool(num_processes)
+        content_pool = utils.worker_pool(num_processes)
+
+        # an index task that fails never sends its end-of-row sentinel: send it here, and fail the run once the other
+        # rows are written
+        index_errors = []
+        def on_index_error(e):
+            index_errors.append(e)
+            # from a thread of its own: the queue may be full, and this runs on the thread delivering the content
+            # results that let the loop below drain it
+            threading.Thread(target=discovered.put, args=(None,), daemon=True).start()
+
+        print(f'Executing pipelined index and content scrape across max {num_processes} + {num_processes} processes')
+        for i, row in enumerate(rows):
+            index_pool.apply_async(self._scrape_index_to_queue, (i, row.index_url, row.href_selector, row.pagination, discovered),
+                                   error_callback=on_index_error)
+
+        def on_done(i, content_url, content):
+            in_flight.release()
+            done.put((i, content_url, content))
+
+        def on_error(i, content_url, e):
+            print(f'[WARNING] Exception thrown - skipping {content_url}')
+            print(e)
+            on_done(i, content_url, None)
+
+        producing = len(rows)
+        dispatched = 0
+        written = 0
+        while producing or written < dispatched:
+            if producing:
+                item = discovered.get()
+                if item is None:
+                    producing -= 1
+                    continue
+
+                i, content_url = item
+                scraper, request_url, args = self._content_request(rows[i], content_url)
+                hosts.add(urlparse(request_url).hostname)
+
+                in_flight.acquire()
+                content_pool.apply_async(scraper.scrape_url, (request_url, 1, *args),
+                    callback=lambda content, i=i, u=content_url: on_done(i, u, content),
+                    error_callback=lambda e, i=i, u=content_url: on_error(i, u, e))
+                dispatched += 1
+            else:
+                self._write_content(writer, rows, *done.get())
+                written += 1
+                continue
+
+            while not done.empty():
+                self._write_content(writer, rows, *done.get())
+                written += 1
+
+        index_pool.close()
+        content_pool.close()
+        manager.shutdown()
+
+        if index_errors:
+            raise index_errors[0]
+
+        return hosts
+
+    def _scrape_index_to_queue(self, i, index_url, href_selector, pagination_options, discovered):
+        index_urls = self.scrape_index.index_urls(index_url, pagination_options)
+        utils.metrics().submitted(len(index_urls))
+        for i_url in index_urls:
+            for content_url in self.scrape_index.scrape_url(i_url, 1, href_selector):
+                utils.metrics().submitted()
+                discovered.put((i, content_url)) # blocks while the content workers are behind
+        # on failure, the parent sends this (see `_run_pipeline`)
+        discovered.put(None)
+
+    async def _run_pipeline_async(self, rows, writer):
+        queue_size = utils.get_option('queue_size')
+        concurrency = utils.get_option('concurrency')
+        runner = async_scraper.Runner(concurrency, utils.get_option('host_concurrency'))
+        discovered = asyncio.Queue(maxsize=queue_size)
+        hosts = set(urlparse(row.index_url).hostname for row in rows)
+
+        print(f'Executing pipelined async index and content scrape with max {concurrency} concurrent requests')
+
+        async def produce(i, row):
+            index_urls = await runner.call(urlparse(row.index_url).hostname, self.scrape_index.index_urls, row.index_url, row.pagination)
+            utils.metrics().submitted(len(index_urls))
+            for i_url in index_urls:
+                for content_url in await runner.scrape(self.scrape_index, i_url, 1, row.href_selector):
+                    utils.metrics().submitted()
+                    await discovered.put((i, content_url)) # waits while the content workers are behind
+
+        async def consume():
+            while True:
+                item = await discovered.get()
+                if item is None:
+                    return
+
+                i, content_url = item
+                scraper, request_url, args = self._content_request(rows[i], content_url)
+                hosts.add(urlparse(request_url).hostname)
+                content = await runner.scrape(scraper, request_url, 1, *args)
+                self._write_content(writer, rows, i, content_url, content)
+
+        consumers = [asyncio.ensure_future(consume()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*[produce(i, row) for i, row in enumerate(rows)])
+            for _ in consumers:
+                await discovered.put(None)
+            await asyncio.gather(*consumers)
+        finally:
+            runner.close()
+
+        return hosts
+
+    def _write_content(self, writer, rows, i, content_url, content):
+        writer.write({'content_url': content_url, 'content': content, **rows[i].to_dict()})
+
+    def _content_request(self, row, content_url):
+        '''(scraper, url, args) to scrape the content of one content url of a config row
+        '''
+        if self.scrape_method is ContentScrapeMethod.DOM:
+            return (self.scrape_content, content_url, (row.content_selectors, 'text'))
+        elif self.scrape_method is ContentScrapeMethod.RecipeAPI:
+            return (self.scrape_content, self._construct_augmentation_url(content_url), ())
+        elif self.scrape_method is ContentScrapeMethod.StructuredData:
+            # rows without content selectors have a NaN there
+            content_selectors = row.get('content_selectors')
+            return (self.scrape_content, content_url, (content_selectors if isinstance(content_selectors, list) else None,))
         else:
-            self._config_df_to_file(config_df)
+            print(f'[ERROR] \'self.scrape_method\' not set or invalid ({self.scrape_method})')
+            sys.exit()
 
     def _config_file_to_df(self):
         try:
             with open(self.config_file) as f:
                 config_df = pd.read_json(f)
                 print(f'{len(config_df.index)} sites found in {self.config_file}.')
-                if self.out_file is not None:
-                    # get columns from original config_file for file output later
-                    self.original_columns = list(config_df.columns)
         except TypeError as e:
             print(f'[ERROR] No config file provided to IndexScraper. {USAGE_HELP}')
             print(e)
@@ -214,25 +612,8 @@ class Pipeline(object):
 
         return config_df
 
-    def _config_df_to_file(self, config_df):
-        if self.out_file is not None:
-            file_rows = []
-
-            for row in config_df.itertuples(index=True):
-                scraped_vals = zip(row.content_urls, row.content)
-                for content_url, content in scraped_vals:
-                    # TODO: do we want all original_columns in the output? thinking it could be good for debugging failed scrapes...
-                    # e.g., maybe 'content_selectors' only output if DOM scrape happened
-                    new_row = tuple([content_url, content] + [getattr(row, column) for column in self.original_columns])
-                    file_rows.append(new_row)
-
-            file_df = pd.DataFrame.from_records(file_rows, columns=['content_url', 'content'] + self.original_columns)
-            file_df.to_json(self.out_file, orient='records')
-
-            print(f'Scrape results saved to {self.out_file}')
-
     def _construct_augmentation_url(self, url):
-        return f'https://www.onenote.com/onaugmentation/clipperextract/v1.0/?renderMethod=extractAggressive&url={url}&lang=en-US'
+        return f'{AUGMENTATION_API_URL}?renderMethod=extractAggressive&url={url}&lang=en-US'
 
     def _handle_augmentation_response(self, **kwargs):
         if kwargs is None:
@@ -247,14 +628,16 @@ class Pipeline(object):
 
         response_text = res.text
 
-        response_json = json.loads(response_text)[0] # always a list of 1 object
+        with tracing.span('parse', url=url):
+            response_json = json.loads(response_text)[0] # always a list of 1 object
         content_model = response_json['ContentModel']
         if content_model is not 0: # 0 is None
-            html = response_json['ContentInHtml']
-            html = self._strip_api_metadata(html)
-            h = html2text.HTML2Text()
-            h.ignore_links = True
-            content = h.handle(html)
+            with tracing.span('extract', url=url):
+                html = response_json['ContentInHtml']
+                html = self._strip_api_metadata(html)
+                h = html2text.HTML2Text()
+                h.ignore_links = True
+                content = h.handle(html)
 
             if content_model is not 4: # 4 is Recipe
                 print(f'[WARNING] {url} content extracted using non-recipe model ({content_model})')
@@ -264,65 +647,22 @@ class Pipeline(object):
         return content
 
     def _strip_api_metadata(self, html):
-        soup = BeautifulSoup(html, "html.parser")
-
-        for metadata in soup.select('.Metadata'):
-            metadata.decompose()
+        parser = parsers.get(utils.get_option('parser'))
+        soup = parser.parse_fragment(html)
 
-        for thumbnail in soup.select('.Thumbnail'):
-            thumbnail.decompose()
+        for metadata in parser.select(soup, '.Metadata'):
+            parser.remove(metadata)
 
-        for header in soup.select('.IngredientsContainer h2'):
-            header.decompose()
+        for thumbnail in parser.select(soup, '.Thumbnail'):
+            parser.remove(thumbnail)
 
-        for header in soup.select('.InstructionsContainer h2'):
-            header.decompose()
-
-        return str(soup)
-
-    def _scrape_index(self, config_df):
-        start = time.time()
-
-        index_scrape_configs = list(zip(config_df.index_url, config_df.href_selector, config_df.pagination))
-        config_df = config_df.assign(content_urls=lambda x:None)
-        config_df.content_urls = self.scrape_index.run(index_scrape_configs)
-
-        end = time.time()
-        print(f'{sum([len(row) for row in config_df.content_urls])} content urls scraped in {end-start:.2f}s.')
-
-        return config_df
+        for header in parser.select(soup, '.IngredientsContainer h2'):
+            parser.remove(header)
 
-    def _scrape_content_async(self, config_df):
-        # TODO: Pool can't handle KeyboardInterrupt on Windows... https://stackoverflow.com/a/35134329 :(
-
-        start = time.time()
-        num_processes = len(config_df.index) # num processes == num unique site indices == num rows
-        pool = Pool(processes=num_processes)
-
-        print(f'Executing content scrape across max {num_processes} processes')
-        async_results = [pool.apply_async(self._scrape_content_by_row, (row,)) for i, row in config_df.iterrows()]
-        pool_results = [res.get() for res in async_results] # `get` is a blocking call
-        pool.close()
-
-        config_df = pd.DataFrame.from_records(pool_results)
-
-        end = time.time()
-        # only counting content that is not None
-        print(f'{sum([sum(1 for _ in filter(None.__ne__, row)) for row in config_df.content])} pieces of content scraped in {end-start:.2f}s.')
-
-        return config_df
-
-    def _scrape_content_by_row(self, row):
-        if self.scrape_method is ContentScrapeMethod.DOM:
-            content = self.scrape_content.run(row.content_urls, row.content_selectors)
-        elif self.scrape_method is ContentScrapeMethod.RecipeAPI:
-            extract_urls = [self._construct_augmentation_url(url) for url in row.content_urls]
-            content = self.scrape_content.run(extract_urls)
-        else:
-            print(f'[ERROR] \'self.scrape_method\' not set or invalid ({self.scrape_method})')
-            sys.exit()
+        for header in parser.select(soup, '.InstructionsContainer h2'):
+            parser.remove(header)
 
-        return row.append(pd.Series([content], index=['content']))
+        return parser.fragment_to_html(soup)
 
 if __name__ == '__main__':
     import fire; fire.Fire(Pipeline)
@@ -0,0 +1,61 @@
+'''Persistent search query -> top hit cache for `reviews.extern_song_ids`, shared by every search provider.
+
+Queries are keyed by their normalized form (`normalize`), so songs whose queries differ only in case,
+spacing or accents share one search. The cache is a JSON Lines file of resolved searches, one line
+per (provider, query), appended as soon as a search resolves; later lines win when it is loaded:
+
+    {"provider": "spotify", "query": "song 1 artist 1", "id": "4uLU6hMCjMI75M1A2tKUQC"}
+
+Only hits are kept: a search that found nothing is tried again next run.
+'''
+
+import files
+import json
+import os
+import unicodedata
+
+def normalize(query):
+    '''The cache key of a search query.
+
+        >>> normalize('  Song 1 (Remix)   Art ist ')
+        'song 1 (remix) art ist'
+        >>> normalize('Beyoncé') == normalize('BEYONCE\\u0301')
+        True
+    '''
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+class SearchCache():
+    def __init__(self, path):
+        self.path = path
+        self.hits = {}
+        self.file = None
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in files.complete_lines(f):
+                    entry = json.loads(line)
+                    self.hits[(entry['provider'], entry['query'])] = entry['id']
+
+    def __len__(self):
+        return len(self.hits)
+
+    def get(self, provider, key):
+        return self.hits.get((provider, key))
+
+    def put(self, provider, key, id):
+        if self.hits.get((provider, key)) == id:
+            return
+
+        self.hits[(provider, key)] = id
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        files.append(self.file, json.dumps({'provider': provider, 'query': key, 'id': id}) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
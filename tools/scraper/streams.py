@@ -0,0 +1,202 @@
+'''Streaming record input and output for the CLI commands.
+
+Input files (`bloglist_file`, `songids_file`, ...) may be JSON arrays or JSON Lines (optionally gzip-compressed);
+either way they are read incrementally and handed to the scrapers in bounded chunks, so fetching starts right away
+and inputs never have to fit in memory.
+
+The output format follows the `out_file` extension:
+    - `.jsonl` / `.jsonl.gz`: JSON Lines, each record appended (and flushed) as soon as it is produced,
+      so the file is readable while the job is still running and memory stays flat
+    - anything else (e.g. `.json`): one JSON array, as written by `DataFrame.to_json(orient='records')`
+    - no `out_file`: the JSON array is printed to stdout
+'''
+
+import gzip
+from io import StringIO
+from itertools import islice
+import json
+import numpy as np
+import pandas as pd
+import tracing
+
+JSONL_EXTENSIONS = ('.jsonl', '.jsonl.gz')
+
+# bytes read from an input file at a time
+READ_SIZE = 1 << 16
+
+def is_jsonl(out_file):
+    return out_file is not None and out_file.endswith(JSONL_EXTENSIONS)
+
+def _open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+
+    return open(path, encoding='utf-8')
+
+def read_records(path):
+    '''Yield the records of a JSON array or JSON Lines file one at a time.
+
+        >>> import tempfile
+        >>> f = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        >>> _ = f.write('[{"url": "a"}, "b", 12, [1, 2]]'); f.close()
+        >>> list(read_records(f.name))
+        [{'url': 'a'}, 'b', 12, [1, 2]]
+    '''
+    with _open_text(path) as f:
+        if is_jsonl(path):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        yield from _iter_json_array(f)
+
+def _iter_json_array(f):
+    decoder = json.JSONDecoder()
+    buf = f.read(READ_SIZE).lstrip()
+    eof = False
+
+    if not buf.startswith('['):
+        raise ValueError(f'{f.name} is neither a JSON array nor JSON Lines')
+    buf = buf[1:]
+
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if buf.startswith(']'):
+            return
+
+        try:
+            record, end = decoder.raw_decode(buf)
+            # a scalar ending exactly at the end of the buffer (e.g. a number) may continue in the next read
+            complete = eof or end < len(buf)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+
+        if complete:
+            yield record
+            buf = buf[end:]
+            continue
+
+        more = f.read(READ_SIZE)
+        eof = not more
+        buf += more
+
+def read_json_chunks(path, chunk_size, dtype=None):
+    '''Yield DataFrames of up to `chunk_size` records from a JSON array or JSON Lines file.
+    Each chunk is built by `pd.read_json`, which infers column types from that chunk alone: an integer column
+    with a null in some chunks comes out as floats in those chunks only. `dtype` (as for `pd.read_json`)
+    fixes the type of the columns it names in every chunk.
+
+        >>> import tempfile
+        >>> f = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        >>> _ = f.write('[{"id": 1}, {"id": null}, {"id": 3}, {"id": 4}]'); f.close()
+        >>> [list(df.id) for df in read_json_chunks(f.name, 2)]
+        [[1.0, nan], [3, 4]]
+        >>> [list(df.id) for df in read_json_chunks(f.name, 2, dtype={'id': 'Int64'})]
+        [[1, <NA>], [3, 4]]
+    '''
+    if dtype is None:
+        dtype = True
+
+    records = read_records(path)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+
+        yield pd.read_json(StringIO(json.dumps(chunk)), dtype=dtype)
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+def _clean(record):
+    # NaN (or a nullable column's NA) is not valid JSON: write null like `DataFrame.to_json` does
+    return {k: (None if v is pd.NA or (isinstance(v, float) and v != v) else v) for k, v in record.items()}
+
+class RecordWriter():
+    '''Write output records one at a time:
+
+        with streams.RecordWriter(out_file) as writer:
+            for record in records:
+                writer.write(record)
+
+    A JSON array is only written when the block completes without an exception;
+    JSON Lines output keeps every record written so far.
+    '''
+    def __init__(self, out_file, columns=None):
+        self.out_file = out_file
+        self.columns = columns
+        self.count = 0
+        self.records = None
+        self.frames = None
+        self.file = None
+
+        if is_jsonl(out_file):
+            if out_file.endswith('.gz'):
+                self.file = gzip.open(out_file, 'wt', encoding='utf-8')
+            else:
+                self.file = open(out_file, 'w', encoding='utf-8')
+        else:
+            self.records = []
+            self.frames = []
+
+    def write(self, record):
+        self.count += 1
+
+        if self.file is None:
+            self.records.append(record)
+            return
+
+        with tracing.span('serialize'):
+            self.file.write(json.dumps(_clean(record), default=_json_default))
+            self.file.write('\n')
+            # for gzip, a sync flush: everything written so far can be decompressed while the job runs
+            self.file.flush()
+
+    def write_df(self, df):
+        if self.file is None:
+            # JSON arrays are written by pandas anyway: keep the frame as is
+            self.count += len(df.index)
+            self.frames.append(df)
+            return
+
+        for record in df.to_dict(orient='records'):
+            self.write(record)
+
+    def close(self, complete=True):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        elif self.records is not None and complete:
+            with tracing.span('serialize', records=self.count):
+                frames = self.frames
+                if self.records or not frames:
+                    frames = frames + [pd.DataFrame.from_records(self.records, columns=self.columns)]
+                df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+                if self.out_file is not None:
+                    df.to_json(self.out_file, orient='records')
+                else:
+                    print(df.to_json(orient='records'))
+
+        self.records = None
+        self.frames = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,239 @@
+'''Host-keyed token-bucket rate limiting shared across processes and threads.
+
+A single `HostRateLimiter` is created once per run (see `utils.host_limiter`) and handed
+to every pool worker, so limits hold for the whole run instead of per request or per process.
+Buckets live in shared memory, one per host (a `host_table.HostTable` of up to `max_hosts` hosts): one host's
+AIMD cuts and pauses never hold back another. A bucket refills at the lowest rate asked for its host; hosts past
+`max_hosts` share one bucket (and so one budget).
+
+Rates adapt to what each host tells us (AIMD): a throttled response (429, or a `Retry-After` /
+`X-RateLimit-*` header saying the quota is spent) halves the host's rate and pauses it until the
+indicated time (at most `max_pause` seconds ahead); every clean response adds back a little, up to `max_scale`
+times the requested rate.
+'''
+
+from email.utils import parsedate_to_datetime
+import host_table
+import time
+
+# AIMD defaults: multiplicative decrease on throttling, additive increase per clean response
+DECREASE = 0.5
+INCREASE = 0.02
+MIN_SCALE = 1 / 64
+
+# seconds: the longest pause a host's `Retry-After` (or rate limit reset) is honoured for
+MAX_PAUSE = 300
+
+# fields stored per host in the shared table
+_TOKENS, _UPDATED, _RATE, _BURST, _COUNT, _FIRST, _LAST, _WAITED, _SCALE, _THROTTLED, _LIMIT = range(11)
+_NUM_FIELDS = 11
+
+def retry_after(headers, now=None):
+    '''Seconds until a host will accept requests again, from its `Retry-After` header
+    (delay seconds or an HTTP date) or from an exhausted `X-RateLimit-Remaining` / `RateLimit-Remaining`
+    quota with its `*-Reset` header (delay seconds or a unix timestamp). None if the headers don't say.
+
+        >>> retry_after({'Retry-After': '3'})
+        3.0
+        >>> retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:05 GMT'}, now=1445412480)
+        5.0
+        >>> retry_after({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1445412490'}, now=1445412480)
+        10.0
+        >>> retry_after({'X-RateLimit-Remaining': '7', 'X-RateLimit-Reset': '60'}) is None
+        True
+    '''
+    now = time.time() if now is None else now
+
+    value = headers.get('Retry-After')
+    if value is None:
+        for prefix in ('X-RateLimit-', 'RateLimit-'):
+            if headers.get(f'{prefix}Remaining', '').strip() == '0':
+                value = headers.get(f'{prefix}Reset')
+                break
+    if value is None:
+        return None
+
+    try:
+        seconds = float(value)
+        # large values are timestamps rather than delays
+        if seconds > 1e9:
+            seconds -= now
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - now
+        except (TypeError, ValueError):
+            return None
+
+    return max(0.0, seconds)
+
+class HostRateLimiter():
+    '''Token buckets, one per host, in shared memory.
+
+    `rate` arg: n for n calls per second (ex. 3 means 3 calls per second)
+    1/n for n seconds per call (ex. 0.25 means 4 seconds in between calls)
+    `burst` arg: number of calls that may go out back-to-back after an idle period
+    `max_scale` arg: how far above `rate` clean responses may push a host's actual rate (1: `rate` is a ceiling)
+    `max_pause` arg: the longest a host is paused for, whatever it asks
+    `max_hosts` arg: hosts that get a bucket of their own
+
+        >>> limiter = HostRateLimiter()
+        >>> limiter.reserve('example.com', rate=2, burst=2)
+        0.0
+        >>> limiter.reserve('example.com', rate=2, burst=2)
+        0.0
+        >>> round(limiter.reserve('example.com', rate=2, burst=2), 1)
+        0.5
+        >>> limiter.stats('example.com')['count']
+        3
+        >>> limiter.throttled('example.com', 0)
+        >>> limiter.stats('example.com')['scale']
+        0.5
+        >>> limiter.succeeded('example.com'); round(limiter.stats('example.com')['scale'], 2)
+        0.52
+        >>> limiter.throttled('example.com', 86400); limiter.reserve('example.com', rate=2, burst=2) < 310 # max_pause (300s) and a turn
+        True
+
+    Each host has a bucket of its own: a host pausing us doesn't hold back others.
+
+        >>> limiter.throttled('dead.example.com', 60)
+        >>> limiter.reserve('alive.example.com', rate=2)
+        0.0
+    '''
+    def __init__(self, adaptive=True, max_scale=1.0, max_pause=MAX_PAUSE, max_hosts=host_table.MAX_HOSTS):
+        self.adaptive = adaptive
+        self.max_scale = max_scale
+        self.max_pause = max_pause
+        self.table = host_table.HostTable(_NUM_FIELDS, max_hosts)
+        self.lock = self.table.lock
+        self.slots = self.table.slots
+
+    def _offset(self, host):
+        return self.table.offset(host)
+
+    def reserve(self, host, rate, burst=1):
+        '''Take a token from the bucket for `host`.
+        Returns the number of seconds the caller must wait before sending; the token is already
+        spoken for, so callers wait without holding the lock (and concurrent callers queue up behind it).
+        '''
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        burst = max(1, burst)
+
+        with self.lock:
+            o = self._offset(host)
+            s = self.slots
+            now = time.time()
+
+            if s[o + _SCALE] == 0:
+                s[o + _SCALE] = 1.0
+            # the host's budget is the lowest rate asked for it
+            if s[o + _LIMIT] == 0 or rate < s[o + _LIMIT]:
+                s[o + _LIMIT] = rate
+            rate = s[o + _LIMIT] * s[o + _SCALE]
+
+            updated = s[o + _UPDATED]
+            if updated == 0:
+                tokens = burst
+                updated = s[o + _FIRST] = now
+            elif updated < now:
+                tokens = min(burst, s[o + _TOKENS] + (now - updated) * rate)
+                updated = now
+            else:
+                # the host is paused: the bucket only starts refilling at `updated`
+                tokens = s[o + _TOKENS]
+
+            tokens -= 1
+            wait = (updated - now) + (-tokens / rate if tokens < 0 else 0.0)
+
+            s[o + _TOKENS] = tokens
+            s[o + _UPDATED] = updated
+            s[o + _RATE] = rate
+            s[o + _BURST] = burst
+            s[o + _COUNT] += 1
+            s[o + _LAST] = now + wait
+            s[o + _WAITED] += wait
+
+        return wait
+
+    def acquire(self, host, rate, burst=1):
+        '''Block until a request to `host` may be sent. Returns the time spent waiting.
+        '''
+        wait = self.reserve(host, rate, burst)
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    def throttled(self, host, pause=None):
+        '''The host throttled us: cut its rate (multiplicative decrease) and, if it said for how long,
+        let nothing through before `pause` seconds from now.
+        '''
+        with self.lock:
+            o = self._offset(host)
+            s = self.slots
+            s[o + _THROTTLED] += 1
+            if self.adaptive:
+                s[o + _SCALE] = max(MIN_SCALE, (s[o + _SCALE] or 1.0) * DECREASE)
+            if pause:
+                self._pause(o, time.time() + pause)
+
+    def paused(self, host, pause):
+        '''The host's quota is spent (but this response was fine): let nothing through before `pause` seconds from now.
+        '''
+        with self.lock:
+            self._pause(self._offset(host), time.time() + pause)
+
+    def _pause(self, o, until):
+        s = self.slots
+        now = time.time()
+        until = min(until, now + self.max_pause)
+        if s[o + _UPDATED] == 0:
+            s[o + _FIRST] = now
+            tokens = 0.0
+        else:
+            tokens = min(0.0, s[o + _TOKENS] + (now - s[o + _UPDATED]) * s[o + _RATE])
+
+        # an empty bucket as of `until`: callers wait for it, then take turns at the host's rate
+        if until > s[o + _UPDATED]:
+            s[o + _TOKENS] = tokens
+            s[o + _UPDATED] = until
+
+    def succeeded(self, host):
+        '''A clean response from the host: raise its rate a little (additive increase).
+        '''
+        if not self.adaptive:
+            return
+
+        with self.lock:
+            o = self._offset(host)
+            scale = self.slots[o + _SCALE] or 1.0
+            self.slots[o + _SCALE] = min(self.max_scale, scale + INCREASE) if scale < self.max_scale else scale
+
+    def stats(self, host):
+        with self.lock:
+            o = self._offset(host)
+            count, first, last = self.slots[o + _COUNT], self.slots[o + _FIRST], self.slots[o + _LAST]
+            rate, burst, waited = self.slots[o + _RATE], self.slots[o + _BURST], self.slots[o + _WAITED]
+            scale, throttled = self.slots[o + _SCALE] or 1.0, self.slots[o + _THROTTLED]
+
+        # achieved rate is measured between the first and last send times;
+        # a lone request has no interval to measure
+        achieved = (count - 1) / (last - first) if count > 1 and last > first else None
+
+        return {'count': int(count), 'target_rate': rate, 'burst': int(burst), 'achieved_rate': achieved, 'waited': waited,
+                'scale': scale, 'throttled': int(throttled)}
+
+    def report(self, hosts):
+        for host in sorted(set(hosts)):
+            stats = self.stats(host)
+            if not stats['count']:
+                continue
+
+            achieved = f'{stats["achieved_rate"]:.2f}/s' if stats['achieved_rate'] is not None else 'n/a'
+            throttled = f'; throttled {stats["throttled"]} times' if stats['throttled'] else ''
+            print(f'{host}: {stats["count"]} requests; achieved {achieved} of target {stats["target_rate"]:g}/s '
+                  f'(burst {stats["burst"]}); {stats["waited"]:.2f}s spent waiting{throttled}')
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
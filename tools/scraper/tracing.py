@@ -0,0 +1,164 @@
+'''Opt-in tracing and profiling of where a run's time goes.
+
+With the `trace_file` option, every process of the run records spans - per url and per stage - and the
+command merges them into one Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev):
+    - `scrape`: one url, end to end (`Scraper.scrape_url`)
+    - `fetch`: one request, retries and fallbacks included, made of
+        - `rate-wait`: waiting on the host's rate limiter
+        - `connect`: from sending the request until the response headers are in (connection setup and server time)
+        - `download`: reading the response body
+    - `parse`: turning a response into a document (HTML, JSON)
+    - `extract`: pulling content out of a document (selectors, html2text, language detection...)
+    - `serialize`: writing records out
+Each span carries its process and thread ids, so pool workers show up as separate rows.
+
+With the `profile_dir` option, each process (the main one and every pool worker) also runs cProfile
+and writes `<role>-<pid>.prof` there when it exits; read them with `python -m pstats` or snakeviz.
+cProfile only sees the thread that started it: with the `async` backend, profile the event loop's
+process as a whole with `trace_file` instead.
+
+Spans are no-ops unless tracing is enabled in the process (see `utils.start_tracing`).
+'''
+
+import cProfile
+import files
+import json
+import multiprocessing.util
+import os
+import shutil
+import signal
+import threading
+import time
+
+# this process's trace: spans are appended to <trace dir>/<pid>.jsonl (see `enable`)
+_trace_dir = None
+_role = None
+_file = None
+_file_pid = None
+_lock = threading.Lock()
+
+# this process's profiler (see `start_profile`)
+_profiler = None
+_profile_path = None
+
+def enable(trace_dir, role):
+    '''Record this process's spans (and those of processes it forks) into `trace_dir`
+    '''
+    global _trace_dir, _role
+    os.makedirs(trace_dir, exist_ok=True)
+    _trace_dir = trace_dir
+    _role = role
+
+def disable():
+    global _trace_dir, _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        _trace_dir = None
+        _file = None
+
+def enabled():
+    return _trace_dir is not None
+
+class _Span():
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event(self.name, self.start, time.time(), **self.args)
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **args):
+    '''Record the `with` block as a span:
+
+        with tracing.span('parse', url=url):
+            soup = BeautifulSoup(page, 'lxml')
+    '''
+    if _trace_dir is None:
+        return _NO_SPAN
+
+    return _Span(name, args)
+
+def event(name, start, end, **args):
+    '''Record a span from `start` to `end` (`time.time()` values), e.g. one measured after the fact
+    '''
+    if _trace_dir is None:
+        return
+
+    record = {'name': name, 'cat': 'url' if name == 'scrape' else 'stage', 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+              'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': args}
+    with _lock:
+        files.append(_out(), json.dumps(record) + '\n')
+
+def _out():
+    '''This process's trace file, opened on first use (forked processes open their own)
+    '''
+    global _file, _file_pid
+    if _file is None or _file_pid != os.getpid():
+        _file = open(files.process_path(_trace_dir), 'a')
+        _file_pid = os.getpid()
+        # name the process's row in the trace viewer
+        files.append(_file, json.dumps({'name': 'process_name', 'ph': 'M', 'pid': _file_pid, 'args': {'name': f'{_role} {_file_pid}'}}) + '\n')
+
+    return _file
+
+def merge(trace_dir, trace_file):
+    '''Merge the spans every process recorded into `trace_dir` into one Chrome trace file; removes `trace_dir`
+    '''
+    events = []
+    for name in sorted(os.listdir(trace_dir)):
+        with open(os.path.join(trace_dir, name)) as f:
+            for line in files.complete_lines(f):
+                events.append(json.loads(line))
+
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    shutil.rmtree(trace_dir, ignore_errors=True)
+
+    return len(events)
+
+def start_profile(profile_dir, role):
+    '''Profile this process with cProfile until it exits (or `stop_profile`), then write its stats into `profile_dir`
+    '''
+    global _profiler, _profile_path
+    if _profiler is not None:
+        # a forked process inherits its parent's profiler: replace it with its own
+        _profiler.disable()
+
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile_path = os.path.join(profile_dir, f'{role}-{os.getpid()}.prof')
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+    if role == 'worker':
+        # pool workers exit through multiprocessing's finalizers, or are terminated with SIGTERM when the pool is
+        multiprocessing.util.Finalize(None, stop_profile, exitpriority=100)
+        signal.signal(signal.SIGTERM, _stop_profile_and_exit)
+
+def stop_profile():
+    global _profiler
+    if _profiler is None:
+        return
+
+    _profiler.disable()
+    _profiler.dump_stats(_profile_path)
+    _profiler = None
+
+def _stop_profile_and_exit(signum, frame):
+    stop_profile()
+    os._exit(0)
@@ -1,38 +1,398 @@
 #!/usr/bin/python -u
 
-from bs4 import BeautifulSoup
+import async_scraper
+from collections import deque
+from contextlib import contextmanager
 from enum import Enum, auto
-from multiprocessing import Pool
-import numpy as np
-from rate_limited import rate_limited
+import executor as run_executor
+from itertools import chain, islice
+import fetch_policy
+import http_cache
+import journal as scrape_journal
+import metrics as run_metrics
+import os
+import parsers
 import requests
-from sys import stdout
-from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+import shutil
+import sys
+import threading
+import throttle
+import time
+import tracing
+from urllib.parse import urljoin, urlparse
+import warc
+
+# run-wide options, shared with every pool worker (see `configure` and `worker_pool`)
+_options = {
+    'burst': 1, # token bucket size per host: calls allowed back-to-back after an idle period
+    'adaptive_rate': True, # back off hosts that throttle us (429, Retry-After, X-RateLimit-*) and speed up again on clean responses
+    'max_rate_scale': 1, # how far above `request_rate` adaptive rates may climb (1: `request_rate` is a ceiling)
+    'max_retries': 5, # retries of a throttled or failed request (connection error, timeout, 5xx)
+    'max_hosts': 4096, # distinct hosts rate-limited (and counted in metrics) on their own; further hosts share one record
+    'max_pause': 300, # seconds: the longest `Retry-After` / rate limit reset waited for; a host asking for longer fails the request
+    'connect_timeout': 5, # seconds to wait for a connection
+    'read_timeout': 30, # seconds to wait for the server to send data
+    'backoff_base': 0.5, # seconds: retries of failed requests wait up to backoff_base * 2^attempt (with jitter)...
+    'backoff_max': 30, # ...but never more than this
+    'breaker_threshold': 3, # consecutive failures after which a host is skipped (circuit breaker)...
+    'breaker_cooldown': 300, # ...for this many seconds, before one probe request is let through
+    'keep_alive': True, # reuse connections; False sends `Connection: close` with every request
+    'pool_size': 10, # pooled connections kept per host
+    'host_pool_sizes': {}, # per-host overrides of `pool_size`, e.g. {'api.spotify.com': 20}
+    'backend': 'pool', # 'pool': a process per slice of urls; 'async': concurrent requests in one process
+    'concurrency': 100, # 'async' backend: max requests in flight
+    'host_concurrency': 8, # 'async' backend: max requests in flight per host
+    'cache_dir': None, # directory for the on-disk response cache; None disables caching
+    'cache_ttl': 7 * 24 * 60 * 60, # seconds a cached response is served without revalidation
+    'cache_max_bytes': 2 * 1024 ** 3, # size bound of the response cache
+    'queue_size': 100, # `Pipeline.run`: max content urls discovered by the index step but not yet scraped
+    'batch_size': 2, # 'pool' backend: urls handed to an idle worker at a time
+    'postprocess_processes': None, # workers for CPU-bound post-processing (e.g. html2text, langdetect); None: one per CPU
+    'postprocess_batch_size': 16, # records handed to a post-processing worker at a time
+    'chunk_size': 1000, # urls handed to the backend (or in flight, for 'pool') at a time; results are streamed out as they complete
+    'resume': True, # resume from the journal of a previous run with the same out_file; False starts over
+    'progress': True, # redraw one aggregated progress line while a command runs
+    'metrics_file': None, # JSON snapshot of the run's metrics, rewritten every `metrics_interval` seconds
+    'prometheus_file': None, # the same metrics in the Prometheus text format (e.g. for node_exporter's textfile collector)
+    'metrics_interval': 10, # seconds between writes of `metrics_file` / `prometheus_file`
+    'trace_file': None, # Chrome trace (JSON) of per-url, per-stage spans of every process; None disables tracing
+    'profile_dir': None, # directory for a cProfile profile of each process (main and pool workers); None disables profiling
+    'parser': 'lxml', # HTML parser for DOM scrapes: 'lxml' (lxml.html + cssselect, fast) or 'bs4' (BeautifulSoup); see `parsers`
+    'warc_dir': None, # directory to archive every response (and its request) to, as gzipped WARC files; None disables capture
+    'replay_dir': None, # directory of WARC files to answer every request from, with no network access; None fetches as usual
+}
+
+BACKENDS = ('pool', 'async')
+
+# bytes read at a time from streamed responses (see `_read_until`)
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# process-wide, host-keyed rate limiter (see `host_limiter`)
+_host_limiter = None
+
+# process-wide, host-keyed circuit breakers (see `circuit_breakers`)
+_circuit_breakers = None
+
+# this process's view of the on-disk response cache (see `response_cache`)
+_response_cache = None
+
+# this process's WARC writer and the pid that created it (see `warc_writer`)
+_warc_writer = None
+_warc_writer_pid = None
+
+# the WARC archives requests are replayed from (see `replay_archive`)
+_replay_archive = None
+
+# the run's metrics, and the main process's reporter of them (see `start_metrics`, `start_reporter`)
+_metrics = None
+_reporter = None
+
+# the run's worker processes, shared by all of its stages (see `worker_pool`)
+_executor = None
+
+# journal of completed scrapes for this run's out_file (see `start_journal`)
+_journal = None
+_journal_dir = None
+
+# guards lazy creation of the process-wide objects above and below against concurrent threads
+_create_lock = threading.Lock()
+
+# time each thread spent fetching (see `fetch_seconds`)
+_fetch_time = threading.local()
+
+# this worker's pooled HTTP session and the pid that created it (see `session`)
+_session = None
+_session_pid = None
+
+def configure(**options):
+    '''Set run-wide options. CLI commands pass their extra `--option=value` flags through here.
+    '''
+    unknown = set(options) - set(_options)
+    if unknown:
+        raise ValueError(f'unknown option(s): {", ".join(sorted(unknown))}; valid options are: {", ".join(sorted(_options))}')
+
+    if 'backend' in options and options['backend'] not in BACKENDS:
+        raise ValueError(f'backend must be one of: {", ".join(BACKENDS)}')
+
+    if 'parser' in options and options['parser'] not in parsers.PARSERS:
+        raise ValueError(f'parser must be one of: {", ".join(parsers.PARSERS)}')
+
+    _options.update(options)
+
+def get_option(name):
+    return _options[name]
 
-def print_progress(count, total, status=''):
-    """
-    Source: https://gist.github.com/vladignatyev/06860ec2040cb497f0f3
-    """
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
+def host_limiter():
+    '''The run's single `throttle.HostRateLimiter`; created on first use and inherited by pool workers.
+    '''
+    global _host_limiter
+    with _create_lock:
+        if _host_limiter is None:
+            _host_limiter = throttle.HostRateLimiter(adaptive=get_option('adaptive_rate'), max_scale=get_option('max_rate_scale'),
+                                                     max_pause=get_option('max_pause'), max_hosts=get_option('max_hosts'))
+
+    return _host_limiter
+
+def circuit_breakers():
+    '''The run's single `fetch_policy.CircuitBreakers`; created on first use and inherited by pool workers.
+    '''
+    global _circuit_breakers
+    with _create_lock:
+        if _circuit_breakers is None:
+            _circuit_breakers = fetch_policy.CircuitBreakers(get_option('breaker_threshold'), get_option('breaker_cooldown'))
+
+    return _circuit_breakers
+
+def metrics():
+    '''The run's single `metrics.Metrics`; created on first use and inherited by pool workers.
+    '''
+    global _metrics
+    with _create_lock:
+        if _metrics is None:
+            _metrics = run_metrics.Metrics(get_option('max_hosts'))
+
+    return _metrics
+
+def start_metrics():
+    '''Start collecting a command's metrics (see `start_reporter` for reporting them).
+    '''
+    global _metrics
+    finish_metrics()
+    _metrics = run_metrics.Metrics(get_option('max_hosts'))
+
+def start_reporter():
+    '''Start reporting the command's metrics from this (the main) process: the progress line and the `metrics_file` /
+    `prometheus_file` snapshots (see `metrics.Reporter`).
+    '''
+    global _reporter
+    _reporter = run_metrics.Reporter(metrics(), get_option('metrics_interval'), get_option('metrics_file'), get_option('prometheus_file'),
+                                     sys.stdout if get_option('progress') else None).start()
+
+def finish_metrics():
+    '''Stop reporting: draw the final progress line and write the final snapshots.
+    '''
+    global _reporter
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+
+def start_tracing():
+    '''Start tracing (`trace_file` option) and profiling (`profile_dir` option) a command, if enabled; pool workers
+    created afterwards trace and profile themselves too (see `tracing`).
+    '''
+    trace_file = get_option('trace_file')
+    if trace_file is not None:
+        # spans of an earlier, interrupted run
+        shutil.rmtree(_trace_dir(trace_file), ignore_errors=True)
+    _start_process_tracing('main')
+
+def finish_tracing():
+    '''Write this process's profile, and merge every process's spans into `trace_file`.
+    '''
+    tracing.stop_profile()
+    trace_file = get_option('trace_file')
+    if trace_file is not None and tracing.enabled():
+        tracing.disable()
+        count = tracing.merge(_trace_dir(trace_file), trace_file)
+        print(f'Trace of {count} spans saved to {trace_file}')
+
+def _trace_dir(trace_file):
+    return f'{trace_file}.spans'
+
+def _start_process_tracing(role):
+    if get_option('trace_file') is not None:
+        tracing.enable(_trace_dir(get_option('trace_file')), role)
+    if get_option('profile_dir') is not None:
+        tracing.start_profile(get_option('profile_dir'), role)
+
+def fetch_seconds():
+    '''Seconds the current thread has spent in `RequestRateLimiter.make_rate_limited_request` (waits and retries included)
+    '''
+    return getattr(_fetch_time, 'seconds', 0.0)
+
+def session():
+    '''This worker's keep-alive `requests.Session`, created on first use and kept for the worker's life.
+    Connections are pooled per host; a forked worker never reuses its parent's sockets.
+    '''
+    global _session, _session_pid
+    with _create_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session_pid = os.getpid()
+
+            pool_size = get_option('pool_size')
+            if get_option('backend') == 'async':
+                # the async backend's threads share this session: keep a connection for each request in flight
+                pool_size = max(pool_size, get_option('host_concurrency'))
+
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+
+            for host, pool_size in get_option('host_pool_sizes').items():
+                host_adapter = HTTPAdapter(pool_maxsize=pool_size)
+                _session.mount(f'http://{host}/', host_adapter)
+                _session.mount(f'https://{host}/', host_adapter)
+
+    return _session
+
+def response_cache():
+    '''This process's `http_cache.ResponseCache`, or None when the `cache_dir` option is not set.
+    '''
+    global _response_cache
+    if get_option('cache_dir') is None:
+        return None
+
+    with _create_lock:
+        if _response_cache is None:
+            _response_cache = http_cache.ResponseCache(get_option('cache_dir'), get_option('cache_ttl'), get_option('cache_max_bytes'))
+
+    return _response_cache
+
+def warc_writer():
+    '''This process's `warc.Writer`, or None unless the `warc_dir` option is set (and requests are not replayed).
+    '''
+    global _warc_writer, _warc_writer_pid
+    if get_option('warc_dir') is None or get_option('replay_dir') is not None:
+        return None
+
+    with _create_lock:
+        # a forked worker writes files of its own
+        if _warc_writer is None or _warc_writer_pid != os.getpid():
+            _warc_writer = warc.Writer(get_option('warc_dir'))
+            _warc_writer_pid = os.getpid()
+
+    return _warc_writer
+
+def replay_archive():
+    '''The run's `warc.Archive` of the `replay_dir` option's WARC files, or None when requests are not replayed.
+    Indexed once, on first use, and inherited by pool workers.
+    '''
+    global _replay_archive
+    if get_option('replay_dir') is None:
+        return None
 
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
+    with _create_lock:
+        if _replay_archive is None or _replay_archive.replay_dir != get_option('replay_dir'):
+            _replay_archive = warc.Archive(get_option('replay_dir'))
+            print(f'Replaying {len(_replay_archive)} archived responses from {get_option("replay_dir")}')
 
-    stdout.write('[%s] %s%s ...%s\r' % (bar, percents, '%', status))
-    if percents is 100.0:
-        stdout.write('\n')
-    stdout.flush()
+    return _replay_archive
+
+def start_journal(out_file):
+    '''Journal completed scrapes next to `out_file`, so rerunning the same command resumes
+    where it stopped instead of fetching everything again (see `journal.Journal`).
+    '''
+    global _journal, _journal_dir
+    if out_file is None:
+        return
+
+    _journal_dir = f'{out_file}.journal'
+    _journal = None
+
+    if not get_option('resume'):
+        scrape_journal.Journal(_journal_dir).remove()
+
+    if len(journal()):
+        print(f'Resuming from {_journal_dir}: {len(journal())} urls already scraped.')
+
+def journal():
+    '''This process's view of the run's `journal.Journal`, or None when the run is not journaled.
+    '''
+    global _journal
+    if _journal_dir is None:
+        return None
+
+    with _create_lock:
+        if _journal is None:
+            _journal = scrape_journal.Journal(_journal_dir)
+
+    return _journal
+
+def finish_journal():
+    '''Drop the journal once the command's out_file is written.
+    '''
+    global _journal, _journal_dir
+    if journal() is not None:
+        journal().remove()
+
+    _journal = None
+    _journal_dir = None
+
+def _init_worker(limiter, breakers, run_metrics, options, journal_dir, archive, cache):
+    global _host_limiter, _circuit_breakers, _metrics, _journal_dir, _replay_archive, _response_cache
+    _host_limiter = limiter
+    _circuit_breakers = breakers
+    _metrics = run_metrics
+    _journal_dir = journal_dir
+    _replay_archive = archive
+    _response_cache = cache
+    _options.update(options)
+    _start_process_tracing('worker')
+
+def start_executor():
+    '''Create the run's `executor.Executor`. Its fork server is forked here, so this comes before the command starts
+    threads (the metrics reporter's...), and after everything the workers inherit is set up.
+    '''
+    global _executor
+    finish_executor()
+    initargs = (host_limiter(), circuit_breakers(), metrics(), dict(_options), _journal_dir, replay_archive(), response_cache())
+    # not under `_create_lock`: the fork server (and so every worker) would inherit it locked
+    _executor = run_executor.Executor(_init_worker, initargs)
+
+def worker_pool(num_processes):
+    '''A lane of `num_processes` workers of the run's `executor.Executor`, taking tasks as a `Pool` would (`apply_async`,
+    `close`). The workers share this run's rate limiter, circuit breakers, metrics, options, journal, replayed
+    archives and response cache, and outlive the lane: the run's later stages reuse them (see `executor`).
+    '''
+    if _executor is None:
+        start_executor()
+
+    return _executor.lane(num_processes)
+
+def finish_executor():
+    '''Stop the run's worker processes, once their tasks are done; they write their profiles and spans as they exit,
+    so this comes before `finish_tracing`.
+    '''
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+@contextmanager
+def command(out_file, **options):
+    '''Run the `with` block as a CLI command writing `out_file`: set its options, journal, metrics and tracing up,
+    and tear them down (worker processes, metrics reporter, profiles and trace) when the block exits, even on an
+    exception. The journal is only dropped when the block completes, so a failed run resumes where it stopped.
+
+        with utils.command(out_file, **options):
+            ...
+    '''
+    configure(**options)
+    start_journal(out_file)
+    start_metrics()
+    start_tracing()
+    start_executor()
+    start_reporter()
+    try:
+        yield
+    finally:
+        finish_executor()
+        finish_metrics()
+        finish_tracing()
+    finish_journal()
 
 class Soup():
-    '''Static helper methods for working with BeautifulSoup
+    '''Static helper methods for parsing pages and selecting from them, with the `parser` option's backend
+    (lxml or BeautifulSoup: see `parsers`)
     '''
     @staticmethod
     def url_to_soup(url, request_rate, limit_warning=False):
         try:
-            rrl = RequestRateLimiterFactory(request_rate)()
+            rrl = RequestRateLimiter(request_rate)
             if limit_warning:
-                print(f'[WARNING] rate_limited url_to_soup(): max_per_Second:{request_rate}')
+                print(f'[WARNING] requests limited to {request_rate}/s per host')
             res = rrl.make_rate_limited_request(url)
 
             if res.status_code is not 200:
@@ -46,7 +406,8 @@ class Soup():
             return None
 
         try:
-            soup = BeautifulSoup(page, 'lxml')
+            with tracing.span('parse', url=url):
+                soup = parsers.get(get_option('parser')).parse(page)
         except Exception as e:
             print(f'[WARNING] Failed to parse {url}')
             print(e)
@@ -58,12 +419,14 @@ class Soup():
     def soup_to_index(url, soup, href_selector):
         content_urls = []
 
-        urls = soup.select(href_selector)
-        for u in urls:
-            # urljoin here ensures we always have an absolute URL:
-            # it treats the first URL as the default for all unspecified parts of the second URL;
-            # if the second URL is already absolute, it just uses that one
-            content_urls.append(urljoin(url, u.attrs['href']))
+        with tracing.span('extract', url=url):
+            parser = parsers.of(soup)
+            urls = parser.select(soup, href_selector)
+            for u in urls:
+                # urljoin here ensures we always have an absolute URL:
+                # it treats the first URL as the default for all unspecified parts of the second URL;
+                # if the second URL is already absolute, it just uses that one
+                content_urls.append(urljoin(url, parser.attr(u, 'href')))
 
         if len(content_urls) is 0:
             print(f'[WARNING] No content urls found for {url}')
@@ -74,13 +437,15 @@ class Soup():
     def soup_to_content(url, soup, content_selectors, select_prop='text'):
         content = {}
 
-        for selector in content_selectors:
-            select = soup.select(selector)
-            if len(select) > 0:
-                content[selector] = '\n'.join([s[select_prop] for s in select])
-            else:
-                print(f'[WARNING] Failed to select content with selector {selector} for url {url}')
-                content[selector] = ''
+        with tracing.span('extract', url=url):
+            parser = parsers.of(soup)
+            for selector in content_selectors:
+                select = parser.select(soup, selector)
+                if len(select) > 0:
+                    content[selector] = '\n'.join([parser.attr(s, select_prop) for s in select])
+                else:
+                    print(f'[WARNING] Failed to select content with selector {selector} for url {url}')
+                    content[selector] = ''
 
         return '\n'.join(content.values())
 
@@ -88,25 +453,198 @@ class RequestVerb(Enum):
     GET = auto()
     POST = auto()
 
-def RequestRateLimiterFactory(rate):
+class RequestRateLimiter():
+    '''Make requests paced by the run's shared, host-keyed token bucket, handling failures as `policy`
+    (a `fetch_policy.Policy`) says.
+    '''
     # if needed: https://www.charlesproxy.com/documentation/using-charles/ssl-certificates
-    class RequestRateLimiter:
-        # `rate` arg: n for n calls per second  (ex. 3 means 3 calls per second)
-        # 1/n for n seconds per call (ex. 0.25 means 4 seconds in between calls)
-        @rate_limited(rate)
-        def make_rate_limited_request(self, url, verb=RequestVerb.GET, data=None, headers=None):
-            base_header = {'User-Agent': 'iconix', 'Connection': 'close', 'cache-control': 'no-cache'}
-            if headers is not None:
-                headers = {**base_header, **headers}
-            else:
-                headers = base_header
-
-            if verb is RequestVerb.POST:
-                return requests.post(url, data=data, headers=headers, allow_redirects=True)
-            else:
-                return requests.get(url, headers=headers, allow_redirects=True)
-
-    return RequestRateLimiter
+
+    # `rate` arg: n for n calls per second  (ex. 3 means 3 calls per second)
+    # 1/n for n seconds per call (ex. 0.25 means 4 seconds in between calls)
+    def __init__(self, rate, burst=None, policy=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else get_option('burst')
+        self.policy = policy if policy is not None else fetch_policy.Policy()
+
+    def make_rate_limited_request(self, url, verb=RequestVerb.GET, data=None, headers=None, read_until=None):
+        '''Fetch `url`, falling back to the policy's fallback urls in turn if it fails for good.
+        Returns the last response received; raises the last `requests.RequestException` if there was none.
+
+        With `read_until`, the body is streamed and reading stops as soon as `read_until(body so far)` is true:
+        the response's `content` is then only the start of the body (see `_read_until`).
+        '''
+        base_header = {'User-Agent': 'iconix', 'cache-control': 'no-cache'}
+        if not get_option('keep_alive'):
+            base_header['Connection'] = 'close'
+        if headers is not None:
+            headers = {**base_header, **headers}
+        else:
+            headers = base_header
+
+        start = time.perf_counter()
+        try:
+            with tracing.span('fetch', url=url):
+                res = None
+                error = None
+                for request_url in chain([url], self.policy.fallback_urls(url)):
+                    if request_url != url:
+                        print(f'[WARNING] {url} failed ({res if res is not None else error}) - falling back to {request_url}')
+
+                    try:
+                        res = self._fetch(request_url, verb, data, headers, read_until, fallback=request_url != url)
+                    except requests.RequestException as e:
+                        error = e
+                        continue
+
+                    writer = warc_writer()
+                    if writer is not None:
+                        writer.write(verb.name, request_url, headers, data, res, truncated=getattr(res, 'truncated', False))
+
+                    if res.status_code not in self.policy.retry_statuses + self.policy.fallback_statuses:
+                        return res
+
+                if res is None:
+                    raise error
+
+                return res
+        finally:
+            _fetch_time.seconds = fetch_seconds() + time.perf_counter() - start
+
+    def _fetch(self, url, verb, data, headers, read_until, fallback=False):
+        host = urlparse(url).hostname
+        run_metrics = metrics()
+
+        # replays skip everything else: network, cache, rate limiter and retries
+        archive = replay_archive()
+        if archive is not None:
+            res = archive.response(verb.name, url, data)
+            run_metrics.request(host, res.status_code, 0.0, len(res.content))
+            return res
+
+        # fresh cached responses skip both the network and the rate limiter
+        cache = response_cache()
+        entry = cache.get(verb.name, url, headers, data) if cache is not None else None
+        if entry is not None and entry.is_fresh(cache.ttl):
+            run_metrics.cache(host, 'hit')
+            return cache.fresh_response(entry)
+
+        request_headers = {**headers, **entry.validators()} if entry is not None else headers
+
+        breaker_key = self.policy.breaker_key(url)
+        limiter = host_limiter()
+        # only policies that opt in (many hosts, some dead) have breakers
+        breakers = circuit_breakers() if self.policy.circuit_breaker else None
+        timeout = (get_option('connect_timeout'), get_option('read_timeout'))
+        max_retries = get_option('max_retries')
+        for attempt in range(max_retries + 1):
+            if breakers is not None and not breakers.allow(breaker_key):
+                raise fetch_policy.HostUnavailable(f'{breaker_key} keeps failing - skipping {url}')
+
+            wait_start = time.time()
+            run_metrics.waited(host, limiter.acquire(host, self.rate, self.burst))
+            tracing.event('rate-wait', wait_start, time.time(), url=url)
+
+            sent_at = time.time()
+            sent = time.perf_counter()
+            try:
+                stream = read_until is not None
+                if verb is RequestVerb.POST:
+                    res = session().post(url, data=data, headers=request_headers, allow_redirects=True, timeout=timeout, stream=stream)
+                else:
+                    res = session().get(url, headers=request_headers, allow_redirects=True, timeout=timeout, stream=stream)
+                truncated = _read_until(res, read_until) if stream else False
+            except (requests.ConnectionError, requests.Timeout) as e:
+                run_metrics.request(host, None, time.perf_counter() - sent, 0)
+                tracing.event('connect', sent_at, time.time(), url=url, error=type(e).__name__)
+                # no point retrying once the host's breaker has opened
+                if self._failed(breaker_key) or attempt == max_retries:
+                    raise
+                print(f'[WARNING] {type(e).__name__} on {url} - retrying')
+                time.sleep(fetch_policy.backoff(attempt, get_option('backoff_base'), get_option('backoff_max')))
+                continue
+
+            run_metrics.request(host, res.status_code, time.perf_counter() - sent, len(res.content))
+            # `res.elapsed` runs until the response headers were parsed; the body is read after that
+            headers_at = min(sent_at + res.elapsed.total_seconds(), time.time())
+            tracing.event('connect', sent_at, headers_at, url=url, status=res.status_code)
+            tracing.event('download', headers_at, time.time(), url=url, bytes=len(res.content))
+
+            pause = throttle.retry_after(res.headers)
+            if _is_throttled(res, pause):
+                # the limiter holds back every worker's requests to this host until `pause` (at most `max_pause`) has passed
+                limiter.throttled(host, pause)
+                if pause is not None and pause > get_option('max_pause'):
+                    print(f'[WARNING] {host} asks to wait {pause:.0f}s (more than max_pause) - giving up on {url}')
+                    break
+                if attempt == max_retries:
+                    print(f'[WARNING] still throttled by {host} after {attempt} retries - giving up on {url}')
+                else:
+                    print(f'[WARNING] throttled by {host} ({res.status_code}) - retrying {url}' + (f' in {pause:.0f}s' if pause else ''))
+                continue
+
+            if pause is not None:
+                limiter.paused(host, pause)
+            limiter.succeeded(host)
+
+            opened = False
+            if self.policy.host_failed(res.status_code, fallback):
+                opened = self._failed(breaker_key)
+            elif breakers is not None:
+                breakers.succeeded(breaker_key)
+
+            if res.status_code in self.policy.retry_statuses and not opened and attempt < max_retries:
+                print(f'[WARNING] request to {url} not successful: {res} - retrying')
+                time.sleep(fetch_policy.backoff(attempt, get_option('backoff_base'), get_option('backoff_max')))
+                continue
+
+            break
+
+        res.truncated = truncated
+        if cache is not None:
+            if res.status_code == 304 and entry is not None:
+                run_metrics.cache(host, 'revalidated')
+                return cache.revalidated_response(entry, res)
+            run_metrics.cache(host, 'miss')
+            # the start of a body is no use to requests that need all of it
+            cache.store(verb.name, url, headers, data, res, complete=not truncated)
+
+        return res
+
+    def _failed(self, breaker_key):
+        '''Count a failure against `breaker_key` (if the policy has breakers); returns True if that opened its breaker.
+        '''
+        if not self.policy.circuit_breaker:
+            return False
+
+        opened = circuit_breakers().failed(breaker_key)
+        if opened:
+            print(f'[WARNING] {breaker_key} failed {get_option("breaker_threshold")} times in a row - '
+                  f'skipping it for {get_option("breaker_cooldown")}s')
+
+        return opened
+
+def _read_until(res, done):
+    '''Read a streamed response's body a chunk at a time until `done(body so far)`; returns True if reading
+    stopped before the end of the body. The body read is then the response's `content`.
+    A connection left mid-body can't be reused, so early exits cost a new connection for the next request to the host.
+    '''
+    body = bytearray()
+    truncated = False
+    for chunk in res.iter_content(STREAM_CHUNK_SIZE):
+        body += chunk
+        if done(body):
+            truncated = True
+            break
+
+    # releases the connection - or, if the body was not read to the end, closes it
+    res.close()
+    res._content = bytes(body)
+    res._content_consumed = True
+
+    return truncated
+
+def _is_throttled(res, retry_after):
+    return res.status_code == 429 or (res.status_code == 503 and retry_after is not None)
 
 def create_auth_headers(bearer_token=None, api_key=None):
     headers = {}
@@ -135,28 +673,99 @@ def handle_json_response(**kwargs):
         parsed_res = []
     else:
         try:
-            parsed_res = res.json()
+            with tracing.span('parse', url=url):
+                parsed_res = res.json()
         except Exception as e:
             print(f'[WARNING] Exception thrown on res.json() for {url}; {res.text} - skipping')
             parsed_res = []
 
     return parsed_res
 
-def run_multi_scraper(scraper, urls, num_processes, *args):
+def _batches(urls, batch_size, num_workers):
+    '''Split `urls` into batches of `batch_size` to hand out to workers as they free up. Once the end of the input is
+    in sight, batches shrink, so the last urls are spread over every worker instead of queuing up behind one:
+
+        >>> [len(batch) for batch in _batches(range(53), 5, 2)]
+        [5, 5, 5, 5, 5, 5, 5, 5, 5, 2, 2, 1, 1, 1, 1]
+    '''
+    url_iter = iter(urls)
+    lookahead = batch_size * num_workers
+    buf = deque()
+    exhausted = False
+
+    while True:
+        if not exhausted:
+            buf.extend(islice(url_iter, lookahead - len(buf)))
+            exhausted = len(buf) < lookahead
+        if not buf:
+            return
+
+        size = batch_size if not exhausted else min(batch_size, -(-len(buf) // (2 * num_workers)))
+        yield [buf.popleft() for _ in range(size)]
+
+def _scrape_batch(scraper, urls, args):
+    return [scraper.scrape_url(url, len(urls)-i, *args) for i, url in enumerate(urls)]
+
+def _pool_scrape(pool, scraper, urls, num_processes, args):
+    '''Hand out small batches of urls to pool workers on demand - an idle worker takes the next batch, so one slow
+    batch never holds up the rest - and yield results in input order.
+    At most `chunk_size` urls are in flight at a time.
+    '''
+    batch_size = get_option('batch_size')
+    window = max(2 * num_processes, get_option('chunk_size') // batch_size)
+    pending = deque()
+
+    for batch in _batches(urls, batch_size, num_processes):
+        pending.append(pool.apply_async(_scrape_batch, (scraper, batch, args)))
+        metrics().submitted(len(batch))
+        if len(pending) >= window:
+            yield from pending.popleft().get() # `get` is a blocking call
+
+    while pending:
+        yield from pending.popleft().get()
+
+def iter_multi_scraper(scraper, urls, num_processes, *args):
+    '''Like `run_multi_scraper`, but yields results in input order as they complete, so callers can stream them out
+    without holding every result in memory.
+    '''
     if num_processes < 1 or not isinstance(num_processes, int):
         raise ValueError('num_processes must be a positive integer')
 
-    if num_processes is 1:
-        return scraper.run(urls, *args)
-
-    pool = Pool(processes=num_processes)
+    backend = get_option('backend')
+    pool = worker_pool(num_processes) if backend == 'pool' and num_processes > 1 else None
+    hosts = set()
+
+    def track_hosts(urls):
+        for url in urls:
+            hosts.add(urlparse(url).hostname)
+            yield url
+
+    url_iter = track_hosts(urls)
+    try:
+        if pool is not None:
+            print(f'Executing scrape across max {num_processes} processes ({get_option("batch_size")} urls per batch)')
+            yield from _pool_scrape(pool, scraper, url_iter, num_processes, args)
+        else:
+            while True:
+                chunk = list(islice(url_iter, get_option('chunk_size')))
+                if not chunk:
+                    break
+
+                if backend == 'async':
+                    yield from async_scraper.run(scraper, chunk, *args)
+                else:
+                    yield from scraper.run(chunk, *args)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    host_limiter().report(hosts)
+    if response_cache() is not None:
+        response_cache().report()
 
-    print(f'Executing scrape across max {num_processes} processes')
-    async_results = [pool.apply_async(scraper.run, (split, *args)) for split in np.array_split(urls, num_processes)]
-    pool_results = []
-    for res in async_results:
-        pool_results.extend(res.get()) # `get` is a blocking call
-
-    pool.close()
+def run_multi_scraper(scraper, urls, num_processes, *args):
+    return list(iter_multi_scraper(scraper, urls, num_processes, *args))
 
-    return pool_results
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
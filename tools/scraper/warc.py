@@ -0,0 +1,273 @@
+'''WARC capture of the run's HTTP responses, and offline replay of them.
+
+With the `warc_dir` option, every response `utils.RequestRateLimiter` hands to a scraper - fetched, or served by
+the response cache - is written to gzipped WARC/1.1 files there, with the request that asked for it: a `request`
+record and a `response` record per fetch, each record its own gzip member, as web archives store them. Each
+process writes its own files (`scrape-<time>-<pid>-<n>.warc.gz`, rolled over at `MAX_FILE_BYTES`); standard
+WARC tools (warcio, pywb...) read them.
+
+With the `replay_dir` option, requests are answered from the WARC files there instead: no network, no rate
+limits, no retries. Rerunning a command with it re-extracts everything a previous run fetched at CPU speed, e.g.
+after a change to a selector or a response handler.
+
+Responses are stored as `requests` hands them over: bodies decoded (no `Content-Encoding`), and, for streamed
+requests that stopped early (`read_until`), only the start of the body (marked with `WARC-Truncated`).
+Credentials (`http_cache.SENSITIVE_HEADERS`) are left out of the request records.
+
+    >>> import requests, tempfile
+    >>> res = requests.Response()
+    >>> res.status_code, res.reason, res.url = 200, 'OK', 'https://example.com/final'
+    >>> res.headers = requests.structures.CaseInsensitiveDict({'Content-Type': 'text/html; charset=utf-8', 'Content-Encoding': 'gzip'})
+    >>> res._content = '<p>café</p>'.encode('utf-8')
+    >>> warc_dir = tempfile.mkdtemp()
+    >>> Writer(warc_dir).write('GET', 'https://example.com/page?q=1', {'Authorization': 'Bearer secret'}, None, res)
+    >>> archive = Archive(warc_dir)
+    >>> len(archive)
+    1
+    >>> replayed = archive.response('GET', 'https://example.com/page?q=1')
+    >>> replayed.status_code, replayed.url, replayed.text, 'Content-Encoding' in replayed.headers
+    (200, 'https://example.com/final', '<p>café</p>', False)
+    >>> try:
+    ...     archive.response('POST', 'https://example.com/page?q=1')
+    ... except NotArchived as e:
+    ...     print(e)
+    POST https://example.com/page?q=1 is not in the replayed archives
+'''
+
+import base64
+from datetime import datetime, timedelta, timezone
+import hashlib
+import http_cache
+import os
+import requests
+from requests.structures import CaseInsensitiveDict
+import requests.utils
+import threading
+import time
+from urllib.parse import urlsplit
+import uuid
+import zlib
+
+# a process starts a new file once its current one has grown past this
+MAX_FILE_BYTES = 1024 ** 3
+
+# response headers that describe the body on the wire, not the decoded body stored
+_WIRE_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length')
+
+# compressed bytes read at a time when scanning archives
+_READ_SIZE = 1024 ** 2
+
+class NotArchived(requests.exceptions.ConnectionError):
+    '''A request the replayed archives have no response for: it fails as a request that got no response would.
+    '''
+
+def _body(data):
+    if data is None:
+        return b''
+
+    return data if isinstance(data, bytes) else str(data).encode()
+
+def _key(method, url, data):
+    h = hashlib.sha256(f'{method} {url}\n'.encode())
+    h.update(_body(data))
+
+    return h.hexdigest()
+
+class Writer():
+    '''Append request / response records to this process's WARC files in `warc_dir`
+    '''
+    def __init__(self, warc_dir, max_file_bytes=MAX_FILE_BYTES):
+        self.warc_dir = warc_dir
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        self.file = None
+        self.files = 0
+
+        os.makedirs(warc_dir, exist_ok=True)
+
+    def write(self, method, url, headers, data, res, truncated=False):
+        '''Archive response `res` to a `method` request for `url` with `headers` and body `data`
+        '''
+        request_id = _record_id()
+        date = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += f'?{parts.query}'
+        request_headers = {'Host': parts.netloc, **{name: value for name, value in http_cache.public_headers(headers).items()
+                                                    if name.lower() != 'host'}}
+        request_block = _http_block(f'{method} {target} HTTP/1.1', request_headers, _body(data))
+
+        content = res.content or b''
+        response_headers = {name: value for name, value in res.headers.items() if name.lower() not in _WIRE_HEADERS}
+        response_headers['Content-Length'] = str(len(content))
+        response_block = _http_block(f'HTTP/1.1 {res.status_code} {res.reason or ""}'.rstrip(), response_headers, content)
+
+        response_fields = {'WARC-Concurrent-To': request_id,
+                           'WARC-Payload-Digest': 'sha1:' + base64.b32encode(hashlib.sha1(content).digest()).decode()}
+        if res.url and res.url != url:
+            # an extension field: where redirects led (`requests`' `res.url`)
+            response_fields['WARC-Final-URI'] = res.url
+        if truncated:
+            response_fields['WARC-Truncated'] = 'length'
+
+        records = (_record('request', request_id, date, url, 'application/http; msgtype=request', request_block) +
+                   _record('response', _record_id(), date, url, 'application/http; msgtype=response', response_block, response_fields))
+
+        with self.lock:
+            f = self._file()
+            f.write(records)
+            # whole records only: a process killed between writes leaves a readable file
+            f.flush()
+
+    def _file(self):
+        if self.file is None or self.file.tell() >= self.max_file_bytes:
+            if self.file is not None:
+                self.file.close()
+            self.files += 1
+            name = f'scrape-{time.strftime("%Y%m%d%H%M%S")}-{os.getpid()}-{self.files:05d}.warc.gz'
+            self.file = open(os.path.join(self.warc_dir, name), 'ab')
+            info = b'software: iconix/openai scraper\r\nformat: WARC File Format 1.1\r\n'
+            self.file.write(_record('warcinfo', _record_id(), datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                    None, 'application/warc-fields', info, {'WARC-Filename': name}))
+
+        return self.file
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def _record_id():
+    return f'<urn:uuid:{uuid.uuid4()}>'
+
+def _http_block(start_line, headers, body):
+    head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    return f'{start_line}\r\n{head}\r\n'.encode('iso-8859-1', errors='replace') + body
+
+def _record(type, record_id, date, url, content_type, block, fields=None):
+    '''One gzipped WARC record
+    '''
+    header = {'WARC-Type': type, 'WARC-Record-ID': record_id, 'WARC-Date': date}
+    if url is not None:
+        header['WARC-Target-URI'] = url
+    header.update(fields or {})
+    header.update({'Content-Type': content_type, 'Content-Length': str(len(block))})
+    record = ('WARC/1.1\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in header.items()) + '\r\n').encode('utf-8')
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(record + block + b'\r\n\r\n') + compressor.flush()
+
+class Archive():
+    '''The responses in the WARC files of `replay_dir`, indexed by request (method, url and body).
+    When the same request was archived more than once, the latest response wins.
+    '''
+    def __init__(self, replay_dir):
+        self.replay_dir = replay_dir
+        # request key -> (file, offset of its response record)
+        self.index = {}
+
+        if not os.path.isdir(replay_dir):
+            raise ValueError(f'replay_dir {replay_dir} is not a directory')
+
+        paths = sorted(os.path.join(replay_dir, name) for name in os.listdir(replay_dir) if name.endswith('.warc.gz'))
+        for path in paths:
+            self._index_file(path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _index_file(self, path):
+        # request records come before their responses (`Writer.write`); other tools' archives may have none, or write them later
+        requests_by_id = {}
+        responses = []
+        with open(path, 'rb') as f:
+            for offset, record in _records(f):
+                fields, block = _parse_record(record)
+                if fields.get('warc-type') == 'request':
+                    method = block.split(b' ', 1)[0].decode('ascii', errors='replace')
+                    requests_by_id[fields.get('warc-record-id')] = (method, fields.get('warc-target-uri'), block.split(b'\r\n\r\n', 1)[-1])
+                elif fields.get('warc-type') == 'response':
+                    responses.append((offset, fields))
+
+        for offset, fields in responses:
+            method, url, data = requests_by_id.get(fields.get('warc-concurrent-to'), ('GET', fields.get('warc-target-uri'), None))
+            self.index[_key(method, url, data)] = (path, offset)
+
+    def response(self, method, url, data=None):
+        '''The archived response to a `method` request for `url` with body `data`, as a `requests.Response`;
+        raises `NotArchived` if there is none.
+        '''
+        location = self.index.get(_key(method, url, data))
+        if location is None:
+            raise NotArchived(f'{method} {url} is not in the replayed archives')
+
+        path, offset = location
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            _, record = next(_records(f))
+        fields, block = _parse_record(record)
+
+        head, _, content = block.partition(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        status = lines[0].split(' ', 2)
+        headers = CaseInsensitiveDict(line.split(':', 1) for line in lines[1:] if ':' in line)
+        headers = CaseInsensitiveDict({name: value.strip() for name, value in headers.items()})
+
+        res = requests.Response()
+        res.status_code = int(status[1])
+        res.reason = status[2] if len(status) > 2 else ''
+        res.headers = headers
+        res._content = content
+        res.encoding = requests.utils.get_encoding_from_headers(headers)
+        res.url = fields.get('warc-final-uri', url)
+        res.elapsed = timedelta(0)
+        res.request = requests.Request(method, url).prepare()
+        res.from_archive = True
+
+        return res
+
+def _records(f):
+    '''(offset, record bytes) of each gzip member of `f` from its current position - that is, of each record of a
+    gzipped WARC file. A member cut short (a writer killed mid-record) ends the file.
+    '''
+    offset = f.tell()
+    buf = b''
+    while True:
+        if not buf:
+            buf = f.read(_READ_SIZE)
+            if not buf:
+                return
+
+        start = offset
+        decompressor = zlib.decompressobj(31)
+        out = []
+        while True:
+            out.append(decompressor.decompress(buf))
+            if decompressor.eof:
+                offset += len(buf) - len(decompressor.unused_data)
+                buf = decompressor.unused_data
+                break
+            offset += len(buf)
+            buf = f.read(_READ_SIZE)
+            if not buf:
+                return
+
+        yield start, b''.join(out)
+
+def _parse_record(record):
+    '''(fields with lowercased names, content block) of one WARC record
+    '''
+    head, _, rest = record.partition(b'\r\n\r\n')
+    fields = {}
+    for line in head.decode('utf-8', errors='replace').split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        fields[name.strip().lower()] = value.strip()
+
+    return fields, rest[:int(fields.get('content-length', len(rest)))]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()